@@ -0,0 +1,39 @@
+# api/concurrency.py
+"""
+CPU バウンド処理（埋め込み・FAISS 検索など）用の上限付きスレッドプール。
+
+イベントループのデフォルト executor もこのプールに差し替えるため、
+LangChain の非同期 API が内部で使う run_in_executor(None, ...) も同じ上限に従う。
+"""
+
+import os
+import asyncio
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+RAG_THREADPOOL_SIZE = int(os.environ.get("RAG_THREADPOOL_SIZE", str(min(32, (os.cpu_count() or 1) + 4))))
+
+_executor: ThreadPoolExecutor | None = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=RAG_THREADPOOL_SIZE, thread_name_prefix="rag-worker")
+    return _executor
+
+
+def install_default_executor(loop: asyncio.AbstractEventLoop | None = None):
+    """イベントループのデフォルト executor を上限付きプールに差し替える"""
+    loop = loop or asyncio.get_running_loop()
+    loop.set_default_executor(get_executor())
+    logger.info(f"✅ Default executor installed (max_workers={RAG_THREADPOOL_SIZE})")
+
+
+async def run_in_pool(fn, *args, **kwargs):
+    """同期関数をプール上で実行して結果を await する"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(fn, *args, **kwargs))
@@ -5,6 +5,9 @@ from pathlib import Path
 from datetime import datetime
 from uuid import uuid4
 import traceback
+import json
+import time
+from functools import lru_cache
 
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
@@ -15,6 +18,10 @@ import io
 import sys
 
 import main
+from api.concurrency import run_in_pool
+from rag.index_version import current_version
+from rag.semantic_cache import get_semantic_cache
+from rag.answer_cache import get_answer_cache, prompt_hash
 
 router = APIRouter()
 history_logs: list[dict] = []
@@ -22,25 +29,194 @@ history_logs: list[dict] = []
 # ロガー設定
 logger = logging.getLogger(__name__)
 
+class SearchFilters(BaseModel):
+    """検索の絞り込み（条件はすべて AND。リストはいずれかに一致）"""
+    sources: list[str] | None = None
+    customer: list[str] | None = None
+    tags: list[str] | None = None
+    page_from: int | None = None
+    page_to: int | None = None
+    uploaded_from: float | None = None  # UNIX 秒
+    uploaded_to: float | None = None
+
+    def to_filter(self) -> dict | None:
+        """rag/metadata_filter.py の形にする（条件がなければ None）"""
+        search_filter: dict = {"source": self.sources, "customer": self.customer, "tags": self.tags}
+        for field, low, high in (("page", self.page_from, self.page_to),
+                                 ("uploaded_at", self.uploaded_from, self.uploaded_to)):
+            bounds = {op: v for op, v in (("gte", low), ("lte", high)) if v is not None}
+            if bounds:
+                search_filter[field] = bounds
+        search_filter = {k: v for k, v in search_filter.items() if v}
+        return search_filter or None
+
 class ChatRequest(BaseModel):
     question: str
     username: str | None = None
+    filters: SearchFilters | None = None
+    # 取り込み時に返る document_id。指定するとその文書（複数可）のチャンクだけを検索する
+    document_ids: list[str] | None = None
+    # 顧客ごとのシャード（rag/tenant_shards.py）。省略時は共有ストア
+    tenant: str | None = None
+
+    def search_filter(self) -> dict | None:
+        search_filter = (self.filters.to_filter() if self.filters else None) or {}
+        if self.document_ids:
+            search_filter["document_id"] = self.document_ids
+        return search_filter or None
+
+    @property
+    def scoped(self) -> bool:
+        """テナント・絞り込みの指定がある（回答キャッシュを使わない）"""
+        return bool(self.tenant or self.search_filter())
+
+
+async def _check_request(req: ChatRequest):
+    """テナントキーが不正なら 400、document_ids に取り込み台帳にないものがあれば 404（全体検索に黙って切り替えない）"""
+    if req.tenant:
+        from rag.tenant_shards import validate_tenant
+        try:
+            validate_tenant(req.tenant)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="テナントキーが不正です。")
+    if not req.document_ids or main.vectorstore is None:
+        return
+    from rag.ingested_text import unknown_documents
+    missing = await run_in_pool(unknown_documents, req.document_ids, req.tenant)
+    if missing:
+        raise HTTPException(status_code=404, detail=f"文書が見つかりません: {', '.join(missing)}")
+
+
+async def _resolve_chain(req: ChatRequest) -> tuple:
+    """(ベクトルストア, RAG チェーン)。テナント・絞り込みの指定があれば retriever を差し替えたチェーン"""
+    vectorstore, chain = main.vectorstore, main.rag_chain_template
+    if not (vectorstore and req.scoped):
+        return vectorstore, chain
+    from rag.ingested_text import filtered_chain, get_vectorstore
+    if req.tenant:
+        # シャードの初回ロード（GCS からの取得を含む）はスレッドプールで
+        vectorstore = await run_in_pool(get_vectorstore, req.tenant)
+    return vectorstore, filtered_chain(chain, vectorstore, req.search_filter()) if chain else None
+
+def _to_sources(docs) -> list[dict]:
+    sources = []
+    for doc in docs:
+        meta = {k: str(v) for k, v in doc.metadata.items()}
+        meta["source"] = Path(meta.get("source", "unknown")).name
+        meta.setdefault("page", "?")
+        sources.append({"metadata": meta})
+    return sources
+
+
+def _search_only_answer(docs, header: str) -> str:
+    answer = header
+    for i, doc in enumerate(docs[:3], 1):
+        answer += f"{i}. {doc.page_content[:200]}...\n"
+        answer += f"   出典: {doc.metadata.get('source', '不明')} (p{doc.metadata.get('page', '?')})\n\n"
+    return answer
+
+
+async def _run_chain(chain, query: str) -> dict:
+    """チェーンを非同期で実行（ネイティブ async が無ければスレッドプールで実行）"""
+    if hasattr(chain, "ainvoke"):
+        return await chain.ainvoke({"query": query})
+    if hasattr(chain, "invoke"):
+        return await run_in_pool(chain.invoke, {"query": query})
+    if hasattr(chain, "run"):
+        answer = await run_in_pool(chain.run, query)
+        return {"result": answer, "source_documents": []}
+    return await run_in_pool(chain, {"query": query})
+
+
+async def _call_llm(llm, prompt: str) -> str:
+    if hasattr(llm, "ainvoke"):
+        response = await llm.ainvoke(prompt)
+    elif hasattr(llm, "invoke"):
+        response = await run_in_pool(llm.invoke, prompt)
+    else:
+        response = await run_in_pool(llm, prompt)
+    return response.content if hasattr(response, "content") else str(response)
+
+
+@lru_cache(maxsize=1)
+def _prompt_fingerprint() -> str:
+    from rag.ingested_text import load_prompt
+    return prompt_hash(load_prompt().template)
+
+
+def _answer_model_name() -> str:
+    from rag.ingested_text import SimpleSearchChain
+    if main.llm_instance is None or isinstance(main.rag_chain_template, SimpleSearchChain):
+        return "search-only"
+    return getattr(main.llm_instance, "model_name", None) or type(main.llm_instance).__name__
+
+
+def _exact_lookup(query: str) -> dict | None:
+    cache = get_answer_cache()
+    if cache is None:
+        return None
+    return cache.get(query, _prompt_fingerprint(), _answer_model_name())
+
+
+def _semantic_lookup(query: str) -> dict | None:
+    cache = get_semantic_cache()
+    if cache is None:
+        return None
+    return cache.lookup(query, current_version())
+
+
+async def _cache_lookup(query: str) -> dict | None:
+    """完全一致キャッシュ → セマンティックキャッシュの順に引く（失敗してもチャット自体は続行）"""
+    for name, lookup in (("exact", _exact_lookup), ("semantic", _semantic_lookup)):
+        try:
+            cached = await run_in_pool(lookup, query)
+        except Exception as e:
+            logger.warning(f"{name} answer cache lookup failed: {e}")
+            continue
+        if cached:
+            logger.info(f"Answer cache hit ({name}): {query}")
+            return {**cached, "cache": name}
+    return None
+
+
+def _cache_store_sync(query: str, answer: str, sources: list[dict], index_version: str):
+    """index_version: 検索を始める前のインデックスバージョン（回答はこの版から作られた）"""
+    answer_cache = get_answer_cache()
+    # 処理中にインデックスが変わった（無効化は済んでいる）なら、古い版の回答を入れ直さない
+    if answer_cache is not None and current_version() == index_version:
+        answer_cache.put(query, answer, sources, _prompt_fingerprint(), _answer_model_name())
+    semantic_cache = get_semantic_cache()
+    if semantic_cache is not None:
+        semantic_cache.store(query, answer, sources, index_version)
+
+
+async def _cache_store(query: str, answer: str, sources: list[dict], index_version: str):
+    try:
+        await run_in_pool(_cache_store_sync, query, answer, sources, index_version)
+    except Exception as e:
+        logger.warning(f"Answer cache store failed: {e}")
+
+
+def _search_kwargs(k: int, search_filter: dict | None) -> dict:
+    return {"k": k, "filter": search_filter} if search_filter else {"k": k}
+
 
 @router.post("/", summary="AI チャット")
 async def chat_endpoint(req: ChatRequest):
     logger.info(f"=== chat_endpoint called === question: {req.question}, username: {req.username}")
+    await _check_request(req)
     
     query = req.question
     user = req.username or "guest"
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    search_filter = req.search_filter()
     
     answer = ""
     sources: list[dict] = []
     
     try:
         # グローバル変数から取得
-        vectorstore = main.vectorstore
-        rag_chain_template = main.rag_chain_template
+        vectorstore, rag_chain_template = await _resolve_chain(req)
         
         logger.info(f"Vectorstore: {vectorstore is not None}, RAG chain: {rag_chain_template is not None}")
         
@@ -53,20 +229,12 @@ async def chat_endpoint(req: ChatRequest):
             # RAGチェーンがない場合、直接検索を試みる
             logger.info("RAG chain not available, trying direct search")
             try:
-                retriever = vectorstore.as_retriever()
-                docs = retriever.get_relevant_documents(query)
+                retriever = vectorstore.as_retriever(search_kwargs=_search_kwargs(4, search_filter))
+                docs = await retriever.ainvoke(query)
                 
                 if docs:
-                    answer = "以下の関連情報が見つかりました：\n\n"
-                    for i, doc in enumerate(docs[:3], 1):
-                        answer += f"{i}. {doc.page_content[:200]}...\n"
-                        answer += f"   出典: {doc.metadata.get('source', '不明')} (p{doc.metadata.get('page', '?')})\n\n"
-                    
-                    for doc in docs[:3]:
-                        meta = {k: str(v) for k, v in doc.metadata.items()}
-                        meta["source"] = Path(meta.get("source", "unknown")).name
-                        meta.setdefault("page", "?")
-                        sources.append({"metadata": meta})
+                    answer = _search_only_answer(docs, "以下の関連情報が見つかりました：\n\n")
+                    sources = _to_sources(docs[:3])
                 else:
                     answer = "関連する情報が見つかりませんでした。別の質問をお試しください。"
                     sources = [{"metadata": {"source": "検索結果なし", "page": "N/A"}}]
@@ -77,34 +245,29 @@ async def chat_endpoint(req: ChatRequest):
                 sources = [{"metadata": {"source": "エラー", "page": "N/A"}}]
                 
         else:
-            # 通常のRAG処理
+            # 通常のRAG処理（LLM 呼び出しは ainvoke、埋め込み・FAISS はスレッドプール）
             logger.info("Using RAG chain for processing")
             try:
-                # 新しいLangChainの方法で実行
-                if hasattr(rag_chain_template, '__call__'):
-                    # 古いスタイル（callable chain）
-                    result = rag_chain_template({"query": query})
+                # 回答の元になる版は検索の前に決まる（処理中の取り込みで新しい版の回答として保存しない）
+                index_version = current_version()
+                # テナント・絞り込みありの回答はキャッシュしない（同じ質問でも対象が違う）
+                cached = await _cache_lookup(query) if not req.scoped else None
+                if cached:
+                    answer = cached["answer"]
+                    sources = cached["sources"]
                 else:
-                    # 新しいスタイル - invoke()の代わりに__call__を使用
-                    # または、runメソッドがある場合はそれを使用
-                    if hasattr(rag_chain_template, 'run'):
-                        answer = rag_chain_template.run(query)
-                        result = {"result": answer, "source_documents": []}
-                    else:
-                        # RetrievalQAの直接実行
-                        result = rag_chain_template({"query": query}, callbacks=[])
-                
-                # 結果を取得
-                answer = result.get("result", "")
-                if not answer:
-                    answer = "申し訳ございません。回答を生成できませんでした。"
-                
-                # ソースドキュメントを処理
-                for doc in result.get("source_documents", []):
-                    meta = {k: str(v) for k, v in doc.metadata.items()}
-                    meta["source"] = Path(meta.get("source", "unknown")).name
-                    meta.setdefault("page", "?")
-                    sources.append({"metadata": meta})
+                    result = await _run_chain(rag_chain_template, query)
+                    
+                    # 結果を取得
+                    answer = result.get("result", "")
+                    
+                    # ソースドキュメントを処理
+                    sources = _to_sources(result.get("source_documents", []))
+                    
+                    if not answer:
+                        answer = "申し訳ございません。回答を生成できませんでした。"
+                    elif not req.scoped:
+                        await _cache_store(query, answer, sources, index_version)
                     
             except Exception as e:
                 logger.error(f"RAG chain error: {e}")
@@ -116,8 +279,8 @@ async def chat_endpoint(req: ChatRequest):
                     # callbacksエラーの場合、別の方法を試す
                     try:
                         # retrieverを直接使用してドキュメント検索
-                        retriever = vectorstore.as_retriever(search_kwargs={"k": 3})
-                        docs = retriever.get_relevant_documents(query)
+                        retriever = vectorstore.as_retriever(search_kwargs=_search_kwargs(3, search_filter))
+                        docs = await retriever.ainvoke(query)
                         
                         if docs:
                             # LLMが利用可能な場合
@@ -135,34 +298,13 @@ async def chat_endpoint(req: ChatRequest):
 回答（日本語で分かりやすく）:"""
                                 
                                 # LLMを直接呼び出し
-                                if hasattr(main.llm_instance, 'invoke'):
-                                    llm_response = main.llm_instance.invoke(prompt)
-                                    answer = llm_response.content if hasattr(llm_response, 'content') else str(llm_response)
-                                else:
-                                    answer = main.llm_instance(prompt)
-                                    if hasattr(answer, 'content'):
-                                        answer = answer.content
-                                    else:
-                                        answer = str(answer)
-                                
-                                # ソースドキュメントを追加
-                                for doc in docs[:3]:
-                                    meta = {k: str(v) for k, v in doc.metadata.items()}
-                                    meta["source"] = Path(meta.get("source", "unknown")).name
-                                    meta.setdefault("page", "?")
-                                    sources.append({"metadata": meta})
+                                answer = await _call_llm(main.llm_instance, prompt)
                             else:
                                 # LLMがない場合は検索結果のみ返す
-                                answer = "関連情報が見つかりました:\n\n"
-                                for i, doc in enumerate(docs[:3], 1):
-                                    answer += f"{i}. {doc.page_content[:200]}...\n"
-                                    answer += f"   出典: {doc.metadata.get('source', '不明')} (p{doc.metadata.get('page', '?')})\n\n"
-                                
-                                for doc in docs[:3]:
-                                    meta = {k: str(v) for k, v in doc.metadata.items()}
-                                    meta["source"] = Path(meta.get("source", "unknown")).name
-                                    meta.setdefault("page", "?")
-                                    sources.append({"metadata": meta})
+                                answer = _search_only_answer(docs, "関連情報が見つかりました:\n\n")
+                            
+                            # ソースドキュメントを追加
+                            sources = _to_sources(docs[:3])
                         else:
                             answer = "関連する情報が見つかりませんでした。"
                             sources = [{"metadata": {"source": "検索結果なし", "page": "N/A"}}]
@@ -210,6 +352,119 @@ async def chat_endpoint_slashless(req: ChatRequest):
     """スラッシュなしのエンドポイント（互換性のため）"""
     return await chat_endpoint(req)
 
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _elapsed_ms(start: float) -> float:
+    return round((time.perf_counter() - start) * 1000, 1)
+
+
+async def _stream_chat(req: ChatRequest):
+    """sources → token（複数）→ done の順で SSE イベントを生成"""
+    from rag.ingested_text import SimpleSearchChain, load_prompt, format_context, RAG_TOP_K
+
+    query = req.question
+    user = req.username or "guest"
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    started = time.perf_counter()
+    timings: dict = {}
+    answer = ""
+    sources: list[dict] = []
+    cached = None
+    error_id = None
+    search_filter = req.search_filter()
+
+    try:
+        vectorstore, rag_chain_template = await _resolve_chain(req)
+        use_cache = vectorstore and rag_chain_template and not req.scoped
+        index_version = current_version()
+        cached = await _cache_lookup(query) if use_cache else None
+
+        if not vectorstore:
+            answer = "申し訳ございません。システムが準備中です。しばらくしてから再度お試しください。"
+            sources = [{"metadata": {"source": "システムメッセージ", "page": "N/A"}}]
+            yield _sse("sources", {"sources": sources})
+
+        elif cached:
+            answer, sources = cached["answer"], cached["sources"]
+            yield _sse("sources", {"sources": sources, "cached": cached["cache"]})
+
+        else:
+            # 1) 検索（get_rag_chain と同じ retriever を使う）
+            retriever = getattr(rag_chain_template, "retriever", None) or vectorstore.as_retriever(
+                search_kwargs=_search_kwargs(RAG_TOP_K, search_filter)
+            )
+            if hasattr(retriever, "retrieve_with_stats"):
+                # rerank 付き: 並べ直しの所要時間を別に記録する
+                docs, rerank_info = await run_in_pool(retriever.retrieve_with_stats, query)
+                timings["rerank_ms"] = rerank_info["rerank_ms"]
+                timings["rerank_fallback"] = rerank_info["fallback"]
+            else:
+                docs = await retriever.ainvoke(query)
+            docs = docs[:RAG_TOP_K]
+            sources = _to_sources(docs)
+            timings["retrieval_ms"] = _elapsed_ms(started)
+            yield _sse("sources", {"sources": sources, "retrieval_ms": timings["retrieval_ms"]})
+
+            # 2) 生成（検索のみモードでは LLM を呼ばない）
+            llm = main.llm_instance
+            if isinstance(rag_chain_template, SimpleSearchChain) or llm is None or not docs:
+                answer = SimpleSearchChain.format_result(docs)["result"]
+            else:
+                prompt = load_prompt().format(context=format_context(docs), question=query)
+                parts = []
+                async for chunk in llm.astream(prompt):
+                    token = chunk.content if hasattr(chunk, "content") else str(chunk)
+                    if not token:
+                        continue
+                    if not parts:
+                        timings["first_token_ms"] = _elapsed_ms(started)
+                    parts.append(token)
+                    yield _sse("token", {"token": token})
+                answer = "".join(parts)
+                if not answer:
+                    answer = "申し訳ございません。回答を生成できませんでした。"
+                elif use_cache:
+                    await _cache_store(query, answer, sources, index_version)
+
+    except Exception as e:
+        error_id = str(uuid4())[:8]
+        logger.error(f"Stream error [{error_id}]: {e}")
+        logger.error(traceback.format_exc())
+        answer = f"システムエラーが発生しました。管理者にお問い合わせください。（エラーID: {error_id}）"
+        yield _sse("error", {"message": answer, "error_id": error_id})
+
+    timings["total_ms"] = _elapsed_ms(started)
+    history_logs.append({
+        "id": str(uuid4()),
+        "question": query,
+        "username": user,
+        "answer": answer,
+        "timestamp": now,
+        "sources": sources,
+    })
+    done = {"answer": answer, "sources": sources, "cached": cached["cache"] if cached else None,
+            "timings": timings, "status": "error" if error_id else "ok"}
+    if error_id:
+        done["error_id"] = error_id
+    yield _sse("done", done)
+
+
+@router.post("/stream", summary="AI チャット（SSE ストリーミング）")
+async def chat_stream_endpoint(req: ChatRequest):
+    """
+    回答を Server-Sent Events で返す。
+    イベント順: sources（検索結果）→ token（生成トークン）→ done（全文・出典・所要時間）
+    """
+    await _check_request(req)
+    return StreamingResponse(
+        _stream_chat(req),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @router.get("/history", summary="チャット履歴取得")
 def get_history():
     return {"logs": history_logs}
@@ -1,6 +1,7 @@
 # api/routers/healthz.py
 
 from fastapi import APIRouter
+from fastapi.responses import JSONResponse
 import os
 import psycopg2
 
@@ -23,3 +24,12 @@ def healthz():
         return {"status": "ok", "db": result}
     except Exception as e:
         return {"status": "ng", "error": str(e)}
+
+
+@router.get("/readyz")
+def readyz():
+    """起動処理の各ステップ（埋め込み・ベクトルストア・LLM など）の状態と所要時間。
+    必須のステップがそろうまでは 503"""
+    from api.startup import readiness
+    status = readiness()
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
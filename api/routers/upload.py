@@ -1,6 +1,13 @@
-from rag.ingested_text import ingest_pdf_to_vectorstore
-from fastapi import APIRouter, UploadFile, File, HTTPException
+from rag.ingest_jobs import get_ingest_queue
+from rag.ingested_text import find_ingested, delete_document, list_documents
+from rag.tenant_shards import validate_tenant
+from rag.file_registry import bytes_sha256
+from api.concurrency import run_in_pool, get_executor
+from fastapi import APIRouter, UploadFile, File, HTTPException, Response, Query
 from google.cloud import storage
+import asyncio
+import json
+import time
 import uuid
 import tempfile
 import os
@@ -11,6 +18,9 @@ router = APIRouter()
 logger = logging.getLogger(__name__)
 
 GCS_BUCKET_NAME = os.environ.get("GCS_BUCKET_NAME")
+# /upload_pdf（互換用）がジョブの完了を待つ上限と、ジョブの状態を見に行く間隔
+UPLOAD_PDF_WAIT_SECONDS = float(os.environ.get("UPLOAD_PDF_WAIT_SECONDS", "600"))
+UPLOAD_PDF_POLL_SECONDS = 0.5
 if not GCS_BUCKET_NAME:
     logger.warning("GCS_BUCKET_NAME 環境変数が未設定です。ローカルストレージモードで動作します。")
 
@@ -52,58 +62,179 @@ def download_gcs_to_local(gs_path: str, local_path: str):
     blob.download_to_filename(local_path)
     return local_path
 
-@router.post("/ingest", summary="PDFファイルのアップロードとベクトル化")
-async def ingest(file: UploadFile = File(...)):
-    """
-    PDFファイルをアップロードしてベクトル化する
-    """
+def upload_bytes_to_gcs(data: bytes, dest_filename: str) -> str:
+    """アップロードされた PDF の原本を GCS に保存（取り込みとは独立）"""
+    client = storage.Client()
+    bucket = client.bucket(GCS_BUCKET_NAME)
+    bucket.blob(dest_filename).upload_from_string(data, content_type="application/pdf")
+    return f"gs://{GCS_BUCKET_NAME}/{dest_filename}"
+
+def _archive_original(data: bytes, dest_filename: str):
+    try:
+        gcs_path = upload_bytes_to_gcs(data, dest_filename)
+        logger.info(f"GCSアップロード成功: {gcs_path}")
+    except Exception as e:
+        # GCSアップロードが失敗してもベクトル化は続行
+        logger.error(f"GCSアップロード失敗: {e}")
+
+def _tenant(tenant: str | None) -> str | None:
+    """テナントキーの確認（不正なら 400。省略時は共有ストア）"""
+    if not tenant:
+        return None
+    try:
+        return validate_tenant(tenant)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="テナントキーが不正です。")
+
+def _job_response(job: dict) -> dict:
+    """ジョブテーブルの行を API レスポンスにする（サーバー内のパス・ワーカー名は返さない）"""
+    body = {k: v for k, v in job.items() if k not in ("path", "owner")}
+    body["metadata"] = json.loads(job["metadata"]) if job.get("metadata") else None
+    # 取り込み台帳のキー（/chat の document_ids に渡すとこの文書だけを検索する）
+    ledgered = job["status"] == "succeeded" and (job.get("skipped") or job.get("added_docs"))
+    body["document_id"] = job.get("sha256") if ledgered else None
+    body["job_id"] = job["id"]
+    body["skipped"] = bool(job.get("skipped"))
+    total = job.get("chunks_total") or 0
+    body["progress"] = round((job.get("chunks_embedded") or 0) / total, 4) if total else 0.0
+    if job["status"] == "succeeded":
+        body["progress"] = 1.0
+    body["status_url"] = f"/upload/jobs/{job['id']}"
+    return body
+
+async def _submit_ingest(file: UploadFile, replace: bool = False, metadata: dict | None = None,
+                         tenant: str | None = None) -> dict:
     if not file.filename.lower().endswith(".pdf"):
         raise HTTPException(status_code=400, detail="PDFファイルのみ対応です。")
 
-    ext = os.path.splitext(file.filename)[1]
-    unique_filename = f"{uuid.uuid4().hex}{ext}"
-
-    # 一時ファイルに保存
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-        tmp.write(await file.read())
-        tmp_path = tmp.name
+    data = await file.read()
 
-    try:
-        # GCSにアップロード（設定されている場合）
-        gcs_path = None
-        if GCS_BUCKET_NAME:
-            try:
-                # ファイルポインタをリセット
-                file.file.seek(0)
-                gcs_path = upload_file_to_gcs(file, unique_filename)
-                logger.info(f"GCSアップロード成功: {gcs_path}")
-            except Exception as e:
-                logger.error(f"GCSアップロード失敗: {e}")
-                # GCSアップロードが失敗してもベクトル化は続行
-
-        # ベクトル化処理
-        added_docs = ingest_pdf_to_vectorstore(tmp_path)
-        
-        # 成功レスポンス
+    # 同じ内容の PDF が取り込み済みならジョブも作らずに返す
+    duplicate = await run_in_pool(find_ingested, bytes_sha256(data), tenant)
+    if duplicate is not None:
         return {
+            "job_id": None,
             "filename": file.filename,
-            "gcs_path": gcs_path or "ローカルストレージ",
-            "added_docs": added_docs,
-            "message": "アップロード＆ベクトル化完了！"
+            "status": "skipped",
+            "stage": "skipped",
+            "skipped": True,
+            "duplicate_of": duplicate["source"],
+            "document_id": duplicate["sha256"],
+            "added_docs": 0,
+            "tenant": tenant,
+            "progress": 1.0,
         }
-        
-    except Exception as e:
-        logger.error(f"ベクトル化処理エラー: {e}")
-        raise HTTPException(status_code=500, detail=f"ベクトル化処理失敗: {str(e)}")
-    finally:
-        # 一時ファイルを削除
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
+
+    queue = get_ingest_queue()
+    job = await run_in_pool(queue.submit_bytes, file.filename, data, replace, metadata, tenant)
+
+    # 原本の GCS 保存もリクエストの外で行う
+    gcs_path = None
+    if GCS_BUCKET_NAME:
+        ext = os.path.splitext(file.filename)[1]
+        unique_filename = f"{uuid.uuid4().hex}{ext}"
+        gcs_path = f"gs://{GCS_BUCKET_NAME}/{unique_filename}"
+        get_executor().submit(_archive_original, data, unique_filename)
+
+    body = _job_response(job)
+    body["gcs_path"] = gcs_path or "ローカルストレージ"
+    return body
+
+@router.post("/ingest", status_code=202, summary="PDFファイルのアップロードとベクトル化（ジョブ登録）")
+async def ingest(response: Response, file: UploadFile = File(...), replace: bool = False,
+                 customer: str | None = None, tags: list[str] | None = Query(None), tenant: str | None = None):
+    """
+    PDFファイルを受け付けて取り込みジョブを登録し、すぐに job_id を返す。
+    進捗は /upload/jobs/{job_id} で確認する。
+    replace=true なら同じファイル名の既存チャンクを新しい内容で差し替える。
+    customer / tags（複数可）は全チャンクのメタデータに付き、/chat の filters で絞り込める。
+    tenant を指定するとそのテナントのシャードに取り込む（/chat でも同じ tenant を指定する）。
+    """
+    metadata = {k: v for k, v in {"customer": customer, "tags": tags}.items() if v}
+    body = await _submit_ingest(file, replace, metadata or None, _tenant(tenant))
+    if body["skipped"]:
+        response.status_code = 200
+        body["message"] = f"同じ内容の PDF（{body['duplicate_of']}）が取り込み済みのため、処理は行いませんでした"
+    else:
+        body["message"] = "取り込みジョブを登録しました"
+    return body
+
+@router.get("/jobs/{job_id}", summary="取り込みジョブの進捗")
+async def get_job(job_id: str):
+    job = await run_in_pool(get_ingest_queue().store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりません。")
+    return _job_response(job)
+
+@router.get("/jobs", summary="最近の取り込みジョブ一覧")
+async def list_jobs(limit: int = 20):
+    jobs = await run_in_pool(get_ingest_queue().store.list, min(max(limit, 1), 200))
+    return {"jobs": [_job_response(job) for job in jobs]}
+
+@router.get("/documents", summary="取り込み済みの文書一覧")
+async def list_documents_endpoint(tenant: str | None = None):
+    return {"documents": await run_in_pool(list_documents, _tenant(tenant))}
+
+@router.delete("/documents/{source:path}", summary="文書（出典ファイル名）単位の削除")
+async def delete_document_endpoint(source: str, tenant: str | None = None):
+    """
+    指定したファイル名のチャンクをベクトルストアから削除する（該当セグメントだけを書き換える）
+    """
+    removed = await run_in_pool(delete_document, source, _tenant(tenant))
+    if removed == 0:
+        raise HTTPException(status_code=404, detail=f"{source} は登録されていません。")
+    return {
+        "source": source,
+        "deleted_chunks": removed,
+        "message": "削除しました"
+    }
+
+async def _wait_for_job(job_id: str) -> dict:
+    """ジョブが succeeded / failed になるまで DB を見て待つ
+
+    ジョブは他のワーカーの resume() が取得して実行することもあるので、このプロセスの future ではなく DB の状態で判断する。
+    UPLOAD_PDF_WAIT_SECONDS を過ぎたら 504（ジョブはそのまま続くので /upload/jobs/{job_id} で確認できる）。
+    """
+    queue = get_ingest_queue()
+    deadline = time.monotonic() + UPLOAD_PDF_WAIT_SECONDS
+    while True:
+        job = await run_in_pool(queue.store.get, job_id)
+        if job is not None and job["status"] in ("succeeded", "failed"):
+            return job
+        if time.monotonic() >= deadline:
+            raise HTTPException(status_code=504, detail=f"ベクトル化処理がタイムアウトしました（job_id: {job_id}）")
+        future = queue.future(job_id)
+        if future is not None:
+            # このプロセスで実行中なら終わるまで（最大で次の確認まで）待つ
+            await asyncio.wait([asyncio.wrap_future(future)], timeout=UPLOAD_PDF_POLL_SECONDS)
+        else:
+            await asyncio.sleep(UPLOAD_PDF_POLL_SECONDS)
 
 # ===== 既存フロントエンド互換用エンドポイント =====
 @router.post("/upload_pdf", summary="既存フロントエンド互換")
 async def upload_pdf_compat(file: UploadFile = File(...)):
     """
-    既存フロントエンドとの互換用エンドポイント
+    既存フロントエンドとの互換用エンドポイント（ジョブの完了まで待って結果を返す）
     """
-    return await ingest(file)
\ No newline at end of file
+    body = await _submit_ingest(file)
+    if body["skipped"]:
+        return {
+            "filename": file.filename,
+            "gcs_path": None,
+            "added_docs": 0,
+            "skipped": True,
+            "duplicate_of": body["duplicate_of"],
+            "message": "取り込み済みの PDF です（処理なし）"
+        }
+    job = await _wait_for_job(body["job_id"])
+    if job["status"] != "succeeded":
+        raise HTTPException(status_code=500, detail=f"ベクトル化処理失敗: {job.get('error')}")
+    return {
+        "filename": file.filename,
+        "gcs_path": body["gcs_path"],
+        "added_docs": job["added_docs"],
+        "skipped": bool(job["skipped"]),
+        "duplicate_of": job["duplicate_of"],
+        "job_id": job["id"],
+        "message": "アップロード＆ベクトル化完了！"
+    }
@@ -0,0 +1,131 @@
+# api/startup.py
+"""
+起動処理の依存グラフ。
+
+各ステップは依存するステップが終わった時点で別スレッドで走り始めるので、
+互いに独立な処理（GCS からの取得・埋め込みモデルのロード・LLM クライアントの作成）は並行に進み、
+起動時間は一番長い依存の連なりの分だけになる。各ステップは 1 回だけ実行され、所要時間はログに出す。
+
+ステップの関数は {ステップ名: 結果} を受け取る（失敗した依存の結果は入っていない。どう扱うかは各ステップが決める）。
+各ステップの状態は readiness()（/readyz）で見られる。
+"""
+
+import time
+import logging
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+PENDING, RUNNING, READY, FAILED = "pending", "running", "ready", "failed"
+
+
+class StartupGraph:
+    """名前付きステップと依存関係。run() で依存順に（独立なものは並行に）1 回ずつ実行する"""
+
+    def __init__(self):
+        self._steps: dict = {}
+        self._lock = threading.Lock()
+        self.started_at = None
+        self.finished_at = None
+
+    def step(self, name: str, after: tuple = (), required: bool = True):
+        """ステップを登録するデコレータ
+
+        after: 先に終わっている必要があるステップ（成功・失敗は問わない）
+        required: 失敗すると /readyz を not ready にするか（LLM などは無くても縮退して動く）
+        """
+        def register(fn):
+            self._steps[name] = {
+                "fn": fn, "after": tuple(after), "required": required,
+                "state": PENDING, "seconds": None, "error": None,
+            }
+            return fn
+        return register
+
+    def _check(self):
+        for name, step in self._steps.items():
+            unknown = [dep for dep in step["after"] if dep not in self._steps]
+            if unknown:
+                raise ValueError(f"startup step {name} depends on unknown steps: {unknown}")
+        # 循環があると永遠に始まらないステップが残るので先に調べる
+        done: set = set()
+        remaining = dict(self._steps)
+        while remaining:
+            runnable = [name for name, step in remaining.items() if set(step["after"]) <= done]
+            if not runnable:
+                raise ValueError(f"startup steps have a dependency cycle: {sorted(remaining)}")
+            for name in runnable:
+                done.add(name)
+                del remaining[name]
+
+    def _run_step(self, name: str, results: dict):
+        step = self._steps[name]
+        with self._lock:
+            step["state"] = RUNNING
+        started = time.perf_counter()
+        try:
+            value = step["fn"](results)
+        except Exception as e:
+            seconds = time.perf_counter() - started
+            with self._lock:
+                step.update(state=FAILED, seconds=round(seconds, 3), error=str(e))
+            logger.error(f"❌ Startup step {name} failed after {seconds:.2f}s: {e}")
+            raise
+        seconds = time.perf_counter() - started
+        with self._lock:
+            step.update(state=READY, seconds=round(seconds, 3))
+        logger.info(f"✅ Startup step {name}: {seconds:.2f}s")
+        return value
+
+    def run(self) -> dict:
+        """全ステップを実行し、成功したステップの {名前: 結果} を返す"""
+        global _current
+        self._check()
+        _current = self
+        self.started_at = time.time()
+        wall_start = time.perf_counter()
+        results: dict = {}
+        finished: set = set()
+        running: dict = {}
+        with ThreadPoolExecutor(max_workers=max(1, len(self._steps)), thread_name_prefix="startup") as pool:
+            while len(finished) < len(self._steps):
+                for name, step in self._steps.items():
+                    if name in finished or name in running.values() or not set(step["after"]) <= finished:
+                        continue
+                    running[pool.submit(self._run_step, name, dict(results))] = name
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    finished.add(name)
+                    if future.exception() is None:
+                        results[name] = future.result()
+
+        self.finished_at = time.time()
+        wall = time.perf_counter() - wall_start
+        serial = sum(step["seconds"] or 0 for step in self._steps.values())
+        logger.info(f"=== Startup graph finished in {wall:.2f}s (steps total {serial:.2f}s) ===")
+        return results
+
+    def status(self) -> dict:
+        with self._lock:
+            components = {
+                name: {key: step[key] for key in ("state", "required", "seconds", "error")}
+                for name, step in self._steps.items()
+            }
+        return {
+            "ready": all(c["state"] == READY for c in components.values() if c["required"]),
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "components": components,
+        }
+
+
+_current: StartupGraph | None = None
+
+
+def readiness() -> dict:
+    """直近に実行した（実行中の）起動グラフの状態。起動前は not ready"""
+    if _current is None:
+        return {"ready": False, "started_at": None, "finished_at": None, "components": {}}
+    return _current.status()
@@ -1,10 +1,5 @@
-import os
-from rag.ingested_text import ingest_pdf_to_vectorstore
+# rag/data の PDF を一括でベクトルストアに取り込む（実体は rag/bulk_ingest.py）
+from rag.bulk_ingest import main
 
-pdf_dir = "rag/data"
-
-for filename in os.listdir(pdf_dir):
-    if filename.endswith(".pdf"):
-        filepath = os.path.join(pdf_dir, filename)
-        print(f"📄 処理中: {filepath}")
-        ingest_pdf_to_vectorstore(filepath)
+if __name__ == "__main__":
+    main(default_pdf_dir="rag/data")
@@ -3,6 +3,7 @@
 from __future__ import annotations
 import os
 import logging
+import threading
 from typing import Any, Tuple
 
 # ── 先頭で必ず proxies 関連の環境変数を消す ─────────────────────────────────────────────
@@ -15,10 +16,29 @@ logger = logging.getLogger(__name__)
 # langchain-openaiを使用（より安定）
 from langchain_openai import ChatOpenAI
 
+# 起動時に "Hello" を 1 回送って接続を確かめるか（OpenAI への往復 1 回分、起動が遅くなる）
+LLM_STARTUP_CHECK = os.environ.get("LLM_STARTUP_CHECK", "false").lower() == "true"
 
-def load_llm() -> Tuple[Any, None, int]:
+_loaded: Tuple[Any, None, int] | None = None
+_load_lock = threading.Lock()
+
+
+def get_llm() -> Tuple[Any, None, int]:
+    """プロセスで共有する load_llm() の結果（起動処理と RAG チェーンで同じクライアントを使う）"""
+    global _loaded
+    if _loaded is None:
+        with _load_lock:
+            if _loaded is None:
+                _loaded = load_llm()
+    return _loaded
+
+
+def load_llm(check: bool = LLM_STARTUP_CHECK) -> Tuple[Any, None, int]:
     """
     langchain-openai の ChatOpenAI クラスを使って OpenAI の ChatCompletion を呼び出す。
+    通常は get_llm() を使う（呼ぶたびにクライアントを作り直さないように）。
+
+    check: True なら "Hello" を送って接続を確かめる（既定は LLM_STARTUP_CHECK）
     
     戻り値: (llm, tokenizer, max_new_tokens)
       - llm: ChatOpenAI のインスタンス
@@ -48,9 +68,10 @@ def load_llm() -> Tuple[Any, None, int]:
         )
         
         # テスト呼び出し
-        logger.info(f"Testing LLM connection...")
-        test_response = llm.invoke("Hello")
-        logger.info(f"LLM test successful")
+        if check:
+            logger.info(f"Testing LLM connection...")
+            test_response = llm.invoke("Hello")
+            logger.info(f"LLM test successful")
         
     except Exception as e:
         logger.error(f"Failed to initialize ChatOpenAI: {e}")
@@ -94,49 +94,63 @@ llm_instance = None
 
 @app.on_event("startup")
 async def load_models_on_startup():
-    global vectorstore, rag_chain_template, llm_instance
-   
+    """起動処理を依存グラフとして実行する（api/startup.py）
+
+    gcs_download ─┐
+    embedding ────┴→ vectorstore ─┬→ rag_chain
+    llm ──────────────────────────┘   ingest_jobs / index_watcher（vectorstore の後）
+    reranker（RERANK_SCORER=cross_encoder ならモデルをロード）
+    """
     logger.info("=== startup: begin loading models ===")
    
-    # 1) LLM を確実にロード
-    try:
-        from llm.llm_runner import load_llm
-        llm, tokenizer, max_tokens = load_llm()
-        llm_instance = llm
-        logger.info(f"✅ LLM loaded successfully: {type(llm).__name__}")
-       
-        # LLMのテスト
-        try:
-            if hasattr(llm, "invoke"):
-                test_result = llm.invoke("Hello")
-                logger.info(f"✅ LLM test successful")
-            else:
-                # ChatOpenAIの場合
-                test_result = llm("Hello")
-                logger.info(f"✅ LLM test successful")
-        except Exception as e:
-            logger.warning(f"LLM test warning: {e}")
-           
-    except Exception as e:
-        logger.error(f"❌ LLM load failed: {e}")
-        logger.error(traceback.format_exc())
-        # LLMなしでも続行
-        llm_instance = None
+    # CPU 処理（埋め込み・FAISS）用の上限付きスレッドプールを既定 executor にする
+    from api.concurrency import install_default_executor
+    install_default_executor()
    
-    # 2) ベクトルストアを確実にロード
-    try:
-        from rag.ingested_text import load_vectorstore
-        vectorstore = load_vectorstore()
-        logger.info("✅ Vectorstore loaded successfully")
-    except Exception as e:
-        logger.warning(f"⚠️ Vectorstore load failed, creating empty one: {e}")
-        # 空のベクトルストアを作成
+    # import は並行に走らせない（同じモジュールを複数スレッドから初めて import しないように）
+    from api.startup import StartupGraph
+    from llm.llm_runner import get_llm
+    from rag.embeddings import warmup_embedding
+    from rag import ingested_text
+    from rag.ingest_jobs import get_ingest_queue
+    from rag.hot_reload import get_index_watcher
+    from rag.rerank import warmup_scorer
+   
+    graph = StartupGraph()
+   
+    @graph.step("gcs_download", required=False)
+    def gcs_download(results):
+        return ingested_text.download_vectorstore_from_gcs(ingested_text.LOCAL_VECTOR_DIR)
+   
+    @graph.step("embedding")
+    def embedding(results):
+        # 埋め込みモデルを先にロード（以降はプロセス内で共有される）
+        return warmup_embedding()
+   
+    @graph.step("llm", required=False)
+    def llm(results):
+        # LLM クライアントはここで 1 回だけ作り、RAG チェーンにも同じものを渡す（LLMなしでも続行）
+        global llm_instance
+        llm_instance = get_llm()[0]
+        logger.info(f"✅ LLM loaded successfully: {type(llm_instance).__name__}")
+        return llm_instance
+   
+    @graph.step("reranker")
+    def reranker(results):
+        # クロスエンコーダは最初の質問（rerank の時間予算の中）ではなくここで読み込む
+        return warmup_scorer()
+   
+    @graph.step("vectorstore", after=("gcs_download", "embedding"))
+    def load_store(results):
+        global vectorstore
         try:
-            from rag.ingested_text import MyEmbedding
-            from langchain_community.vectorstores import FAISS
+            vectorstore = ingested_text.load_vectorstore(download=False)
+            logger.info("✅ Vectorstore loaded successfully")
+        except Exception as e:
+            logger.warning(f"⚠️ Vectorstore load failed, creating empty one: {e}")
+            # 空のベクトルストアを作成
             from langchain.schema import Document
            
-            embeddings = MyEmbedding("intfloat/multilingual-e5-small")
             dummy_docs = [
                 Document(
                     page_content="システムは正常に動作しています。PDFをアップロードしてRAG検索を開始してください。",
@@ -147,60 +161,48 @@ async def load_models_on_startup():
                     metadata={"source": "システム初期化", "page": 2}
                 )
             ]
-            vectorstore = FAISS.from_documents(dummy_docs, embeddings)
-           
-            # ローカルに保存
-            os.makedirs("rag/vectorstore", exist_ok=True)
-            vectorstore.save_local("rag/vectorstore", index_name="index")
+            # セグメントとしてローカルに保存
+            store = ingested_text.get_vectorstore()
+            store.add_documents(dummy_docs)
+            from rag.index_version import bump_version
+            bump_version()
+            vectorstore = store
             logger.info("✅ Empty vectorstore created and saved")
-           
-        except Exception as e2:
-            logger.error(f"❌ Failed to create empty vectorstore: {e2}")
-            vectorstore = None
+        return vectorstore
    
-    # 3) RAG チェーンを構築
-    if vectorstore:
-        try:
-            if llm_instance:
-                # LLMがある場合は通常のRAGチェーンを構築
-                from rag.ingested_text import get_rag_chain
-                rag_chain_template = get_rag_chain(vectorstore=vectorstore, return_source=True)
-                logger.info("✅ RAG chain created successfully with LLM")
-            else:
-                # LLMがない場合はシンプルな検索のみのチェーンを作成
-                logger.info("⚠️ Creating search-only chain without LLM")
-                from langchain.chains import RetrievalQA
-                from langchain.schema import BaseRetriever
-               
-                # ダミーのチェーンオブジェクトを作成
-                class SimpleSearchChain:
-                    def __init__(self, vectorstore):
-                        self.vectorstore = vectorstore
-                        self.retriever = vectorstore.as_retriever()
-                   
-                    def invoke(self, inputs):
-                        query = inputs.get("query", "")
-                        docs = self.retriever.get_relevant_documents(query)
-                        if docs:
-                            result = f"関連文書が見つかりました:\n\n"
-                            for i, doc in enumerate(docs[:3], 1):
-                                result += f"{i}. {doc.page_content[:200]}...\n"
-                                result += f"   出典: {doc.metadata.get('source', '不明')} (p{doc.metadata.get('page', '?')})\n\n"
-                        else:
-                            result = "関連する文書が見つかりませんでした。"
-                       
-                        return {
-                            "result": result,
-                            "source_documents": docs[:3]
-                        }
-               
-                rag_chain_template = SimpleSearchChain(vectorstore)
-                logger.info("✅ Search-only chain created")
-               
-        except Exception as e:
-            logger.error(f"❌ RAG chain creation failed: {e}")
-            logger.error(traceback.format_exc())
-            rag_chain_template = None
+    @graph.step("rag_chain", after=("vectorstore", "llm"))
+    def rag_chain(results):
+        global rag_chain_template
+        if "vectorstore" not in results:
+            raise RuntimeError("vectorstore is not loaded")
+        if "llm" in results:
+            # LLMがある場合は通常のRAGチェーンを構築
+            rag_chain_template = ingested_text.get_rag_chain(
+                vectorstore=results["vectorstore"], return_source=True, llm=results["llm"]
+            )
+            logger.info("✅ RAG chain created successfully with LLM")
+        else:
+            # LLMがない場合はシンプルな検索のみのチェーンを作成
+            logger.info("⚠️ Creating search-only chain without LLM")
+            rag_chain_template = ingested_text.SimpleSearchChain(results["vectorstore"])
+            logger.info("✅ Search-only chain created")
+        return rag_chain_template
+   
+    @graph.step("ingest_jobs", after=("vectorstore",), required=False)
+    def ingest_jobs(results):
+        # 前回終わらなかった取り込みジョブを再開
+        get_ingest_queue().resume()
+   
+    @graph.step("index_watcher", after=("vectorstore",), required=False)
+    def index_watcher(results):
+        # 他インスタンスが公開した新しい版を裏で読み込む（再起動不要）
+        if "vectorstore" not in results:
+            raise RuntimeError("vectorstore is not loaded")
+        get_index_watcher().start()
+   
+    # グラフの待ち合わせはイベントループの外で
+    import asyncio
+    await asyncio.get_running_loop().run_in_executor(None, graph.run)
    
     # ステータスログ
     logger.info(f"=== Startup complete ===")
@@ -209,6 +211,25 @@ async def load_models_on_startup():
     logger.info(f"  - RAG Chain: {'✅ Created' if rag_chain_template else '❌ Not created'}")
 
 
+@app.on_event("shutdown")
+def flush_pending_uploads():
+    """予約中の GCS アップロードを終了前に送っておく"""
+    from rag.hot_reload import get_index_watcher
+    get_index_watcher().stop()
+    from rag.gcs_sync import get_gcs_sync
+    sync = get_gcs_sync("rag/vectorstore")
+    if sync is not None:
+        sync.flush()
+    # テナントのシャードも
+    from rag.tenant_shards import get_tenant_shards
+    shards = get_tenant_shards()
+    shards.stop()
+    for tenant in shards.tenants():
+        tenant_sync = shards.sync(tenant)
+        if tenant_sync is not None:
+            tenant_sync.flush()
+
+
 # ルーターをインポート
 from api.routers import upload, chat, google_oauth, healthz
 
@@ -245,10 +266,80 @@ def get_status():
         "vectorstore_loaded": vectorstore is not None,
         "rag_chain_loaded": rag_chain_template is not None,
         "openai_api_key_set": bool(os.environ.get("OPENAI_API_KEY")),
-        "gcs_bucket": os.environ.get("GCS_BUCKET_NAME", "Not set")
+        "gcs_bucket": os.environ.get("GCS_BUCKET_NAME", "Not set"),
+        "embedding": _safe_stats(_embedding_stats),
+        "semantic_cache": _safe_stats(_semantic_cache_stats),
+        "answer_cache": _safe_stats(_answer_cache_stats),
+        "rerank": _safe_stats(_rerank_stats),
+        "vectorstore_stats": _safe_stats(_vectorstore_stats),
+        "tenants": _safe_stats(_tenant_stats),
+        "hot_reload": _safe_stats(_hot_reload_stats),
+        "startup": _safe_stats(_startup_stats),
+        "gcs_sync": _safe_stats(_gcs_sync_stats),
+        "ingest_jobs": _safe_stats(_ingest_job_stats)
     }
 
 
+def _safe_stats(loader):
+    try:
+        return loader()
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def _vectorstore_stats():
+    stats = getattr(vectorstore, "stats", None)
+    return stats() if stats else {}
+
+
+def _tenant_stats():
+    from rag.tenant_shards import get_tenant_shards
+    return get_tenant_shards().stats()
+
+
+def _startup_stats():
+    from api.startup import readiness
+    return readiness()
+
+
+def _hot_reload_stats():
+    from rag.hot_reload import get_index_watcher
+    return get_index_watcher().stats()
+
+
+def _gcs_sync_stats():
+    from rag.gcs_sync import get_gcs_sync
+    sync = get_gcs_sync("rag/vectorstore")
+    return sync.stats() if sync else {"enabled": False}
+
+
+def _ingest_job_stats():
+    from rag.ingest_jobs import get_ingest_queue
+    return get_ingest_queue().stats()
+
+
+def _embedding_stats():
+    from rag.embeddings import embedding_stats
+    return embedding_stats()
+
+
+def _semantic_cache_stats():
+    from rag.semantic_cache import get_semantic_cache
+    cache = get_semantic_cache()
+    return cache.stats() if cache else {"enabled": False}
+
+
+def _rerank_stats():
+    from rag.rerank import rerank_stats
+    return rerank_stats()
+
+
+def _answer_cache_stats():
+    from rag.answer_cache import get_answer_cache
+    cache = get_answer_cache()
+    return cache.stats() if cache else {"enabled": False}
+
+
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8080))
@@ -1,6 +1,7 @@
 import streamlit as st
 import os
 import uuid
+import time
 import traceback
 import requests
 from google.cloud import storage
@@ -28,6 +29,21 @@ GCS_BUCKET_NAME = os.environ.get(
 
 os.makedirs("uploads", exist_ok=True)
 
+# 取り込みジョブの進捗を確認する間隔（秒）
+JOB_POLL_INTERVAL = 1.0
+# これだけ待っても終わらなければポーリングをやめる（ジョブはバックエンドで続く）
+JOB_POLL_TIMEOUT = 600
+STAGE_LABELS = {
+    "queued": "順番待ち",
+    "parsing": "PDF を解析中",
+    "chunking": "チャンク分割中",
+    "embedding": "ベクトル化中",
+    "saving": "保存中",
+    "skipped": "取り込み済み（スキップ）",
+    "done": "完了",
+    "failed": "失敗",
+}
+
 def save_upload_to_local(uploaded_file, save_dir="uploads"):
     unique_filename = f"{uuid.uuid4().hex}.pdf"
     save_path = os.path.join(save_dir, unique_filename)
@@ -51,6 +67,10 @@ if "unique_filename" not in st.session_state:
     st.session_state.unique_filename = ""
 if "blob_name" not in st.session_state:
     st.session_state.blob_name = ""
+if "job_id" not in st.session_state:
+    st.session_state.job_id = ""
+if "document_id" not in st.session_state:
+    st.session_state.document_id = ""
 
 # === 1. アップロードフェーズ (/init) ===
 if st.session_state.upload_status == "init":
@@ -60,6 +80,7 @@ if st.session_state.upload_status == "init":
             local_path, unique_filename = save_upload_to_local(uploaded_file)
             st.session_state.local_path = local_path
             st.session_state.unique_filename = unique_filename
+            st.session_state.original_filename = uploaded_file.name
             st.success(f"✅ ローカル保存成功: {local_path}")
 
             blob_name = f"uploads/{unique_filename}"
@@ -83,32 +104,88 @@ elif st.session_state.upload_status == "uploaded":
     st.info("※ベクトルストアへの取り込みには数秒～数十秒かかる場合があります")
 
 # === 3. 取り込み中フェーズ (/ingesting) ===
+elif st.session_state.upload_status == "ingesting" and st.session_state.get("job_timed_out"):
+    st.warning(f"⚠️ {JOB_POLL_TIMEOUT // 60} 分待っても取り込みが終わりませんでした"
+               f"（ジョブ ID: {st.session_state.job_id}、状態: {st.session_state.job_timed_out}）")
+    col1, col2 = st.columns(2)
+    if col1.button("もう一度確認する"):
+        st.session_state.job_timed_out = ""
+        st.rerun()
+    if col2.button("取り込みをやり直す"):
+        st.session_state.job_timed_out = ""
+        st.session_state.upload_status = "uploaded"
+        st.session_state.job_id = ""
+        st.rerun()
+
 elif st.session_state.upload_status == "ingesting":
     try:
-        with st.spinner("ベクトルストアに取り込み中...⏳"):
-            # ←=== ここが今回の修正ポイント！ ===→
-            # ルーターprefixが「/upload」なので
+        # ルーターprefixが「/upload」なので
+        if not st.session_state.job_id:
             ingest_endpoint = f"{API_URL}/upload/ingest"
-            # ingest_endpoint = f"{API_URL}/upload/upload_pdf" でもOK
-            files = {'file': open(st.session_state.local_path, 'rb')}
-            response = requests.post(ingest_endpoint, files=files, timeout=600)
-            if response.status_code != 200:
+            with open(st.session_state.local_path, "rb") as f:
+                # 出典として元のファイル名が記録されるようにする
+                filename = st.session_state.get("original_filename") or st.session_state.unique_filename
+                files = {"file": (filename, f, "application/pdf")}
+                response = requests.post(ingest_endpoint, files=files, timeout=60)
+            if response.status_code not in (200, 202):
                 raise RuntimeError(f"バックエンド取り込みエラー: {response.status_code} / {response.text}")
+            body = response.json()
+            if body.get("skipped"):
+                # 同じ内容の PDF が取り込み済み（ジョブは作られない）
+                st.info(f"ℹ️ 同じ内容の PDF（{body.get('duplicate_of')}）は取り込み済みです")
+                st.session_state.document_id = body.get("document_id") or ""
+                st.session_state.upload_status = "done"
+                st.rerun()
+            st.session_state.job_id = body["job_id"]
+
+        # 取り込みはバックエンドのジョブで進むので、進捗をポーリングする
+        job_url = f"{API_URL}/upload/jobs/{st.session_state.job_id}"
+        status_text = st.empty()
+        progress_bar = st.progress(0.0)
+        deadline = time.monotonic() + JOB_POLL_TIMEOUT
+        job = None
+        while time.monotonic() < deadline:
+            r = requests.get(job_url, timeout=10)
+            if r.status_code != 200:
+                raise RuntimeError(f"ジョブ状態の取得に失敗: {r.status_code} / {r.text}")
+            job = r.json()
+            progress_bar.progress(min(float(job.get("progress") or 0.0), 1.0))
+            status_text.info(
+                f"⏳ {STAGE_LABELS.get(job['stage'], job['stage'])}"
+                f"（ページ {job.get('pages_parsed') or 0} / "
+                f"チャンク {job.get('chunks_embedded') or 0}/{job.get('chunks_total') or 0}）"
+            )
+            if job["status"] == "succeeded":
+                break
+            if job["status"] == "failed":
+                raise RuntimeError(f"取り込みジョブ失敗: {job.get('error')}")
+            time.sleep(JOB_POLL_INTERVAL)
+        else:
+            # queued / running のまま進まない（持ち主のプロセスが落ちて、次の起動まで再開されないなど）
+            st.session_state.job_timed_out = job["status"] if job else "不明"
+            st.rerun()
 
-        st.success("✅ ベクトルストア取り込み完了！")
+        if job.get("skipped"):
+            st.info(f"ℹ️ 同じ内容の PDF（{job.get('duplicate_of')}）は取り込み済みです")
+        else:
+            st.success(f"✅ ベクトルストア取り込み完了！（{job.get('added_docs')} チャンク）")
+        st.session_state.document_id = job.get("document_id") or ""
         st.session_state.upload_status = "done"
+        st.session_state.job_id = ""
         st.rerun()
 
     except Exception as e:
         st.error("❌ ベクトル化に失敗しました")
         st.code(traceback.format_exc())
         st.session_state.upload_status = "uploaded"
+        st.session_state.job_id = ""
 
 # === 4. チャットフェーズ (/done) ===
 elif st.session_state.upload_status == "done":
     st.success("取り込み完了！このPDFの内容で質問できます")
     if st.button("最初からやり直す"):
-        for key in ["upload_status", "local_path", "unique_filename", "blob_name"]:
+        for key in ["upload_status", "local_path", "unique_filename", "blob_name", "job_id", "original_filename",
+                    "document_id", "job_timed_out"]:
             st.session_state.pop(key, None)
         st.rerun()
 
@@ -119,6 +196,9 @@ elif st.session_state.upload_status == "done":
         try:
             with st.spinner("バックエンドへ質問を送信中...⏳"):
                 payload = {"question": question, "username": st.session_state["user"]}
+                # アップロードした PDF だけを検索する（取り込み ID が分からなければ全体を検索）
+                if st.session_state.document_id:
+                    payload["document_ids"] = [st.session_state.document_id]
                 chat_url = f"{API_URL}/chat/"
                 print("=== API に POST する URL:", chat_url)
                 st.write(f"API に POST する URL: {chat_url}")
@@ -0,0 +1,246 @@
+"""
+セグメントごとの FAISS インデックス種別（Flat / IVF-Flat / HNSW）の選択と構築。
+
+種別とパラメータは manifest.json のセグメントエントリ（"index"）に記録し、
+読み込み時はそれに従って nprobe / efSearch を設定し直す。
+ANN_INDEX_TYPE=auto（既定）ではセグメントのベクトル数と目標レイテンシから種別を決める:
+
+    全件走査の見積もりが目標内 → Flat（厳密）
+    それを超え HNSW_MAX_VECTORS 以下 → HNSW（メモリは多いが高再現率）
+    さらに大きい → IVF-Flat（学習が必要。nprobe は目標レイテンシに収まる範囲で最大）
+
+ベクトルの保存形式（codec）も選べる（ANN_CODEC）:
+
+    flat   float32 のまま（4 × dim バイト/ベクトル）
+    fp16   半精度（2 × dim バイト）
+    sq8    8bit スカラー量子化（dim バイト）
+    pq     直積量子化（PQ_M バイト。学習が必要）
+
+ANN_REFINE_K_FACTOR > 0 なら圧縮コードで k × factor 件に絞り、float32 のベクトルで並べ直す
+（RFlat。再現率は戻るが float32 も持つのでメモリは減らない）。
+圧縮コードから復元したベクトルは近似値なので、削除・マージで書き換えたセグメントは少し誤差が増える。
+
+spec の形: {"type": "flat" | "ivf" | "hnsw", "codec": "flat" | "fp16" | "sq8" | "pq",
+            "refine": k_factor（0 なら並べ直しなし）, "params": {...}}
+
+読み込みは可能なら読み取り専用の mmap で行う（read_index）。
+IVF は転置リストをファイルから直接マップするので、起動時に本体を読まず、
+同じホストの複数ワーカーがページキャッシュを共有する。
+Flat / HNSW のコード領域をマップできるのは IO_FLAG_MMAP_IFC のある faiss だけで、
+それ以前の版ではこれまでどおりメモリに読み込む。
+"""
+
+import os
+import math
+import logging
+
+import faiss
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+INDEX_TYPES = ("flat", "ivf", "hnsw")
+CODECS = ("flat", "fp16", "sq8", "pq")
+
+ANN_INDEX_TYPE = os.environ.get("ANN_INDEX_TYPE", "auto").lower()
+# 1 クエリ・1 セグメントあたりの目標検索時間
+ANN_TARGET_LATENCY_MS = float(os.environ.get("ANN_TARGET_LATENCY_MS", "5"))
+# 全件走査の速さの目安（1 ms に処理できる「ベクトル数 × 次元」）
+FLAT_SCAN_PER_MS = float(os.environ.get("FLAT_SCAN_PER_MS", "2000000"))
+HNSW_MAX_VECTORS = int(os.environ.get("HNSW_MAX_VECTORS", "2000000"))
+
+HNSW_M = int(os.environ.get("HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.environ.get("HNSW_EF_CONSTRUCTION", "80"))
+ANN_EF_SEARCH = int(os.environ.get("ANN_EF_SEARCH", "0"))  # 0 なら manifest の値（新規は 64）
+HNSW_EF_SEARCH_DEFAULT = 64
+IVF_NLIST = int(os.environ.get("IVF_NLIST", "0"))  # 0 なら 4√n
+ANN_NPROBE = int(os.environ.get("ANN_NPROBE", "0"))  # 0 なら目標レイテンシから決める
+# k-means の学習にクラスタあたり最低これだけの点を使う
+IVF_MIN_POINTS_PER_LIST = 39
+
+ANN_CODEC = os.environ.get("ANN_CODEC", "flat").lower()
+PQ_M = int(os.environ.get("PQ_M", "0"))  # 0 なら dim / 8（サブベクトル数 = 1 ベクトルのバイト数）
+# PQ のコードブック（256 セントロイド）の学習に最低限ほしい点の数。これ未満は sq8 にする
+PQ_MIN_TRAIN_POINTS = int(os.environ.get("PQ_MIN_TRAIN_POINTS", "1024"))
+ANN_REFINE_K_FACTOR = float(os.environ.get("ANN_REFINE_K_FACTOR", "0"))
+
+FLAT_SPEC = {"type": "flat", "codec": "flat", "refine": 0, "params": {}}
+
+# faiss 1.10 以降にある、Flat 系のコード配列もマップするフラグ
+_IO_FLAG_MMAP_IFC = getattr(faiss, "IO_FLAG_MMAP_IFC", None)
+
+
+def estimate_flat_ms(n: int, dim: int) -> float:
+    return n * dim / FLAT_SCAN_PER_MS
+
+
+def _ivf_spec(n: int, dim: int, target_ms: float) -> dict:
+    nlist = IVF_NLIST or int(4 * math.sqrt(n))
+    nlist = max(1, min(nlist, n // IVF_MIN_POINTS_PER_LIST))
+    nprobe = ANN_NPROBE or int(target_ms / max(estimate_flat_ms(n, dim), 1e-9) * nlist)
+    return {"type": "ivf", "params": {"nlist": nlist, "nprobe": max(1, min(nprobe, nlist))}}
+
+
+def _hnsw_spec() -> dict:
+    return {"type": "hnsw", "params": {"M": HNSW_M, "efConstruction": HNSW_EF_CONSTRUCTION,
+                                       "efSearch": ANN_EF_SEARCH or HNSW_EF_SEARCH_DEFAULT}}
+
+
+def pq_subquantizers(dim: int) -> int:
+    """dim を割り切る PQ のサブベクトル数（PQ_M 以下で最大）"""
+    m = max(1, min(PQ_M or dim // 8, dim))
+    while dim % m:
+        m -= 1
+    return m
+
+
+def choose_codec(n: int, dim: int, codec: str | None = None) -> dict:
+    codec = (codec or ANN_CODEC).lower()
+    if codec not in CODECS:
+        raise ValueError(f"unknown ANN_CODEC: {codec}")
+    if codec == "pq":
+        if n < PQ_MIN_TRAIN_POINTS:
+            codec = "sq8"
+        else:
+            return {"codec": "pq", "pq_m": pq_subquantizers(dim)}
+    return {"codec": codec}
+
+
+def choose_index_spec(n: int, dim: int, index_type: str | None = None,
+                      target_ms: float | None = None, codec: str | None = None,
+                      refine: float | None = None) -> dict:
+    """ベクトル数・次元・目標レイテンシからインデックス種別・保存形式・パラメータを決める"""
+    spec = _choose_structure(n, dim, index_type, target_ms)
+    storage = choose_codec(n, dim, codec)
+    spec["codec"] = storage.pop("codec")
+    spec["params"].update(storage)
+    refine = ANN_REFINE_K_FACTOR if refine is None else refine
+    spec["refine"] = refine if spec["codec"] != "flat" else 0
+    return spec
+
+
+def _choose_structure(n: int, dim: int, index_type: str | None, target_ms: float | None) -> dict:
+    index_type = (index_type or ANN_INDEX_TYPE).lower()
+    target_ms = ANN_TARGET_LATENCY_MS if target_ms is None else target_ms
+
+    if index_type == "auto":
+        if estimate_flat_ms(n, dim) <= target_ms:
+            index_type = "flat"
+        elif n <= HNSW_MAX_VECTORS:
+            index_type = "hnsw"
+        else:
+            index_type = "ivf"
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"unknown ANN_INDEX_TYPE: {index_type}")
+
+    if index_type == "ivf":
+        if n < IVF_MIN_POINTS_PER_LIST * 2:
+            # 学習できるほど点がない小さなセグメントは全件走査で十分
+            return {"type": "flat", "params": {}}
+        return _ivf_spec(n, dim, target_ms)
+    if index_type == "hnsw":
+        return _hnsw_spec()
+    return {"type": "flat", "params": {}}
+
+
+def _codec_string(spec: dict) -> str:
+    codec = spec.get("codec", "flat")
+    if codec == "fp16":
+        return "SQfp16"
+    if codec == "sq8":
+        return "SQ8"
+    if codec == "pq":
+        return f"PQ{spec['params']['pq_m']}"
+    return "Flat"
+
+
+def factory_string(spec: dict) -> str:
+    """spec に対応する faiss.index_factory の記述（IDMap2 で包む前の部分）"""
+    params = spec.get("params") or {}
+    codec = _codec_string(spec)
+    if spec["type"] == "ivf":
+        description = f"IVF{params['nlist']},{codec}"
+    elif spec["type"] == "hnsw":
+        description = f"HNSW{params['M']},{codec}"
+    else:
+        description = codec
+    if spec.get("refine"):
+        description += ",RFlat"
+    return description
+
+
+def build_index(vectors: np.ndarray, ids: np.ndarray, spec: dict):
+    """spec に従って IndexIDMap2 で包んだインデックスを作り、学習・追加まで行う"""
+    inner = faiss.index_factory(int(vectors.shape[1]), factory_string(spec))
+    if spec["type"] == "hnsw":
+        _base_index(inner).hnsw.efConstruction = spec["params"]["efConstruction"]
+    if not inner.is_trained:
+        inner.train(vectors)
+    index = faiss.IndexIDMap2(inner)
+    index.add_with_ids(vectors, ids)
+    apply_search_params(index, spec)
+    return index
+
+
+def apply_search_params(index, spec: dict | None, nprobe: int | None = None, ef_search: int | None = None):
+    """読み込んだインデックスに nprobe / efSearch を設定する（引数・環境変数が manifest の値より優先）"""
+    spec = spec or FLAT_SPEC
+    params = spec.get("params") or {}
+    inner = faiss.downcast_index(index.index) if hasattr(index, "id_map") else index
+    if spec.get("refine"):
+        inner.k_factor = float(spec["refine"])
+    inner = _base_index(inner)
+    if spec["type"] == "ivf":
+        inner.nprobe = nprobe or ANN_NPROBE or params.get("nprobe", 1)
+    elif spec["type"] == "hnsw":
+        inner.hnsw.efSearch = ef_search or ANN_EF_SEARCH or params.get("efSearch", HNSW_EF_SEARCH_DEFAULT)
+
+
+def _base_index(index):
+    """RFlat で包んでいれば中の近似インデックスを返す"""
+    if isinstance(index, faiss.IndexRefine):
+        return faiss.downcast_index(index.base_index)
+    return index
+
+
+def mmap_supported(spec: dict | None) -> bool:
+    """この faiss でインデックス本体をマップできるか"""
+    spec = spec or FLAT_SPEC
+    # RFlat で包んだものも中の IVF はマップされる（float32 側は通常の読み込み）
+    return spec["type"] == "ivf" or _IO_FLAG_MMAP_IFC is not None
+
+
+def read_index(path: str, spec: dict | None, mmap: bool = True) -> tuple:
+    """インデックスを読み込み、(index, マップしたか) を返す"""
+    if mmap and mmap_supported(spec):
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+        if _IO_FLAG_MMAP_IFC is not None:
+            flags |= _IO_FLAG_MMAP_IFC
+        index, mapped = faiss.read_index(path, flags), True
+    else:
+        index, mapped = faiss.read_index(path), False
+    apply_search_params(index, spec)
+    return index, mapped
+
+
+def supports_selector(spec: dict | None) -> bool:
+    """SearchParameters(sel=...) で絞り込み検索できるか（PQ の全件走査と RFlat は非対応）"""
+    spec = spec or FLAT_SPEC
+    if spec.get("refine"):
+        return False
+    return not (spec["type"] == "flat" and spec.get("codec") == "pq")
+
+
+def selector_params(index, spec: dict | None, selector, exhaustive: bool = False):
+    """IDMap2 の中のインデックスに渡す、IDSelector 付きの検索パラメータ
+
+    exhaustive=True なら IVF は全リストを見る（絞り込みで k 件に届かなかったときの再検索用）
+    """
+    spec = spec or FLAT_SPEC
+    inner = faiss.downcast_index(index.index)
+    if spec["type"] == "ivf":
+        nprobe = inner.nlist if exhaustive else inner.nprobe
+        return faiss.SearchParametersIVF(sel=selector, nprobe=nprobe)
+    if spec["type"] == "hnsw":
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=inner.hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
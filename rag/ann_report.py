@@ -0,0 +1,132 @@
+"""
+インデックスの保存形式（flat / fp16 / sq8 / pq、並べ直しの有無）ごとの
+1 ベクトルあたりのメモリ・recall@k・検索時間を、全件走査（IndexFlatL2）の結果と比べるレポート。
+
+既定では rag/vectorstore に取り込み済みのベクトル（rag/data の PDF）を使う。
+--pdf_dir を指定するとその PDF を解析・埋め込みして使う（ストアには書き込まない）。
+
+python -m rag.ann_report [--pdf_dir rag/data] [--queries 200] [--k 5] [--index_type flat]
+"""
+
+import time
+import logging
+import argparse
+
+import faiss
+import numpy as np
+
+from rag.ann_index import build_index, choose_index_spec
+
+logger = logging.getLogger(__name__)
+
+# 比べる設定（codec, 並べ直しの k_factor）
+DEFAULT_CONFIGS = [
+    ("flat", 0),
+    ("fp16", 0),
+    ("sq8", 0),
+    ("sq8", 4),
+    ("pq", 0),
+    ("pq", 4),
+]
+
+
+def evaluate(vectors: np.ndarray, queries: np.ndarray, k: int = 5, index_type: str = "flat",
+             configs=DEFAULT_CONFIGS) -> list[dict]:
+    """各設定でインデックスを作り、全件走査の top-k に対する recall@k などを返す"""
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    queries = np.ascontiguousarray(queries, dtype="float32")
+    n, dim = vectors.shape
+    ids = np.arange(n, dtype="int64")
+    k = min(k, n)
+
+    exact = faiss.IndexFlatL2(dim)
+    exact.add(vectors)
+    _, truth = exact.search(queries, k)
+
+    rows = []
+    for codec, refine in configs:
+        spec = choose_index_spec(n, dim, index_type=index_type, codec=codec, refine=refine)
+        t0 = time.perf_counter()
+        index = build_index(vectors, ids, spec)
+        build_seconds = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        _, found = index.search(queries, k)
+        search_seconds = time.perf_counter() - t0
+
+        hits = sum(len(set(f[f >= 0]) & set(t)) for f, t in zip(found, truth))
+        rows.append({
+            "codec": spec["codec"],
+            "refine": spec["refine"],
+            "type": spec["type"],
+            "bytes_per_vector": round(len(faiss.serialize_index(index)) / n, 1),
+            f"recall@{k}": round(hits / (len(queries) * k), 4),
+            "ms_per_query": round(search_seconds * 1000 / len(queries), 4),
+            "build_seconds": round(build_seconds, 3),
+        })
+    return rows
+
+
+def load_store_vectors(root_dir: str | None = None) -> np.ndarray:
+    """取り込み済みのベクトルをすべて読み出す"""
+    from rag.embeddings import get_embedding
+    from rag.segment_store import SegmentedVectorStore
+
+    if root_dir is None:
+        from rag.ingested_text import LOCAL_VECTOR_DIR
+        root_dir = LOCAL_VECTOR_DIR
+    store = SegmentedVectorStore.load(root_dir, get_embedding())
+    if not store.segments:
+        return np.zeros((0, 0), dtype="float32")
+    return np.concatenate([seg.vectors() for seg in store.segments])
+
+
+def embed_pdf_dir(pdf_dir: str) -> np.ndarray:
+    from rag.bulk_ingest import find_pdfs, parse_pdf
+    from rag.embeddings import get_embedding
+
+    texts = []
+    for path in find_pdfs(pdf_dir):
+        _, _, chunks = parse_pdf(path)
+        texts.extend(chunk.page_content for chunk in chunks)
+    return np.asarray(get_embedding().embed_documents(texts), dtype="float32")
+
+
+def format_rows(rows: list[dict]) -> str:
+    if not rows:
+        return ""
+    columns = list(rows[0].keys())
+    lines = ["\t".join(columns)]
+    lines.extend("\t".join(str(row[c]) for c in columns) for row in rows)
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="圧縮インデックスのメモリと recall の比較")
+    parser.add_argument("--pdf_dir", default=None, help="PDF を埋め込み直して使う（既定: 取り込み済みのベクトル）")
+    parser.add_argument("--vectorstore", default=None, help="ベクトルストアの場所（既定: rag/vectorstore）")
+    parser.add_argument("--queries", type=int, default=200, help="クエリに使うベクトル数")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--index_type", choices=["flat", "ivf", "hnsw"], default="flat",
+                        help="比べるときのインデックス構造（既定: flat = 保存形式だけの差を見る）")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    vectors = embed_pdf_dir(args.pdf_dir) if args.pdf_dir else load_store_vectors(args.vectorstore)
+    if len(vectors) == 0:
+        raise SystemExit("No vectors to evaluate")
+
+    # 取り込み済みのチャンクに少し揺らぎを足したものを質問の代わりにする
+    rng = np.random.default_rng(args.seed)
+    picked = vectors[rng.choice(len(vectors), size=min(args.queries, len(vectors)), replace=False)]
+    noise = rng.normal(scale=float(picked.std()) * 0.1, size=picked.shape).astype("float32")
+    rows = evaluate(vectors, picked + noise, k=args.k, index_type=args.index_type)
+
+    print(f"vectors={len(vectors)} dim={vectors.shape[1]} queries={len(picked)}")
+    print(format_rows(rows))
+    return rows
+
+
+if __name__ == "__main__":
+    main()
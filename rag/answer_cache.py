@@ -0,0 +1,224 @@
+"""
+完全一致の回答キャッシュ（プロセス内 LRU + 共有 SQLite の 2 段構成）。
+
+キーは (正規化した質問, インデックスバージョン, プロンプトテンプレートのハッシュ, モデル名)。
+SQLite 層は同じディスク上の全 uvicorn ワーカー・再起動後のインスタンスで共有される。
+取り込み・削除のたびにバージョンが進むので、それより前の回答は引かれない
+（新しい PDF が増えて「資料には記載がありません」が古くなった回答も含めて）。
+変更時は、そのファイルを sources に含む回答と、古いバージョンの回答を SQLite からも消す。
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+from rag.cache import LRUTTLCache, normalize_query
+from rag.index_version import current_version, on_change
+
+logger = logging.getLogger(__name__)
+
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_DB = os.environ.get("ANSWER_CACHE_DB", os.path.join("rag", "cache", "answer_cache.db"))
+ANSWER_CACHE_L1_SIZE = int(os.environ.get("ANSWER_CACHE_L1_SIZE", "256"))
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", str(7 * 86400)))
+
+
+def prompt_hash(template: str) -> str:
+    return hashlib.sha256(template.encode("utf-8")).hexdigest()[:16]
+
+
+def source_names(sources: list[dict]) -> list[str]:
+    """chat_endpoint が組み立てた sources からファイル名だけを取り出す"""
+    names = []
+    for entry in sources or []:
+        name = (entry.get("metadata") or {}).get("source")
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+class AnswerCache:
+    """L1: プロセス内 LRU / L2: SQLite（WAL）"""
+
+    def __init__(self, db_path: str = ANSWER_CACHE_DB, l1_size: int = 256, ttl: float | None = None,
+                 version_fn=current_version):
+        self.db_path = db_path
+        self.ttl = ttl if ttl and ttl > 0 else None
+        self.l1 = LRUTTLCache(max_size=l1_size, ttl=self.ttl)
+        self._version_fn = version_fn
+        self._l1_version = None
+        self._lock = threading.Lock()
+        self.l2_hits = 0
+        self.l2_misses = 0
+        self.invalidated = 0
+        self._init_db()
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _init_db(self):
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS answers (
+                    key TEXT PRIMARY KEY,
+                    question TEXT,
+                    answer TEXT,
+                    sources TEXT,
+                    model_name TEXT,
+                    generation TEXT,  -- 作成時のインデックスバージョン（列名は旧形式のまま）
+                    created_at REAL,
+                    expires_at REAL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS answer_sources (
+                    key TEXT,
+                    source TEXT,
+                    PRIMARY KEY (key, source)
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_answer_sources_source ON answer_sources(source)")
+
+    def make_key(self, question: str, prompt_fingerprint: str, model_name: str) -> str:
+        raw = json.dumps([normalize_query(question), self._version_fn(), prompt_fingerprint, model_name],
+                         ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _sync_l1(self):
+        # 他ワーカーでの取り込みも version ファイル経由で検知し、引かれなくなった L1 を捨てる
+        version = self._version_fn()
+        if version != self._l1_version:
+            with self._lock:
+                if version != self._l1_version:
+                    self.l1.clear()
+                    self._l1_version = version
+
+    def get(self, question: str, prompt_fingerprint: str, model_name: str) -> dict | None:
+        self._sync_l1()
+        key = self.make_key(question, prompt_fingerprint, model_name)
+        value = self.l1.get(key)
+        if value is not None:
+            return value
+
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT answer, sources, expires_at FROM answers WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or (row[2] is not None and row[2] <= time.time()):
+            self.l2_misses += 1
+            return None
+
+        self.l2_hits += 1
+        value = {"answer": row[0], "sources": json.loads(row[1])}
+        self.l1.set(key, value)
+        return value
+
+    def put(self, question: str, answer: str, sources: list[dict], prompt_fingerprint: str, model_name: str):
+        self._sync_l1()
+        key = self.make_key(question, prompt_fingerprint, model_name)
+        now = time.time()
+        expires_at = now + self.ttl if self.ttl else None
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, question, answer, json.dumps(sources, ensure_ascii=False), model_name,
+                 self._version_fn(), now, expires_at),
+            )
+            conn.execute("DELETE FROM answer_sources WHERE key = ?", (key,))
+            conn.executemany(
+                "INSERT OR IGNORE INTO answer_sources VALUES (?, ?)",
+                [(key, name) for name in source_names(sources)],
+            )
+        self.l1.set(key, {"answer": answer, "sources": sources})
+
+    def invalidate_sources(self, names: list[str]) -> int:
+        """指定ファイルを出典に含む回答だけを破棄する"""
+        if not names:
+            return 0
+        placeholders = ",".join("?" * len(names))
+        with self._connect() as conn:
+            keys = [r[0] for r in conn.execute(
+                f"SELECT DISTINCT key FROM answer_sources WHERE source IN ({placeholders})", names
+            )]
+            conn.executemany("DELETE FROM answers WHERE key = ?", [(k,) for k in keys])
+            conn.executemany("DELETE FROM answer_sources WHERE key = ?", [(k,) for k in keys])
+        for key in keys:
+            self.l1.pop(key)
+        self.invalidated += len(keys)
+        logger.info(f"Answer cache: invalidated {len(keys)} entries citing {names}")
+        return len(keys)
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM answers")
+            conn.execute("DELETE FROM answer_sources")
+        self.l1.clear()
+
+    def prune(self):
+        """期限切れ・古いバージョンのエントリを削除"""
+        with self._connect() as conn:
+            keys = [r[0] for r in conn.execute(
+                "SELECT key FROM answers WHERE generation != ? OR (expires_at IS NOT NULL AND expires_at <= ?)",
+                (self._version_fn(), time.time()),
+            )]
+            conn.executemany("DELETE FROM answers WHERE key = ?", [(k,) for k in keys])
+            conn.executemany("DELETE FROM answer_sources WHERE key = ?", [(k,) for k in keys])
+        return len(keys)
+
+    def on_index_change(self, version: str, sources: list[str] | None):
+        # 古いバージョンのキーはもう引かれない。変更のあった出典を含む回答を先に数えてから残りも片付ける
+        if sources:
+            self.invalidate_sources(sources)
+        self.invalidated += self.prune()
+        self.l1.clear()
+
+    def stats(self) -> dict:
+        try:
+            with self._connect() as conn:
+                l2_size = conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        except sqlite3.Error:
+            l2_size = None
+        l2_total = self.l2_hits + self.l2_misses
+        return {
+            "enabled": True,
+            "l1": self.l1.stats(),
+            "l2": {
+                "path": self.db_path,
+                "size": l2_size,
+                "hits": self.l2_hits,
+                "misses": self.l2_misses,
+                "hit_rate": round(self.l2_hits / l2_total, 4) if l2_total else 0.0,
+            },
+            "invalidated": self.invalidated,
+        }
+
+
+_cache: AnswerCache | None = None
+_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> AnswerCache | None:
+    """プロセス共通の回答キャッシュ（無効なら None）"""
+    global _cache
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                cache = AnswerCache(ANSWER_CACHE_DB, l1_size=ANSWER_CACHE_L1_SIZE, ttl=ANSWER_CACHE_TTL)
+                on_change(cache.on_index_change)
+                _cache = cache
+    return _cache
@@ -0,0 +1,215 @@
+"""
+PDF の一括取り込み。
+
+- PDF の解析・チャンク分割はプロセスプールで並列に行う
+- 解析が終わったものから大きなバッチで埋め込み、最後に 1 セグメントとして書き出す
+  （ファイルごとにインデックスを読み書きしない）
+- 終了時にスループット（files/s, pages/s, chunks/s）を表示する
+- 内容（SHA-256）が取り込み済みの PDF は解析もせずにスキップする（--rebuild 時は全件取り込み直す）
+
+python -m rag.bulk_ingest --pdf_dir rag/data [--workers 4] [--batch_size 256] [--rebuild] [--upload]
+    [--index_type auto|flat|ivf|hnsw] [--codec flat|fp16|sq8|pq]
+"""
+
+import os
+import glob
+import time
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from rag.chunking import load_pdf_pages, split_documents
+from rag.file_registry import file_sha256
+
+logger = logging.getLogger(__name__)
+
+BULK_INGEST_WORKERS = int(os.environ.get("BULK_INGEST_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+BULK_EMBED_BATCH_SIZE = int(os.environ.get("BULK_EMBED_BATCH_SIZE", "256"))
+
+
+def parse_pdf(pdf_path: str) -> tuple[str, int, list]:
+    """ワーカープロセスで実行: PDF を読み込んでチャンクに分割する"""
+    pages = load_pdf_pages(pdf_path)
+    return pdf_path, len(pages), split_documents(pages)
+
+
+def _safe_parse(pdf_path: str, parse_fn=parse_pdf) -> tuple:
+    """(path, pages, chunks, error) を返す（壊れた PDF があっても残りは続ける）"""
+    try:
+        return (*parse_fn(pdf_path), None)
+    except Exception as e:
+        return pdf_path, 0, [], str(e)
+
+
+def find_pdfs(pdf_dir: str) -> list[str]:
+    return sorted(glob.glob(os.path.join(pdf_dir, "**", "*.pdf"), recursive=True))
+
+
+def _parsed_files(pdf_paths: list[str], workers: int, parse_fn=parse_pdf):
+    """(path, pages, chunks, error) を解析が終わった順に返す"""
+    if workers <= 1 or len(pdf_paths) <= 1:
+        for path in pdf_paths:
+            yield _safe_parse(path, parse_fn)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_safe_parse, path, parse_fn) for path in pdf_paths]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def run_bulk_ingest(pdf_paths: list[str], root_dir: str | None = None, embedding=None,
+                    workers: int = BULK_INGEST_WORKERS, batch_size: int = BULK_EMBED_BATCH_SIZE,
+                    rebuild: bool = False, upload: bool = False, parse_fn=None,
+                    index_type: str | None = None, codec: str | None = None) -> dict:
+    """
+    PDF 群を取り込んでスループットのレポートを返す。
+    rebuild=True なら既存のセグメントをすべて置き換える（False なら 1 セグメントとして追記）
+    index_type / codec: 書き出すセグメントのインデックス種別と保存形式（省略時は ANN_INDEX_TYPE / ANN_CODEC）
+    """
+    from rag.segment_store import SegmentedVectorStore
+    from rag.index_version import bump_version
+
+    if root_dir is None:
+        from rag.ingested_text import LOCAL_VECTOR_DIR
+        root_dir = LOCAL_VECTOR_DIR
+    if embedding is None:
+        from rag.embeddings import get_embedding
+        embedding = get_embedding()
+
+    started = time.perf_counter()
+    store = SegmentedVectorStore.load(root_dir, embedding)
+
+    # 内容が同じファイルは 1 回だけ、取り込み済みのものは解析もしない
+    targets: list = []
+    hashes: dict = {}
+    duplicates: list = []
+    for path in pdf_paths:
+        sha256 = file_sha256(path)
+        if sha256 in hashes.values() or (not rebuild and store.ingested_file(sha256)):
+            duplicates.append(path)
+            continue
+        hashes[path] = sha256
+        targets.append(path)
+    if duplicates:
+        logger.info(f"Skip {len(duplicates)} already ingested / duplicate PDFs")
+
+    documents: list = []
+    vectors: list = []
+    pending: list = []
+    sources: list = []
+    files: list = []
+    pages_total = 0
+    failed: list = []
+    embed_seconds = 0.0
+
+    def flush(force: bool = False):
+        nonlocal embed_seconds
+        while pending and (force or len(pending) >= batch_size):
+            batch = pending[:batch_size]
+            del pending[:batch_size]
+            t0 = time.perf_counter()
+            vectors.extend(embedding.embed_documents([doc.page_content for doc in batch]))
+            embed_seconds += time.perf_counter() - t0
+            documents.extend(batch)
+
+    for path, pages, chunks, error in _parsed_files(targets, workers, parse_fn or parse_pdf):
+        if error is not None:
+            failed.append(path)
+            logger.error(f"❌ PDF parse failed: {path}: {error}")
+            continue
+        pages_total += pages
+        sources.append(os.path.basename(path))
+        if chunks:
+            # チャンクはファイル単位で連続して並ぶので、台帳には件数だけ渡せばよい
+            files.append({
+                "sha256": hashes[path],
+                "source": os.path.basename(path),
+                "count": len(chunks),
+                "pages": pages,
+                "size": os.path.getsize(path),
+            })
+        pending.extend(chunks)
+        logger.info(f"📄 {os.path.basename(path)}: {pages} pages, {len(chunks)} chunks")
+        # 解析の続きと並行して、たまった分から埋め込む
+        flush()
+    flush(force=True)
+
+    if documents:
+        array = np.asarray(vectors, dtype="float32")
+        if rebuild:
+            store.rebuild(array, documents, files=files, index_type=index_type, codec=codec)
+        else:
+            store.add_embeddings(array, documents, files=files, index_type=index_type, codec=codec)
+        bump_version(sources=None if rebuild else sources)
+
+    if upload and documents:
+        from rag.gcs_sync import get_gcs_sync
+        sync = get_gcs_sync(root_dir)
+        if sync is not None:
+            sync.attach_store(store)
+            sync.upload()
+
+    elapsed = time.perf_counter() - started
+    report = {
+        "files": len(sources),
+        "failed_files": failed,
+        "skipped_files": len(duplicates),
+        "pages": pages_total,
+        "chunks": len(documents),
+        "seconds": round(elapsed, 3),
+        "embed_seconds": round(embed_seconds, 3),
+        "files_per_sec": round(len(sources) / elapsed, 3) if elapsed else 0.0,
+        "pages_per_sec": round(pages_total / elapsed, 3) if elapsed else 0.0,
+        "chunks_per_sec": round(len(documents) / elapsed, 3) if elapsed else 0.0,
+        "vectorstore": store.stats(),
+    }
+    return report
+
+
+def format_report(report: dict) -> str:
+    return (
+        f"files={report['files']} (failed={len(report['failed_files'])}, skipped={report['skipped_files']}) pages={report['pages']} "
+        f"chunks={report['chunks']} in {report['seconds']:.1f}s "
+        f"(embed {report['embed_seconds']:.1f}s)\n"
+        f"throughput: {report['files_per_sec']:.2f} files/s, "
+        f"{report['pages_per_sec']:.2f} pages/s, {report['chunks_per_sec']:.2f} chunks/s"
+    )
+
+
+def main(argv=None, default_pdf_dir: str = "rag/data"):
+    parser = argparse.ArgumentParser(description="PDF の一括取り込み")
+    parser.add_argument("--pdf_dir", default=default_pdf_dir, help="PDF フォルダ（サブフォルダも対象）")
+    parser.add_argument("--out", default=None, help="ベクトルストアの保存先（既定: rag/vectorstore）")
+    parser.add_argument("--workers", type=int, default=BULK_INGEST_WORKERS, help="解析プロセス数")
+    parser.add_argument("--batch_size", type=int, default=BULK_EMBED_BATCH_SIZE, help="埋め込みのバッチサイズ")
+    parser.add_argument("--rebuild", action="store_true", help="既存のベクトルをすべて置き換える")
+    parser.add_argument("--upload", action="store_true", help="終了後に GCS へ同期する")
+    parser.add_argument("--index_type", choices=["auto", "flat", "ivf", "hnsw"], default=None,
+                        help="インデックス種別（既定: 環境変数 ANN_INDEX_TYPE、未設定なら auto）")
+    parser.add_argument("--codec", choices=["flat", "fp16", "sq8", "pq"], default=None,
+                        help="ベクトルの保存形式（既定: 環境変数 ANN_CODEC、未設定なら flat）")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    pdf_paths = find_pdfs(args.pdf_dir)
+    if not pdf_paths:
+        raise SystemExit(f"No PDF found in {args.pdf_dir}")
+
+    report = run_bulk_ingest(
+        pdf_paths,
+        root_dir=args.out,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        rebuild=args.rebuild,
+        upload=args.upload,
+        index_type=args.index_type,
+        codec=args.codec,
+    )
+    print(format_report(report))
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""
+セグメントごとのチャンク本文・メタデータの保存先（SQLite）。
+
+docstore.pkl（ID → Document の dict を丸ごと pickle）の代わりに、
+segments/<segment名>/chunks.db に整数 ID を主キーとして 1 行 1 チャンクで書き出す。
+読み込み時に全件をメモリに展開せず、検索でヒットした top-k の行だけを読むので、
+起動時間とメモリはチャンク数に比例しない。
+
+セグメントは不変なので、読み込みは immutable=1 の読み取り専用接続（スレッドごと）で行う。
+
+同じファイルに BM25 用の文字 n-gram 転置インデックスも書き出す（rag/lexical.py）:
+    postings(term, doc_id, tf)   lexical_terms(term, df)   lexical_docs(id, length)
+メタデータでの絞り込み用の索引も持つ（rag/metadata_filter.py）:
+    chunk_fields(field, value, num, doc_id)
+"""
+
+import os
+import json
+import pickle
+import sqlite3
+import threading
+
+import numpy as np
+from langchain_core.documents import Document
+
+from rag.lexical import term_frequencies
+from rag.metadata_filter import field_rows, filter_sql, matches
+
+CHUNKS_DB_NAME = "chunks.db"
+LEGACY_DOCSTORE_NAME = "docstore.pkl"
+# 1 回の IN (...) に渡す ID の数
+SQL_IN_BATCH = 500
+
+
+def _batched(items: list, size: int = SQL_IN_BATCH):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class ChunkStore:
+    """chunks.db の読み書き"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    @classmethod
+    def write(cls, path: str, ids, docs: list) -> "ChunkStore":
+        """新しいセグメントのチャンクを書き出す（書き出した後は読み取り専用）"""
+        conn = sqlite3.connect(path)
+        try:
+            conn.execute("PRAGMA journal_mode=OFF")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute(
+                "CREATE TABLE chunks (id INTEGER PRIMARY KEY, source TEXT, content TEXT, metadata TEXT)"
+            )
+            conn.executemany(
+                "INSERT INTO chunks (id, source, content, metadata) VALUES (?, ?, ?, ?)",
+                (
+                    (int(i), doc.metadata.get("source"), doc.page_content,
+                     json.dumps(doc.metadata, ensure_ascii=False, default=str))
+                    for i, doc in zip(ids, docs)
+                ),
+            )
+            conn.execute("CREATE INDEX idx_chunks_source ON chunks(source)")
+            cls._write_lexical(conn, ids, docs)
+            cls._write_fields(conn, ids, docs)
+            conn.commit()
+        finally:
+            conn.close()
+        return cls(path)
+
+    @staticmethod
+    def _write_lexical(conn: sqlite3.Connection, ids, docs: list):
+        conn.execute("CREATE TABLE postings (term TEXT, doc_id INTEGER, tf INTEGER, "
+                     "PRIMARY KEY (term, doc_id)) WITHOUT ROWID")
+        conn.execute("CREATE TABLE lexical_terms (term TEXT PRIMARY KEY, df INTEGER) WITHOUT ROWID")
+        conn.execute("CREATE TABLE lexical_docs (id INTEGER PRIMARY KEY, length INTEGER)")
+        df: dict = {}
+        for doc_id, doc in zip(ids, docs):
+            counts, length = term_frequencies(doc.page_content)
+            conn.execute("INSERT INTO lexical_docs (id, length) VALUES (?, ?)", (int(doc_id), length))
+            conn.executemany("INSERT INTO postings (term, doc_id, tf) VALUES (?, ?, ?)",
+                             ((term, int(doc_id), tf) for term, tf in counts.items()))
+            for term in counts:
+                df[term] = df.get(term, 0) + 1
+        conn.executemany("INSERT INTO lexical_terms (term, df) VALUES (?, ?)", df.items())
+
+    @staticmethod
+    def _write_fields(conn: sqlite3.Connection, ids, docs: list):
+        conn.execute("CREATE TABLE chunk_fields (field TEXT, value TEXT, num REAL, doc_id INTEGER)")
+        conn.executemany(
+            "INSERT INTO chunk_fields (field, value, num, doc_id) VALUES (?, ?, ?, ?)",
+            ((field, value, num, int(doc_id))
+             for doc_id, doc in zip(ids, docs) for field, value, num in field_rows(doc.metadata)),
+        )
+        conn.execute("CREATE INDEX idx_chunk_fields_value ON chunk_fields(field, value)")
+        conn.execute("CREATE INDEX idx_chunk_fields_num ON chunk_fields(field, num)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            uri = f"file:{os.path.abspath(self.path)}?mode=ro&immutable=1"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _document(content: str, metadata: str) -> Document:
+        return Document(page_content=content, metadata=json.loads(metadata))
+
+    def get(self, doc_id: int) -> Document | None:
+        row = self._conn().execute(
+            "SELECT content, metadata FROM chunks WHERE id = ?", (int(doc_id),)
+        ).fetchone()
+        return self._document(*row) if row else None
+
+    def get_many(self, ids) -> dict:
+        """ID → Document（見つからない ID は含まない）"""
+        found = {}
+        conn = self._conn()
+        for batch in _batched([int(i) for i in ids]):
+            query = f"SELECT id, content, metadata FROM chunks WHERE id IN ({','.join('?' * len(batch))})"
+            for doc_id, content, metadata in conn.execute(query, batch):
+                found[doc_id] = self._document(content, metadata)
+        return found
+
+    def ids_for_source(self, source: str) -> list[int]:
+        return [row[0] for row in self._conn().execute("SELECT id FROM chunks WHERE source = ?", (source,))]
+
+    def source_counts(self) -> dict:
+        rows = self._conn().execute("SELECT source, COUNT(*) FROM chunks GROUP BY source")
+        return {source: n for source, n in rows}
+
+    # ------------------------------------------------------------------
+    # BM25 用の転置インデックス
+    # ------------------------------------------------------------------
+    @property
+    def has_lexical(self) -> bool:
+        if not hasattr(self, "_has_lexical"):
+            row = self._conn().execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'postings'"
+            ).fetchone()
+            self._has_lexical = row is not None
+        return self._has_lexical
+
+    def lexical_stats(self) -> tuple[int, int]:
+        """(文書数, 文書長の合計)。セグメントは不変なので 1 回だけ数える"""
+        if not self.has_lexical:
+            return 0, 0
+        if not hasattr(self, "_lexical_stats"):
+            self._lexical_stats = tuple(self._conn().execute(
+                "SELECT COUNT(*), COALESCE(SUM(length), 0) FROM lexical_docs"
+            ).fetchone())
+        return self._lexical_stats
+
+    def term_df(self, terms) -> dict:
+        if not self.has_lexical:
+            return {}
+        found = {}
+        conn = self._conn()
+        for batch in _batched(list(terms)):
+            query = f"SELECT term, df FROM lexical_terms WHERE term IN ({','.join('?' * len(batch))})"
+            found.update(conn.execute(query, batch))
+        return found
+
+    def postings(self, terms, id_ranges=None) -> list[tuple]:
+        """[(term, doc_id, tf, 文書長), ...]
+
+        id_ranges: [[start, end], ...] を渡すとその ID 区間だけ（主キー (term, doc_id) の範囲で引く）
+        """
+        if not self.has_lexical:
+            return []
+        rows = []
+        conn = self._conn()
+        for batch in _batched(list(terms)):
+            query = (
+                "SELECT p.term, p.doc_id, p.tf, d.length FROM postings p "
+                f"JOIN lexical_docs d ON d.id = p.doc_id WHERE p.term IN ({','.join('?' * len(batch))})"
+            )
+            if id_ranges is None:
+                rows.extend(conn.execute(query, batch))
+                continue
+            for start, end in id_ranges:
+                rows.extend(conn.execute(query + " AND p.doc_id BETWEEN ? AND ?", [*batch, int(start), int(end)]))
+        return rows
+
+    # ------------------------------------------------------------------
+    # メタデータでの絞り込み
+    # ------------------------------------------------------------------
+    def _has_table(self, name: str) -> bool:
+        row = self._conn().execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+        ).fetchone()
+        return row is not None
+
+    def filter_ids(self, normalized: tuple) -> np.ndarray:
+        """フィルタ（metadata_filter.normalize_filter の正規形）に合う ID（昇順）"""
+        if self._has_table("chunk_fields"):
+            sql, params = filter_sql(normalized)
+            ids = [row[0] for row in self._conn().execute(sql, params)]
+        else:
+            ids = [doc_id for doc_id, metadata in self._conn().execute("SELECT id, metadata FROM chunks")
+                   if matches(json.loads(metadata), normalized)]
+        return np.unique(np.asarray(ids, dtype="int64"))
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class PickleChunkStore:
+    """docstore.pkl 形式の古いセグメント用（全件をメモリに持つ。マージ・書き換えで chunks.db になる）
+
+    転置インデックスはないので、キーワード検索の対象にならない。
+    """
+
+    has_lexical = False
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._docs: dict = pickle.load(f)
+
+    def get(self, doc_id: int) -> Document | None:
+        return self._docs.get(int(doc_id))
+
+    def get_many(self, ids) -> dict:
+        return {int(i): self._docs[int(i)] for i in ids if int(i) in self._docs}
+
+    def ids_for_source(self, source: str) -> list[int]:
+        return [doc_id for doc_id, doc in self._docs.items() if doc.metadata.get("source") == source]
+
+    def source_counts(self) -> dict:
+        counts: dict = {}
+        for doc in self._docs.values():
+            source = doc.metadata.get("source")
+            counts[source] = counts.get(source, 0) + 1
+        return counts
+
+    def lexical_stats(self) -> tuple[int, int]:
+        return 0, 0
+
+    def filter_ids(self, normalized: tuple) -> np.ndarray:
+        ids = [doc_id for doc_id, doc in self._docs.items() if matches(doc.metadata, normalized)]
+        return np.unique(np.asarray(ids, dtype="int64"))
+
+    def term_df(self, terms) -> dict:
+        return {}
+
+    def postings(self, terms, id_ranges=None) -> list[tuple]:
+        return []
+
+    def close(self):
+        pass
+
+
+def open_chunk_store(segment_dir: str):
+    """セグメントのチャンクストアを開く（chunks.db がなければ docstore.pkl）"""
+    db_path = os.path.join(segment_dir, CHUNKS_DB_NAME)
+    if os.path.exists(db_path):
+        return ChunkStore(db_path)
+    return PickleChunkStore(os.path.join(segment_dir, LEGACY_DOCSTORE_NAME))
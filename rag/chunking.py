@@ -0,0 +1,39 @@
+"""
+PDF の読み込みとチャンク分割の共通設定。
+
+アップロード時の取り込みと一括取り込みで同じ分割になるよう、設定はここにまとめる。
+（一括取り込みのワーカープロセスからも import するので、重い依存は持たない）
+"""
+
+import os
+import time
+
+from langchain_community.document_loaders.pdf import PyPDFLoader
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+CHUNK_SIZE = int(os.environ.get("CHUNK_SIZE", "500"))
+CHUNK_OVERLAP = int(os.environ.get("CHUNK_OVERLAP", "100"))
+CHUNK_SEPARATORS = ["\n\n", "\n", "。", "！", "？", "、", " ", ""]
+
+
+def make_text_splitter() -> RecursiveCharacterTextSplitter:
+    return RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
+        separators=CHUNK_SEPARATORS,
+    )
+
+
+def load_pdf_pages(pdf_path: str, source_name: str | None = None) -> list:
+    """PDF を 1 ページ 1 Document で読み込み、出典を source_name にそろえる（取り込み時刻 uploaded_at も付ける）"""
+    pages = PyPDFLoader(pdf_path).load()
+    source_name = source_name or os.path.basename(pdf_path)
+    uploaded_at = time.time()
+    for page in pages:
+        page.metadata["source"] = source_name
+        page.metadata["uploaded_at"] = uploaded_at
+    return pages
+
+
+def split_documents(pages: list) -> list:
+    return make_text_splitter().split_documents(pages)
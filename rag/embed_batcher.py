@@ -0,0 +1,136 @@
+"""
+同時に届いたクエリ埋め込みを 1 回の batched encode にまとめるディスパッチャ。
+
+最初のクエリが届いてから window_ms 待つ（または max_batch_size 件たまる）間に
+来たクエリをまとめて encode し、結果をそれぞれの呼び出し元へ返す。
+"""
+
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+class _Request:
+    __slots__ = ("text", "future", "enqueued_at")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class EmbeddingBatcher:
+    """encode_fn(list[str]) -> list[vector] をまとめて呼び出すマイクロバッチ実行器"""
+
+    def __init__(self, encode_fn, window_ms: float = 5.0, max_batch_size: int = 32, name: str = "embed"):
+        self.encode_fn = encode_fn
+        self.window = max(window_ms, 0) / 1000.0
+        self.max_batch_size = max(max_batch_size, 1)
+        self.name = name
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._closed = False
+
+        # メトリクス
+        self.batches = 0
+        self.items = 0
+        self.max_batch_seen = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_encode = 0.0
+        self.errors = 0
+
+    def embed(self, text: str, timeout: float | None = None):
+        """1 件のテキストを埋め込む。他スレッドからの同時呼び出しとまとめて encode される"""
+        if self._closed:
+            raise RuntimeError("EmbeddingBatcher is closed")
+        self._ensure_worker()
+        request = _Request(text)
+        self._queue.put(request)
+        return request.future.result(timeout=timeout)
+
+    def close(self):
+        self._closed = True
+        self._queue.put(None)
+
+    def _ensure_worker(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name=f"{self.name}-batcher", daemon=True
+                )
+                self._thread.start()
+
+    def _collect(self, first: _Request) -> list:
+        batch = [first]
+        deadline = first.enqueued_at + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = self._collect(first)
+            self._process(batch)
+
+    def _process(self, batch: list):
+        started = time.perf_counter()
+        # 同じバッチ内の重複クエリは 1 回だけ encode する
+        unique_texts = list(dict.fromkeys(r.text for r in batch))
+        try:
+            vectors = self.encode_fn(unique_texts)
+            by_text = {t: list(v) for t, v in zip(unique_texts, vectors)}
+            for r in batch:
+                r.future.set_result(list(by_text[r.text]))
+        except Exception as e:
+            logger.error(f"Embedding batch failed ({len(batch)} items): {e}")
+            with self._stats_lock:
+                self.errors += 1
+            for r in batch:
+                if not r.future.done():
+                    r.future.set_exception(e)
+        finished = time.perf_counter()
+
+        waits = [started - r.enqueued_at for r in batch]
+        with self._stats_lock:
+            self.batches += 1
+            self.items += len(batch)
+            self.max_batch_seen = max(self.max_batch_seen, len(batch))
+            self.total_wait += sum(waits)
+            self.max_wait = max(self.max_wait, max(waits))
+            self.total_encode += finished - started
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "window_ms": round(self.window * 1000, 3),
+                "max_batch_size": self.max_batch_size,
+                "batches": self.batches,
+                "items": self.items,
+                "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+                "max_batch_seen": self.max_batch_seen,
+                "avg_queue_wait_ms": round(self.total_wait / self.items * 1000, 3) if self.items else 0.0,
+                "max_queue_wait_ms": round(self.max_wait * 1000, 3),
+                "avg_encode_ms": round(self.total_encode / self.batches * 1000, 3) if self.batches else 0.0,
+                "errors": self.errors,
+                "queue_depth": self._queue.qsize(),
+            }
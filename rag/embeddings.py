@@ -0,0 +1,167 @@
+"""
+埋め込みモデルのプロセス内レジストリ。
+
+SentenceTransformer の重みはモデル名ごとにプロセスで 1 回だけロードし、
+MyEmbedding の全インスタンス（API・取り込み・CLI）で共有する。
+"""
+
+import os
+import time
+import logging
+import threading
+
+from langchain_core.embeddings import Embeddings
+from sentence_transformers import SentenceTransformer
+
+from rag.cache import LRUTTLCache, normalize_query
+from rag.embed_batcher import EmbeddingBatcher
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL_NAME = os.environ.get("EMBEDDING_MODEL_NAME", "intfloat/multilingual-e5-small")
+
+_models: dict = {}
+_model_stats: dict = {}
+_model_locks: dict = {}
+_embeddings: dict = {}
+_batchers: dict = {}
+_registry_lock = threading.Lock()
+
+# 同時クエリのマイクロバッチ設定（EMBED_BATCH_WINDOW_MS=0 で無効）
+EMBED_BATCH_WINDOW_MS = float(os.environ.get("EMBED_BATCH_WINDOW_MS", "5"))
+EMBED_BATCH_MAX_SIZE = int(os.environ.get("EMBED_BATCH_MAX_SIZE", "32"))
+
+# クエリ埋め込みキャッシュ（キー: (モデル名, 正規化したクエリ)）
+query_embedding_cache = LRUTTLCache(
+    max_size=int(os.environ.get("QUERY_EMBED_CACHE_SIZE", "1024")),
+    ttl=float(os.environ.get("QUERY_EMBED_CACHE_TTL", "3600")),
+)
+
+
+def _current_rss_bytes() -> int:
+    """現在の RSS（バイト）。/proc が無い環境では ru_maxrss で代用"""
+    try:
+        with open("/proc/self/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except Exception:
+        return 0
+
+
+def _param_bytes(model) -> int:
+    try:
+        return sum(p.numel() * p.element_size() for p in model.parameters())
+    except Exception:
+        return 0
+
+
+def _model_lock(model_name: str) -> threading.RLock:
+    with _registry_lock:
+        return _model_locks.setdefault(model_name, threading.RLock())
+
+
+def get_sentence_transformer(model_name: str = EMBEDDING_MODEL_NAME) -> SentenceTransformer:
+    """モデル名ごとに 1 回だけ SentenceTransformer をロードして返す（スレッドセーフ）"""
+    model = _models.get(model_name)
+    if model is not None:
+        return model
+
+    with _model_lock(model_name):
+        model = _models.get(model_name)
+        if model is not None:
+            return model
+
+        rss_before = _current_rss_bytes()
+        start = time.perf_counter()
+        model = SentenceTransformer(model_name)
+        load_seconds = time.perf_counter() - start
+
+        _model_stats[model_name] = {
+            "load_seconds": round(load_seconds, 3),
+            "param_bytes": _param_bytes(model),
+            "rss_delta_bytes": max(_current_rss_bytes() - rss_before, 0),
+            "loaded_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        _models[model_name] = model
+        logger.info(f"✅ Embedding model loaded: {model_name} ({load_seconds:.2f}s)")
+        return model
+
+
+def get_batcher(model_name: str = EMBEDDING_MODEL_NAME) -> EmbeddingBatcher | None:
+    """モデルごとのクエリ埋め込みバッチャ（無効化されていれば None）"""
+    if EMBED_BATCH_WINDOW_MS <= 0:
+        return None
+    batcher = _batchers.get(model_name)
+    if batcher is None:
+        with _model_lock(model_name):
+            batcher = _batchers.get(model_name)
+            if batcher is None:
+                model = get_sentence_transformer(model_name)
+                batcher = EmbeddingBatcher(
+                    lambda texts: model.encode(texts, batch_size=len(texts), show_progress_bar=False).tolist(),
+                    window_ms=EMBED_BATCH_WINDOW_MS,
+                    max_batch_size=EMBED_BATCH_MAX_SIZE,
+                    name=model_name.split("/")[-1],
+                )
+                _batchers[model_name] = batcher
+    return batcher
+
+
+class MyEmbedding(Embeddings):
+    """カスタム埋め込みクラス（モデル本体はレジストリで共有）"""
+    def __init__(self, model_name: str = EMBEDDING_MODEL_NAME):
+        self.model_name = model_name
+        self.model = get_sentence_transformer(model_name)
+
+    def embed_documents(self, texts):
+        return self.model.encode(texts, show_progress_bar=False).tolist()
+
+    def embed_query(self, text):
+        # RetrievalQA の retriever / SimpleSearchChain / 直接検索はすべてここを通る
+        key = (self.model_name, normalize_query(text))
+        vector = query_embedding_cache.get(key)
+        if vector is None:
+            batcher = get_batcher(self.model_name)
+            if batcher is not None:
+                vector = batcher.embed(key[1])
+            else:
+                vector = self.model.encode(key[1]).tolist()
+            query_embedding_cache.set(key, vector)
+        return list(vector)
+
+
+def get_embedding(model_name: str = EMBEDDING_MODEL_NAME) -> MyEmbedding:
+    """共有の MyEmbedding インスタンスを返す"""
+    embedding = _embeddings.get(model_name)
+    if embedding is None:
+        with _model_lock(model_name):
+            embedding = _embeddings.get(model_name)
+            if embedding is None:
+                embedding = MyEmbedding(model_name)
+                _embeddings[model_name] = embedding
+    return embedding
+
+
+def warmup_embedding(model_name: str = EMBEDDING_MODEL_NAME) -> MyEmbedding:
+    """起動時にモデルをロードし、初回 encode の遅延も先に払っておく"""
+    embedding = get_embedding(model_name)
+    start = time.perf_counter()
+    embedding.embed_query("warmup")
+    _model_stats[model_name]["warmup_seconds"] = round(time.perf_counter() - start, 3)
+    return embedding
+
+
+def embedding_stats() -> dict:
+    """ステータスエンドポイント用のロード時間・メモリ情報"""
+    return {
+        "models": {name: dict(stats) for name, stats in _model_stats.items()},
+        "process_rss_bytes": _current_rss_bytes(),
+        "query_cache": query_embedding_cache.stats(),
+        "query_batching": {name: b.stats() for name, b in _batchers.items()},
+    }
@@ -0,0 +1,20 @@
+"""
+取り込み済みファイルの判定に使う内容ハッシュ。
+
+台帳そのものは manifest.json の ingested_files（rag/segment_store.py）にあり、
+ここではアップロードされたバイト列・ローカルファイルの SHA-256 を計算する。
+"""
+
+import hashlib
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def bytes_sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
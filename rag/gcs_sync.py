@@ -0,0 +1,452 @@
+"""
+ベクトルストア（manifest.json + セグメント）と GCS の差分同期。
+
+- アップロード: 取り込みのたびに schedule_upload() を呼ぶと、デバウンス後にバックグラウンドで
+  GCS と md5 が違うファイルだけを送り、最後に manifest を送る（連続した取り込みでも 1 回にまとまる）
+- ダウンロード: GCS 上の manifest の generation が前回同期時と同じなら何もしない。
+  変わっていれば manifest に記録された md5 とローカルを比べ、変わったファイルだけを取得する
+
+前回同期した manifest の generation / md5 は <local_dir>/.gcs_sync.json に、
+manifest そのもの（次の競合時の基準）は <local_dir>/.gcs_base_manifest.json に保存する。
+
+アップロードは manifest の generation を条件にするので、前回同期の後に他インスタンスが公開していると失敗する（競合）。
+そのときは GCS の manifest とセグメントを取得し、前回同期以降のローカルの変更（追加した文書・削除した文書）を
+その上にかけ直して（SegmentedVectorStore.rebase）から、もう一度アップロードする。
+かけ直しは attach_store() で登録された検索中のストア（共有ストア・テナントのシャード）に対して行うので、
+インデックスを二重に読み込まず、検索にもすぐ反映される。
+"""
+
+import os
+import json
+import time
+import base64
+import hashlib
+import logging
+import threading
+import weakref
+
+from rag.segment_store import MANIFEST_NAME, SEGMENTS_DIR, LEGACY_INDEX_NAME, SegmentedVectorStore, file_md5
+
+try:
+    from google.api_core.exceptions import PreconditionFailed
+except ImportError:
+    PreconditionFailed = None
+
+logger = logging.getLogger(__name__)
+
+GCS_BUCKET = os.environ.get("GCS_BUCKET_NAME", "")
+GCS_VEC_DIR = "vectorstore"
+# 最後の取り込みからこの秒数だけ待ってアップロードする
+GCS_SYNC_DEBOUNCE_SECONDS = float(os.environ.get("GCS_SYNC_DEBOUNCE_SECONDS", "3"))
+# 取り込みが続いても、最初の予約からこの秒数以内には必ずアップロードする
+GCS_SYNC_MAX_DELAY_SECONDS = float(os.environ.get("GCS_SYNC_MAX_DELAY_SECONDS", "30"))
+
+# 競合したとき、かけ直してアップロードし直す回数
+GCS_UPLOAD_CONFLICT_RETRIES = int(os.environ.get("GCS_UPLOAD_CONFLICT_RETRIES", "3"))
+
+SYNC_STATE_NAME = ".gcs_sync.json"
+BASE_MANIFEST_NAME = ".gcs_base_manifest.json"
+
+
+def _is_conflict(error: Exception) -> bool:
+    """if_generation_match の条件に合わなかった（HTTP 412）"""
+    if PreconditionFailed is not None and isinstance(error, PreconditionFailed):
+        return True
+    return getattr(error, "code", None) == 412
+
+
+def _bytes_md5(data: bytes) -> str:
+    return base64.b64encode(hashlib.md5(data).digest()).decode("ascii")
+
+
+def _default_client():
+    from google.cloud import storage
+    return storage.Client()
+
+
+class GCSSync:
+    """ローカルのベクトルストアディレクトリと gs://<bucket>/<prefix>/ の同期"""
+
+    def __init__(self, bucket_name: str, local_dir: str, prefix: str = GCS_VEC_DIR, client_factory=None,
+                 debounce_seconds: float = GCS_SYNC_DEBOUNCE_SECONDS,
+                 max_delay_seconds: float = GCS_SYNC_MAX_DELAY_SECONDS, store: SegmentedVectorStore | None = None):
+        self.bucket_name = bucket_name
+        self.local_dir = local_dir
+        self.prefix = prefix.strip("/")
+        self.debounce_seconds = debounce_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self._client_factory = client_factory or _default_client
+        self._client = None
+        self._timer = None
+        self._first_scheduled = None
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._store_ref = None
+        if store is not None:
+            self.attach_store(store)
+        self.uploads = 0
+        self.uploaded_files = 0
+        self.skipped_files = 0
+        self.downloads = 0
+        self.downloaded_files = 0
+        self.last_upload_at = None
+        self.last_download_at = None
+        self.last_error = None
+        self.conflicts = 0
+        self.rebases = 0
+
+    # ------------------------------------------------------------------
+    # 共通
+    # ------------------------------------------------------------------
+    def attach_store(self, store: SegmentedVectorStore):
+        """このディレクトリを開いている検索中のストア（競合時のかけ直しに使う。閉じられたシャードを引き留めないよう弱参照）"""
+        self._store_ref = weakref.ref(store)
+
+    def _live_store(self) -> SegmentedVectorStore | None:
+        return self._store_ref() if self._store_ref is not None else None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self._client_factory()
+        return self._client
+
+    @property
+    def bucket(self):
+        return self.client.bucket(self.bucket_name)
+
+    def _blob_name(self, *parts: str) -> str:
+        return "/".join((self.prefix,) + parts)
+
+    def _local_path(self, *parts: str) -> str:
+        return os.path.join(self.local_dir, *parts)
+
+    def _read_json(self, path: str) -> dict | None:
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _read_state(self) -> dict:
+        return self._read_json(self._local_path(SYNC_STATE_NAME)) or {}
+
+    def _write_state(self, **state):
+        path = self._local_path(SYNC_STATE_NAME)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
+
+    def _read_base(self) -> dict | None:
+        return self._read_json(self._local_path(BASE_MANIFEST_NAME))
+
+    def _write_base(self, raw: bytes):
+        """同期した時点の manifest（GCS と同じバイト列）を、次の競合時の基準として残す"""
+        path = self._local_path(BASE_MANIFEST_NAME)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(raw)
+        os.replace(tmp_path, path)
+
+    def _remote_hashes(self) -> dict:
+        """prefix 配下の blob 名 → md5_hash"""
+        return {
+            blob.name: blob.md5_hash
+            for blob in self.client.list_blobs(self.bucket_name, prefix=f"{self.prefix}/")
+        }
+
+    def _segment_files(self, entry: dict) -> dict:
+        files = entry.get("files")
+        if files:
+            return files
+        # files を持たない古い manifest はその場でハッシュを計算する
+        seg_dir = self._local_path(SEGMENTS_DIR, entry["name"])
+        return {fname: file_md5(os.path.join(seg_dir, fname)) for fname in sorted(os.listdir(seg_dir))}
+
+    # ------------------------------------------------------------------
+    # アップロード
+    # ------------------------------------------------------------------
+    def upload(self) -> int:
+        """変わったファイルだけをアップロードし、送ったファイル数を返す
+
+        他インスタンスの公開と競合したら、ローカルの変更を GCS の版の上にかけ直して送り直す
+        （GCS_UPLOAD_CONFLICT_RETRIES 回まで。それでも送れなければ last_error に残し、変更はローカルに残る）
+        """
+        uploaded = 0
+        for attempt in range(GCS_UPLOAD_CONFLICT_RETRIES + 1):
+            sent, ok = self._upload_once()
+            uploaded += sent
+            if ok:
+                return uploaded
+            self.conflicts += 1
+            if attempt == GCS_UPLOAD_CONFLICT_RETRIES:
+                break
+            logger.warning("⚠️ GCS manifest was updated by another instance, rebasing local changes onto it")
+            self._rebase_onto_remote()
+        self.last_error = "remote manifest changed since last sync; local changes are not uploaded yet"
+        logger.error(f"❌ GCS upload gave up after {self.conflicts} conflicts, local changes are not in GCS")
+        return uploaded
+
+    def _upload_once(self) -> tuple:
+        """1 回分のアップロード。(送ったファイル数, manifest まで送れたか) を返す"""
+        with self._sync_lock:
+            manifest_path = self._local_path(MANIFEST_NAME)
+            try:
+                with open(manifest_path, "rb") as f:
+                    raw = f.read()
+            except OSError:
+                return 0, True
+            manifest = json.loads(raw.decode("utf-8"))
+            manifest_md5 = _bytes_md5(raw)
+            state = self._read_state()
+            if state.get("manifest_md5") == manifest_md5:
+                return 0, True
+
+            bucket = self.bucket
+            remote = self._remote_hashes()
+            uploaded = 0
+            referenced = set()
+            for entry in manifest.get("segments", []):
+                for fname, md5 in self._segment_files(entry).items():
+                    blob_name = self._blob_name(SEGMENTS_DIR, entry["name"], fname)
+                    referenced.add(blob_name)
+                    if remote.get(blob_name) == md5:
+                        self.skipped_files += 1
+                        continue
+                    bucket.blob(blob_name).upload_from_filename(self._local_path(SEGMENTS_DIR, entry["name"], fname))
+                    uploaded += 1
+                    logger.info(f"✅ Uploaded to GCS: gs://{self.bucket_name}/{blob_name}")
+
+            # manifest は最後に上げる（参照先のセグメントが先に揃っているように）。
+            # 読んだ時点のバイト列を送る（送っている間に manifest が書き換わっても基準とずれないように）
+            manifest_blob = bucket.blob(self._blob_name(MANIFEST_NAME))
+            # 前回同期後に他インスタンスが manifest を更新していたら上書きしない（未同期なら「まだ無いこと」が条件）
+            generation = state.get("manifest_generation")
+            tmp_path = f"{manifest_path}.upload"
+            with open(tmp_path, "wb") as f:
+                f.write(raw)
+            try:
+                manifest_blob.upload_from_filename(tmp_path, if_generation_match=generation or 0)
+            except Exception as e:
+                if _is_conflict(e):
+                    logger.warning(f"⚠️ GCS manifest precondition failed: {e}")
+                    return uploaded, False
+                raise
+            finally:
+                os.remove(tmp_path)
+            uploaded += 1
+            self._write_state(manifest_generation=manifest_blob.generation, manifest_md5=manifest_md5)
+            self._write_base(raw)
+
+            # マージで不要になったセグメントを GCS からも消す
+            segments_prefix = self._blob_name(SEGMENTS_DIR) + "/"
+            for blob_name in remote:
+                if blob_name.startswith(segments_prefix) and blob_name not in referenced:
+                    bucket.blob(blob_name).delete()
+
+            self.uploads += 1
+            self.uploaded_files += uploaded
+            self.last_upload_at = time.time()
+            self.last_error = None
+            logger.info(f"✅ GCS sync: uploaded {uploaded} files (manifest v{manifest.get('version')})")
+            return uploaded, True
+
+    def _rebase_onto_remote(self):
+        """GCS の最新の manifest とセグメントを取得し、前回同期以降のローカルの変更をその上にかけ直す"""
+        store = self._live_store()
+        if store is None:
+            # 検索中のストアがないプロセス（一括取り込みのコマンドなど）だけ、ここで開く
+            store = SegmentedVectorStore(self.local_dir, embedding=None)
+        # ロックの順序は ストアの書き込みロック → _sync_lock（ホットリロードと同じ）
+        with store.exclusive():
+            with self._sync_lock:
+                bucket = self.bucket
+                fetched = self._fetch_manifest(bucket)
+                local_md5 = self._read_state().get("manifest_md5")
+                if fetched is None:
+                    # GCS の manifest が消えていた: 次は「まだ無いこと」を条件に送る
+                    self._write_state(manifest_generation=None, manifest_md5=local_md5)
+                    return
+                raw, generation = fetched
+                remote = json.loads(raw.decode("utf-8"))
+                self.downloaded_files += self._download_segments(bucket, remote, store.manifest)
+                base = self._read_base()
+            store.rebase(remote, base)
+            with self._sync_lock:
+                self._write_base(raw)
+                self._write_state(manifest_generation=generation, manifest_md5=local_md5)
+        self.rebases += 1
+
+    def schedule_upload(self):
+        """デバウンスしてバックグラウンドでアップロードする（リクエスト処理はブロックしない）"""
+        with self._lock:
+            now = time.monotonic()
+            if self._first_scheduled is None:
+                self._first_scheduled = now
+            delay = min(self.debounce_seconds,
+                        max(0.0, self._first_scheduled + self.max_delay_seconds - now))
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(delay, self._run_scheduled)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _run_scheduled(self):
+        with self._lock:
+            self._timer = None
+            self._first_scheduled = None
+        try:
+            self.upload()
+        except Exception as e:
+            self.last_error = str(e)
+            logger.error(f"GCS upload error: {e}")
+
+    def flush(self):
+        """予約中のアップロードがあれば今すぐ実行する（シャットダウン時など）"""
+        with self._lock:
+            timer, self._timer = self._timer, None
+            self._first_scheduled = None
+        if timer is not None:
+            timer.cancel()
+            self._run_scheduled()
+
+    @property
+    def pending(self) -> bool:
+        return self._timer is not None
+
+    def has_local_changes(self) -> bool:
+        """ローカルの manifest が前回の同期（アップロード・ダウンロード）から変わっている"""
+        manifest_path = self._local_path(MANIFEST_NAME)
+        if not os.path.exists(manifest_path):
+            return False
+        return self._read_state().get("manifest_md5") != file_md5(manifest_path)
+
+    # ------------------------------------------------------------------
+    # ダウンロード
+    # ------------------------------------------------------------------
+    def _fetch_manifest(self, bucket) -> tuple | None:
+        """GCS の manifest の (バイト列, generation)。なければ None"""
+        manifest_blob = bucket.blob(self._blob_name(MANIFEST_NAME))
+        if not manifest_blob.exists():
+            return None
+        manifest_blob.reload()
+        raw = manifest_blob.download_as_bytes(if_generation_match=manifest_blob.generation)
+        return raw, manifest_blob.generation
+
+    def _download_segments(self, bucket, manifest: dict, local_manifest: dict) -> int:
+        """manifest のセグメントのうち、ローカルにない・変わったファイルだけを取得して件数を返す"""
+        local_files = {e["name"]: e.get("files") for e in local_manifest.get("segments", [])}
+        downloaded = 0
+        for entry in manifest.get("segments", []):
+            seg_dir = self._local_path(SEGMENTS_DIR, entry["name"])
+            files = entry.get("files") or {}
+            if files and local_files.get(entry["name"]) == files and os.path.isdir(seg_dir):
+                continue
+            remote_files = files or {
+                blob.name.rsplit("/", 1)[-1]: blob.md5_hash
+                for blob in self.client.list_blobs(
+                    self.bucket_name, prefix=self._blob_name(SEGMENTS_DIR, entry["name"]) + "/"
+                )
+            }
+            # 初めてのセグメントは一時ディレクトリにそろえてから rename する（書きかけを置かない）
+            staged = not os.path.isdir(seg_dir)
+            target_dir = f"{seg_dir}.download.tmp" if staged else seg_dir
+            os.makedirs(target_dir, exist_ok=True)
+            for fname, md5 in remote_files.items():
+                local_path = os.path.join(target_dir, fname)
+                if os.path.exists(local_path) and file_md5(local_path) == md5:
+                    continue
+                tmp_path = f"{local_path}.download"
+                bucket.blob(self._blob_name(SEGMENTS_DIR, entry["name"], fname)).download_to_filename(tmp_path)
+                os.replace(tmp_path, local_path)
+                downloaded += 1
+                logger.info(f"✅ Downloaded from GCS: {entry['name']}/{fname}")
+            if staged:
+                os.replace(target_dir, seg_dir)
+        return downloaded
+
+    def download(self, force: bool = False) -> bool:
+        """GCS の manifest が前回から変わっていれば差分だけを取得する
+
+        force: generation が前回と同じでも GCS の manifest でローカルを置き換える（上げられないローカルの変更を捨てる）
+        """
+        with self._sync_lock:
+            os.makedirs(self.local_dir, exist_ok=True)
+            bucket = self.bucket
+            manifest_blob = bucket.blob(self._blob_name(MANIFEST_NAME))
+            if not manifest_blob.exists():
+                return self._download_legacy()
+
+            manifest_blob.reload()
+            manifest_path = self._local_path(MANIFEST_NAME)
+            state = self._read_state()
+            if (not force and state.get("manifest_generation") == manifest_blob.generation
+                    and os.path.exists(manifest_path)):
+                logger.info("✅ GCS sync: local vectorstore is up to date")
+                return True
+
+            raw, generation = self._fetch_manifest(bucket)
+            manifest = json.loads(raw.decode("utf-8"))
+            downloaded = self._download_segments(bucket, manifest, self._read_json(manifest_path) or {})
+
+            # GCS の manifest をバイト列のまま置く（md5 がリモートと一致する）
+            tmp_path = f"{manifest_path}.download"
+            with open(tmp_path, "wb") as f:
+                f.write(raw)
+            os.replace(tmp_path, manifest_path)
+            self._write_state(manifest_generation=generation, manifest_md5=file_md5(manifest_path))
+            self._write_base(raw)
+
+            self.downloads += 1
+            self.downloaded_files += downloaded
+            self.last_download_at = time.time()
+            logger.info(f"✅ GCS sync: downloaded {downloaded} files (manifest v{manifest.get('version')})")
+            return True
+
+    def _download_legacy(self) -> bool:
+        """manifest がない旧形式（index.faiss / index.pkl）のバケット"""
+        downloaded = False
+        for fname in (f"{LEGACY_INDEX_NAME}.faiss", f"{LEGACY_INDEX_NAME}.pkl"):
+            blob = self.bucket.blob(self._blob_name(fname))
+            if blob.exists():
+                blob.download_to_filename(self._local_path(fname))
+                logger.info(f"✅ Downloaded from GCS: {self._blob_name(fname)}")
+                downloaded = True
+        return downloaded
+
+    def stats(self) -> dict:
+        return {
+            "bucket": self.bucket_name,
+            "prefix": self.prefix,
+            "pending_upload": self.pending,
+            "uploads": self.uploads,
+            "uploaded_files": self.uploaded_files,
+            "skipped_files": self.skipped_files,
+            "downloads": self.downloads,
+            "downloaded_files": self.downloaded_files,
+            "last_upload_at": self.last_upload_at,
+            "last_download_at": self.last_download_at,
+            "last_error": self.last_error,
+            "conflicts": self.conflicts,
+            "rebases": self.rebases,
+            "local_changes": self.has_local_changes(),
+        }
+
+
+_syncers: dict = {}
+_syncers_lock = threading.Lock()
+
+
+def get_gcs_sync(local_dir: str, prefix: str = GCS_VEC_DIR) -> GCSSync | None:
+    """ディレクトリごとの同期オブジェクト（GCS_BUCKET_NAME 未設定なら None）
+
+    prefix: GCS 側の置き場所（テナントのシャードは vectorstore_tenants/<テナント>。rag/tenant_shards.py）
+    """
+    if not GCS_BUCKET:
+        return None
+    key = os.path.abspath(local_dir)
+    with _syncers_lock:
+        if key not in _syncers:
+            _syncers[key] = GCSSync(GCS_BUCKET, local_dir, prefix=prefix)
+        return _syncers[key]
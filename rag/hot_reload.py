@@ -0,0 +1,199 @@
+"""
+ベクトルストアのホットリロード（インスタンス間）。
+
+あるインスタンスで /upload/ingest すると、新しいセグメントと manifest が GCS に上がる（rag/gcs_sync.py）。
+他のインスタンスはバックグラウンドのスレッドで INDEX_RELOAD_INTERVAL_SECONDS ごとに
+- GCS の manifest の generation を確認し、変わっていれば差分だけを取得する
+- ローカルの manifest（同じホストの他ワーカーの取り込みも含む）が変わっていれば、新しいセグメントを読み込む
+を行い、読み込みが終わってからセグメント一覧を差し替える（SegmentedVectorStore.refresh）。
+
+main.vectorstore と rag_chain_template の retriever は同じストアを参照しているので、
+差し替え後の最初の検索から新しい版が使われる。検索中のリクエストは差し替え前の一覧で最後まで走り、
+読み込みの間もトラフィックは止めない。差分の出典は bump_version で回答キャッシュなどに通知する。
+
+自分の取り込みがまだ GCS に上がっていない間は、GCS から取得しない（ローカルの変更を上書きしない）。
+アップロードが他インスタンスとの競合などで失敗したまま残っている変更は、監視のたびに送り直す
+（GCSSync.upload が GCS の版の上にかけ直す）。INDEX_RELOAD_MAX_UPLOAD_FAILURES 回続けて送れなければ
+アラートを出してローカルの変更を捨て、GCS の版に合わせる（いつまでも取得が止まらないように）。
+"""
+
+import os
+import time
+import logging
+import threading
+
+from rag.index_version import bump_version
+
+logger = logging.getLogger(__name__)
+
+# 0 以下なら監視しない
+INDEX_RELOAD_INTERVAL_SECONDS = float(os.environ.get("INDEX_RELOAD_INTERVAL_SECONDS", "30"))
+# 残ったローカルの変更を何回続けて送れなかったら捨てるか
+INDEX_RELOAD_MAX_UPLOAD_FAILURES = int(os.environ.get("INDEX_RELOAD_MAX_UPLOAD_FAILURES", "3"))
+
+
+def changed_sources(old: dict, new: dict) -> list[str] | None:
+    """2 つの manifest の間で増えた・消えた出典（台帳のないセグメントが増えたときは分からないので None）"""
+    old_files = {sha: e["source"] for sha, e in (old.get("ingested_files") or {}).items()}
+    new_files = {sha: e["source"] for sha, e in (new.get("ingested_files") or {}).items()}
+    old_names = {e["name"] for e in old.get("segments", [])}
+    if any(not e.get("ledgered") and not e.get("merged_from") and not e.get("rewritten_from")
+           for e in new.get("segments", []) if e["name"] not in old_names):
+        return None
+    changed = {src for sha, src in old_files.items() if sha not in new_files}
+    changed |= {src for sha, src in new_files.items() if sha not in old_files}
+    return sorted(changed)
+
+
+class IndexWatcher:
+    """manifest を定期的に確認し、新しい版があれば裏で読み込んで差し替える
+
+    targets_fn() は [(名前, SegmentedVectorStore, GCSSync または None, 共有ストアか), ...] を返す
+    （共有ストア + 開いているテナントのシャード）。
+    """
+
+    def __init__(self, targets_fn, interval: float = INDEX_RELOAD_INTERVAL_SECONDS, on_reload=None,
+                 max_upload_failures: int = INDEX_RELOAD_MAX_UPLOAD_FAILURES):
+        self.targets_fn = targets_fn
+        self.interval = interval
+        self.on_reload = on_reload
+        self.max_upload_failures = max(1, max_upload_failures)
+        self._upload_failures: dict = {}  # 対象名 → 続けて送れなかった回数
+        self._stop = threading.Event()
+        self._thread = None
+        self.checks = 0
+        self.reloads = 0
+        self.skipped_downloads = 0
+        self.retried_uploads = 0
+        self.dropped_local_changes = 0
+        self.last_reload_at = None
+        self.last_reload_ms = None
+        self.last_error = None
+
+    def check(self) -> list[str]:
+        """全対象を 1 回ずつ確認し、読み込み直した対象の名前を返す"""
+        self.checks += 1
+        reloaded = []
+        for name, store, sync, shared in self.targets_fn():
+            try:
+                if self._check_one(name, store, sync, shared):
+                    reloaded.append(name)
+            except Exception as e:
+                self.last_error = f"{name}: {e}"
+                logger.error(f"❌ Hot reload failed ({name}): {e}")
+        return reloaded
+
+    def _check_one(self, name: str, store, sync, shared: bool) -> bool:
+        started = time.perf_counter()
+        before = store.manifest
+        drop_local = False
+        if sync is not None and not sync.pending and sync.has_local_changes():
+            # 書き込みロックの外で送る（競合したときのかけ直しが自分で書き込みロックを取る）
+            drop_local = not self._retry_upload(name, sync)
+        # 取り込み・削除と入れ違いにならないよう、取得と読み込みは書き込みロックの中で
+        with store.exclusive():
+            if sync is not None:
+                if drop_local:
+                    sync.download(force=True)
+                    self.dropped_local_changes += 1
+                    self._upload_failures.pop(name, None)
+                elif sync.pending or sync.has_local_changes():
+                    self.skipped_downloads += 1
+                    logger.info(f"Hot reload ({name}): local changes not uploaded yet, skipping GCS download")
+                else:
+                    sync.download()
+            if not store.refresh():
+                return False
+
+        after = store.manifest
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.reloads += 1
+        self.last_reload_at = time.time()
+        self.last_reload_ms = round(elapsed_ms, 1)
+        logger.info(f"✅ Hot reload ({name}): manifest v{before.get('version')} → v{after.get('version')} "
+                    f"({len(store.segments)} segments, {elapsed_ms:.1f} ms)")
+        if shared:
+            sources = changed_sources(before, after)
+            if sources is None or sources:
+                bump_version(sources=sources)
+        if self.on_reload is not None:
+            self.on_reload(name, store)
+        return True
+
+    def _retry_upload(self, name: str, sync) -> bool:
+        """残っているローカルの変更を送り直す。上限まで失敗が続いたら False（ローカルの変更を捨てる）"""
+        self.retried_uploads += 1
+        try:
+            sync.upload()
+        except Exception as e:
+            logger.error(f"❌ Hot reload ({name}): upload of local changes failed: {e}")
+        if not sync.has_local_changes():
+            self._upload_failures.pop(name, None)
+            return True
+        failures = self._upload_failures.get(name, 0) + 1
+        self._upload_failures[name] = failures
+        if failures < self.max_upload_failures:
+            logger.warning(f"⚠️ Hot reload ({name}): local changes still not in GCS "
+                           f"({failures}/{self.max_upload_failures})")
+            return True
+        self.last_error = f"{name}: dropped local changes that could not be uploaded after {failures} attempts"
+        logger.error(f"❌ Hot reload ({name}): local changes could not be uploaded after {failures} attempts, "
+                     f"dropping them and resetting to the GCS manifest")
+        return False
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.check()
+
+    def start(self):
+        if self.interval <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="index-watcher", daemon=True)
+        self._thread.start()
+        logger.info(f"✅ Index watcher started (every {self.interval:.0f}s)")
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.interval > 0,
+            "running": self._thread is not None and self._thread.is_alive(),
+            "interval_seconds": self.interval,
+            "checks": self.checks,
+            "reloads": self.reloads,
+            "skipped_downloads": self.skipped_downloads,
+            "retried_uploads": self.retried_uploads,
+            "dropped_local_changes": self.dropped_local_changes,
+            "last_reload_at": self.last_reload_at,
+            "last_reload_ms": self.last_reload_ms,
+            "last_error": self.last_error,
+        }
+
+
+def default_targets():
+    """共有ストア + 開いているテナントのシャード"""
+    from rag.ingested_text import LOCAL_VECTOR_DIR, get_vectorstore
+    from rag.gcs_sync import get_gcs_sync
+    from rag.tenant_shards import get_tenant_shards
+
+    targets = [("shared", get_vectorstore(), get_gcs_sync(LOCAL_VECTOR_DIR), True)]
+    shards = get_tenant_shards()
+    # get() は最終利用時刻を更新してしまう（監視のたびに使われたことになり、追い出されなくなる）
+    for tenant, store in shards.loaded_stores():
+        targets.append((f"tenant:{tenant}", store, shards.sync(tenant), False))
+    return targets
+
+
+_watcher: IndexWatcher | None = None
+_watcher_lock = threading.Lock()
+
+
+def get_index_watcher() -> IndexWatcher:
+    global _watcher
+    if _watcher is None:
+        with _watcher_lock:
+            if _watcher is None:
+                _watcher = IndexWatcher(default_targets)
+    return _watcher
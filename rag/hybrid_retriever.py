@@ -0,0 +1,72 @@
+"""
+ベクトル検索とキーワード検索（文字 n-gram BM25）を組み合わせる retriever。
+
+e5 のベクトルは型番・規格番号・カタカナの製品名の完全一致を取りこぼすことがあるので、
+両方から fetch_k 件ずつ取り、Reciprocal Rank Fusion（Σ weight / (rrf_k + 順位)）で並べ直して上位 k 件を返す。
+本文は融合後の k 件の分だけ読む。get_rag_chain / SimpleSearchChain / /chat/stream はこの retriever を使う。
+search_filter（rag/metadata_filter.py）を渡すと、両方の検索をメタデータの条件に合うチャンクに限る。
+"""
+
+import os
+import logging
+from typing import Any
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.retrievers import BaseRetriever
+
+logger = logging.getLogger(__name__)
+
+HYBRID_SEARCH_ENABLED = os.environ.get("HYBRID_SEARCH_ENABLED", "true").lower() == "true"
+HYBRID_FETCH_K = int(os.environ.get("HYBRID_FETCH_K", "20"))
+HYBRID_RRF_K = int(os.environ.get("HYBRID_RRF_K", "60"))
+HYBRID_VECTOR_WEIGHT = float(os.environ.get("HYBRID_VECTOR_WEIGHT", "1.0"))
+HYBRID_LEXICAL_WEIGHT = float(os.environ.get("HYBRID_LEXICAL_WEIGHT", "1.0"))
+
+
+def reciprocal_rank_fusion(ranked_lists: list, weights: list, rrf_k: int = HYBRID_RRF_K) -> list:
+    """
+    ranked_lists: [[(key, item), ...], ...]（それぞれ良い順）
+    同じ key は 1 つにまとめ、[(融合スコア, key, item), ...] を良い順に返す
+    """
+    fused: dict = {}
+    for ranked, weight in zip(ranked_lists, weights):
+        for rank, (key, item) in enumerate(ranked, 1):
+            score, first = fused.get(key, (0.0, item))
+            fused[key] = (score + weight / (rrf_k + rank), first)
+    return sorted(((score, key, item) for key, (score, item) in fused.items()), key=lambda x: -x[0])
+
+
+class HybridRetriever(BaseRetriever):
+    """SegmentedVectorStore のベクトル検索と BM25 を RRF で融合する"""
+
+    vectorstore: Any
+    k: int = 4
+    fetch_k: int = HYBRID_FETCH_K
+    rrf_k: int = HYBRID_RRF_K
+    vector_weight: float = HYBRID_VECTOR_WEIGHT
+    lexical_weight: float = HYBRID_LEXICAL_WEIGHT
+    search_filter: dict | None = None
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list:
+        store = self.vectorstore
+        fetch_k = max(self.fetch_k, self.k)
+        vector_hits = store.vector_hits(store.embedding.embed_query(query), fetch_k, self.search_filter)
+        lexical_hits = store.lexical_hits(query, fetch_k, self.search_filter) if self.lexical_weight > 0 else []
+
+        fused = reciprocal_rank_fusion(
+            [[(hit[1], hit) for hit in vector_hits], [(hit[1], hit) for hit in lexical_hits]],
+            [self.vector_weight, self.lexical_weight],
+            self.rrf_k,
+        )[:self.k]
+        hits = [hit for _, _, hit in fused]
+        return [doc for doc in store.documents_for(hits) if doc is not None]
+
+
+def make_retriever(vectorstore, k: int = 4, search_filter: dict | None = None):
+    """ハイブリッド検索が使えるストアなら HybridRetriever、それ以外は通常のベクトル検索"""
+    if HYBRID_SEARCH_ENABLED and hasattr(vectorstore, "lexical_hits"):
+        return HybridRetriever(vectorstore=vectorstore, k=k, search_filter=search_filter)
+    search_kwargs = {"k": k}
+    if search_filter:
+        search_kwargs["filter"] = search_filter
+    return vectorstore.as_retriever(search_kwargs=search_kwargs)
@@ -0,0 +1,83 @@
+"""
+ベクトルストアのバージョン管理。
+
+取り込み・削除・再構築のたびに bump_version() でバージョンを進め、
+登録済みのリスナー（回答キャッシュなど）へ変更を通知する。
+バージョンはファイルにも書き出すので、同じホストの他ワーカーも変更を検知できる。
+
+- version: 取り込み・削除のたびに進む
+- generation: インデックス全体が作り直されたとき（sources=None）だけ進む
+"""
+
+import os
+import time
+import uuid
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+VERSION_PATH = os.path.join("rag", "vectorstore", "index.version")
+
+_lock = threading.Lock()
+_listeners: list = []
+_cached = {"version": None, "generation": None, "mtime": None}
+
+
+def _read_version_file():
+    try:
+        mtime = os.stat(VERSION_PATH).st_mtime_ns
+    except OSError:
+        return _cached["version"] or "0", _cached["generation"] or "0"
+    if _cached["mtime"] != mtime:
+        with open(VERSION_PATH, encoding="utf-8") as f:
+            lines = f.read().split()
+        _cached["version"] = lines[0] if lines else "0"
+        _cached["generation"] = lines[1] if len(lines) > 1 else _cached["version"]
+        _cached["mtime"] = mtime
+    return _cached["version"], _cached["generation"]
+
+
+def current_version() -> str:
+    """現在のインデックスバージョン"""
+    with _lock:
+        return _read_version_file()[0]
+
+
+def current_generation() -> str:
+    """インデックス全体を作り直したときだけ変わる世代"""
+    with _lock:
+        return _read_version_file()[1]
+
+
+def bump_version(sources: list[str] | None = None) -> str:
+    """
+    インデックスが変わったことを記録してリスナーへ通知する。
+    sources: 変更のあったファイル名（None は全体が変わったことを表す）
+    """
+    version = f"{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}"
+    with _lock:
+        generation = version if sources is None else _read_version_file()[1]
+        os.makedirs(os.path.dirname(VERSION_PATH), exist_ok=True)
+        tmp_path = f"{VERSION_PATH}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(f"{version}\n{generation}\n")
+        os.replace(tmp_path, VERSION_PATH)
+        _cached["version"] = version
+        _cached["generation"] = generation
+        _cached["mtime"] = os.stat(VERSION_PATH).st_mtime_ns
+        listeners = list(_listeners)
+
+    for callback in listeners:
+        try:
+            callback(version, sources)
+        except Exception as e:
+            logger.error(f"Index change listener failed: {e}")
+    return version
+
+
+def on_change(callback):
+    """callback(version, sources) をインデックス変更時に呼ぶよう登録する"""
+    with _lock:
+        _listeners.append(callback)
+    return callback
@@ -0,0 +1,322 @@
+"""
+PDF 取り込みジョブのキューと進捗管理。
+
+/upload/ingest はファイルを保存してジョブを登録したらすぐ job_id を返し、
+取り込み（PDF 解析 → チャンク分割 → 埋め込み → セグメント保存）は上限付きのワーカープールで行う。
+ジョブは SQLite に記録するので、再起動しても状態を確認でき、未完了のジョブは起動時に再投入される。
+
+同じ DB を複数のプロセス（uvicorn のワーカー・再起動前後のプロセス）が使うので、ジョブは実行前に
+条件付き UPDATE で取得（claim）する。取得したプロセスは owner と heartbeat（リース）を書き、
+実行中は INGEST_JOB_LEASE_SECONDS より短い間隔で heartbeat を更新する。
+queued のジョブと、heartbeat が途切れた（リースが切れた）running のジョブだけが取得できるので、
+1 つのジョブが同時に 2 回取り込まれることはない。
+
+stage: queued → parsing → chunking → embedding → saving → done（失敗時は failed）
+同じ内容の PDF が取り込み済みなら stage=skipped で終わる（skipped=1, duplicate_of に既存の出典名）
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+INGEST_JOBS_DB = os.environ.get("INGEST_JOBS_DB", os.path.join("rag", "jobs", "ingest_jobs.db"))
+INGEST_JOBS_DIR = os.environ.get("INGEST_JOBS_DIR", os.path.join("rag", "jobs", "uploads"))
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", "2"))
+# running のジョブの heartbeat がこの秒数途切れたら、持ち主のプロセスは落ちたとみなして取り直せる
+INGEST_JOB_LEASE_SECONDS = float(os.environ.get("INGEST_JOB_LEASE_SECONDS", "120"))
+
+JOB_COLUMNS = (
+    "id", "filename", "path", "status", "stage", "pages_parsed", "chunks_total",
+    "chunks_embedded", "added_docs", "error", "created_at", "updated_at", "finished_at",
+    "sha256", "skipped", "duplicate_of", "replace_existing", "metadata",
+    "tenant", "owner", "heartbeat",
+)
+# 既存の DB に後から足した列
+ADDED_COLUMNS = {
+    "sha256": "TEXT",
+    "skipped": "INTEGER DEFAULT 0",
+    "duplicate_of": "TEXT",
+    "replace_existing": "INTEGER DEFAULT 0",
+    "metadata": "TEXT",
+    "tenant": "TEXT",
+    "owner": "TEXT",
+    "heartbeat": "REAL",
+}
+ACTIVE_STATUSES = ("queued", "running")
+
+
+class IngestJobStore:
+    """ジョブテーブル（SQLite / WAL）"""
+
+    def __init__(self, db_path: str = INGEST_JOBS_DB):
+        self.db_path = db_path
+        self._init_db()
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _init_db(self):
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS ingest_jobs (
+                    id TEXT PRIMARY KEY,
+                    filename TEXT,
+                    path TEXT,
+                    status TEXT,
+                    stage TEXT,
+                    pages_parsed INTEGER DEFAULT 0,
+                    chunks_total INTEGER DEFAULT 0,
+                    chunks_embedded INTEGER DEFAULT 0,
+                    added_docs INTEGER,
+                    error TEXT,
+                    created_at REAL,
+                    updated_at REAL,
+                    finished_at REAL
+                )
+            """)
+            existing = {row[1] for row in conn.execute("PRAGMA table_info(ingest_jobs)")}
+            for name, decl in ADDED_COLUMNS.items():
+                if name not in existing:
+                    conn.execute(f"ALTER TABLE ingest_jobs ADD COLUMN {name} {decl}")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_ingest_jobs_status ON ingest_jobs(status)")
+
+    def create(self, filename: str, path: str, job_id: str | None = None, replace: bool = False,
+               metadata: dict | None = None, tenant: str | None = None) -> dict:
+        job_id = job_id or uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO ingest_jobs (id, filename, path, status, stage, replace_existing, metadata, tenant, "
+                "created_at, updated_at) VALUES (?, ?, ?, 'queued', 'queued', ?, ?, ?, ?, ?)",
+                (job_id, filename, path, int(replace),
+                 json.dumps(metadata, ensure_ascii=False) if metadata else None, tenant, now, now),
+            )
+        return self.get(job_id)
+
+    def update(self, job_id: str, **fields):
+        unknown = set(fields) - set(JOB_COLUMNS)
+        if unknown:
+            raise ValueError(f"unknown job fields: {sorted(unknown)}")
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._connect() as conn:
+            conn.execute(f"UPDATE ingest_jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def claim(self, job_id: str, owner: str, lease_seconds: float = INGEST_JOB_LEASE_SECONDS) -> bool:
+        """queued、またはリースの切れた running のジョブを owner のものにする（取れたら True）"""
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE ingest_jobs SET status = 'running', stage = 'parsing', error = NULL, owner = ?, "
+                "heartbeat = ?, updated_at = ? WHERE id = ? AND (status = 'queued' OR (status = 'running' "
+                "AND (heartbeat IS NULL OR heartbeat < ?)))",
+                (owner, now, now, job_id, now - lease_seconds),
+            )
+            return cursor.rowcount == 1
+
+    def heartbeat(self, job_ids, owner: str):
+        """owner が実行中のジョブのリースを延ばす"""
+        job_ids = list(job_ids)
+        if not job_ids:
+            return
+        with self._connect() as conn:
+            conn.execute(
+                f"UPDATE ingest_jobs SET heartbeat = ? WHERE owner = ? AND status = 'running' "
+                f"AND id IN ({','.join('?' * len(job_ids))})",
+                (time.time(), owner, *job_ids),
+            )
+
+    def get(self, job_id: str) -> dict | None:
+        with self._connect() as conn:
+            row = conn.execute(
+                f"SELECT {', '.join(JOB_COLUMNS)} FROM ingest_jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return dict(zip(JOB_COLUMNS, row)) if row else None
+
+    def list(self, limit: int = 50, statuses: tuple | None = None) -> list[dict]:
+        query = f"SELECT {', '.join(JOB_COLUMNS)} FROM ingest_jobs"
+        params: list = []
+        if statuses:
+            query += f" WHERE status IN ({','.join('?' * len(statuses))})"
+            params.extend(statuses)
+        query += " ORDER BY created_at DESC LIMIT ?"
+        params.append(limit)
+        with self._connect() as conn:
+            return [dict(zip(JOB_COLUMNS, row)) for row in conn.execute(query, params)]
+
+
+class IngestJobQueue:
+    """ジョブを上限付きスレッドプールで実行する
+
+    ingest_fn(path, source_name=..., progress=..., replace=..., metadata=..., tenant=...) は取り込んだチャンク数、
+    または rag.ingested_text.ingest_pdf と同じ形の dict を返す。
+    progress(stage, **counts) で途中経過をジョブテーブルに書き込む。
+    """
+
+    def __init__(self, store: IngestJobStore, ingest_fn=None, max_workers: int = INGEST_WORKERS,
+                 upload_dir: str = INGEST_JOBS_DIR, lease_seconds: float = INGEST_JOB_LEASE_SECONDS):
+        self.store = store
+        self.upload_dir = upload_dir
+        self.lease_seconds = lease_seconds
+        # ジョブの持ち主（プロセスとキューごとに一意）
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._ingest_fn = ingest_fn
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="ingest")
+        self._futures: dict = {}
+        self._running: set = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        os.makedirs(upload_dir, exist_ok=True)
+        threading.Thread(target=self._heartbeat_loop, name="ingest-heartbeat", daemon=True).start()
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.lease_seconds / 4):
+            with self._lock:
+                running = list(self._running)
+            try:
+                self.store.heartbeat(running, self.owner)
+            except Exception as e:
+                logger.warning(f"⚠️ Ingest job heartbeat failed: {e}")
+
+    @property
+    def ingest_fn(self):
+        if self._ingest_fn is None:
+            from rag.ingested_text import ingest_pdf
+            self._ingest_fn = ingest_pdf
+        return self._ingest_fn
+
+    def job_path(self, job_id: str) -> str:
+        return os.path.join(self.upload_dir, f"{job_id}.pdf")
+
+    def submit_bytes(self, filename: str, data: bytes, replace: bool = False, metadata: dict | None = None,
+                     tenant: str | None = None) -> dict:
+        """アップロードされた PDF を保存してジョブを登録する（replace=True なら同名の既存文書を差し替える）
+
+        metadata: 全チャンクに付けるメタデータ（customer / tags など）
+        tenant: 取り込み先のテナントのシャード（省略時は共有ストア）
+        """
+        job_id = uuid.uuid4().hex
+        path = self.job_path(job_id)
+        with open(path, "wb") as f:
+            f.write(data)
+        job = self.store.create(filename, path, job_id=job_id, replace=replace, metadata=metadata, tenant=tenant)
+        self._enqueue(job_id)
+        return job
+
+    def _enqueue(self, job_id: str):
+        with self._lock:
+            future = self._executor.submit(self._run, job_id)
+            self._futures[job_id] = future
+        future.add_done_callback(lambda _: self._forget(job_id))
+        return future
+
+    def _forget(self, job_id: str):
+        with self._lock:
+            self._futures.pop(job_id, None)
+
+    def future(self, job_id: str):
+        with self._lock:
+            return self._futures.get(job_id)
+
+    def _run(self, job_id: str):
+        # 他のプロセス（または再投入した側）が先に取っていれば何もしない
+        if not self.store.claim(job_id, self.owner, self.lease_seconds):
+            logger.info(f"Ingest job {job_id} is owned by another worker, skipping")
+            return None
+        job = self.store.get(job_id)
+        if not os.path.exists(job["path"] or ""):
+            self.store.update(job_id, status="failed", stage="failed",
+                              error="uploaded file was lost before ingestion finished", finished_at=time.time())
+            return self.store.get(job_id)
+        with self._lock:
+            self._running.add(job_id)
+
+        def progress(stage: str, **counts):
+            self.store.update(job_id, stage=stage, **counts)
+
+        try:
+            result = self.ingest_fn(job["path"], source_name=job["filename"], progress=progress,
+                                    replace=bool(job["replace_existing"]),
+                                    metadata=json.loads(job["metadata"]) if job["metadata"] else None,
+                                    tenant=job["tenant"])
+            if not isinstance(result, dict):
+                result = {"added_docs": result}
+            skipped = bool(result.get("skipped"))
+            self.store.update(job_id, status="succeeded", stage="skipped" if skipped else "done",
+                              added_docs=result.get("added_docs", 0), sha256=result.get("sha256"),
+                              skipped=int(skipped), duplicate_of=result.get("duplicate_of"),
+                              finished_at=time.time())
+            detail = "skipped, already ingested" if skipped else f"{result.get('added_docs', 0)} chunks"
+            logger.info(f"✅ Ingest job {job_id} finished: {job['filename']} ({detail})")
+        except Exception as e:
+            self.store.update(job_id, status="failed", stage="failed", error=str(e), finished_at=time.time())
+            logger.error(f"❌ Ingest job {job_id} failed: {e}")
+        finally:
+            with self._lock:
+                self._running.discard(job_id)
+            if os.path.exists(job["path"]):
+                os.remove(job["path"])
+        return self.store.get(job_id)
+
+    def resume(self) -> int:
+        """前回のプロセスで終わらなかったジョブ（queued と、リースの切れた running）を再投入する
+
+        heartbeat が続いている running のジョブは、まだ動いている他のプロセスのものなので触らない。
+        実際に実行するのは claim できたプロセスだけ。
+        """
+        resumed = 0
+        stale_before = time.time() - self.lease_seconds
+        for job in self.store.list(limit=1000, statuses=ACTIVE_STATUSES):
+            if self.future(job["id"]) is not None:
+                continue
+            if job["status"] == "running" and job["heartbeat"] is not None and job["heartbeat"] >= stale_before:
+                continue
+            self._enqueue(job["id"])
+            resumed += 1
+        if resumed:
+            logger.info(f"Resumed {resumed} unfinished ingest jobs")
+        return resumed
+
+    def stats(self) -> dict:
+        with self._lock:
+            in_flight = len(self._futures)
+        return {
+            "workers": self._executor._max_workers,
+            "in_flight": in_flight,
+            "db": self.store.db_path,
+        }
+
+    def shutdown(self, wait: bool = False):
+        self._executor.shutdown(wait=wait)
+        self._stop.set()
+
+
+_queue: IngestJobQueue | None = None
+_queue_lock = threading.Lock()
+
+
+def get_ingest_queue() -> IngestJobQueue:
+    """プロセス共通の取り込みジョブキュー"""
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = IngestJobQueue(IngestJobStore(INGEST_JOBS_DB))
+    return _queue
@@ -1,21 +1,26 @@
 import os
 import logging
 import sys
+import threading
 import traceback
+from contextlib import contextmanager
 from pathlib import Path
 
-from langchain_community.document_loaders.pdf import PyPDFLoader
-from langchain_community.vectorstores import FAISS
-from langchain_core.embeddings import Embeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import numpy as np
+
 from langchain.prompts import PromptTemplate
 from langchain.chains import RetrievalQA
-from sentence_transformers import SentenceTransformer
 from langchain.schema import Document
 
-# 環境変数から GCS バケット名を取得
-GCS_BUCKET = os.environ.get("GCS_BUCKET_NAME", "")
-GCS_VEC_DIR = "vectorstore"
+# MyEmbedding は後方互換のためここからも import できるようにしておく
+from rag.embeddings import MyEmbedding, get_embedding
+from rag.index_version import bump_version
+from rag.segment_store import SegmentedVectorStore
+from rag.chunking import load_pdf_pages, split_documents
+from rag.file_registry import file_sha256
+from rag.gcs_sync import get_gcs_sync
+from rag.rerank import build_retriever
+from rag.tenant_shards import get_tenant_shards
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -24,85 +29,71 @@ logging.basicConfig(level=logging.INFO)
 LOCAL_VECTOR_DIR = "rag/vectorstore"
 INDEX_NAME = "index"
 
-# GCS関連の関数
-def _get_gcs_client():
-    try:
-        from google.cloud import storage
-        return storage.Client()
-    except Exception as e:
-        logger.warning(f"GCS client creation failed: {e}")
-        return None
+# RAG で LLM に渡すチャンク数
+RAG_TOP_K = 3
+PROMPT_TEMPLATE_PATH = "rag/prompt_template.txt"
+
+# 取り込み時に一度に埋め込むチャンク数（この単位で進捗を更新する）
+INGEST_EMBED_BATCH_SIZE = int(os.environ.get("INGEST_EMBED_BATCH_SIZE", "64"))
 
+_vectorstore: SegmentedVectorStore | None = None
+_vectorstore_lock = threading.Lock()
+_ingest_locks: dict = {}  # (テナント, sha256) → [ロック, 使っている数]（取り込み中の文書だけ）
+_ingest_locks_guard = threading.Lock()
+
+# GCS関連の関数（差分同期の実体は rag/gcs_sync.py）
 def upload_vectorstore_to_gcs(local_dir: str):
-    """ベクトルストアをGCSにアップロード"""
-    if not GCS_BUCKET:
+    """ベクトルストアをGCSにアップロード（変わったファイルだけ・同期実行）"""
+    sync = get_gcs_sync(local_dir)
+    if sync is None:
         logger.info("GCS_BUCKET_NAME not set, skipping upload")
         return
     
     try:
-        client = _get_gcs_client()
-        if not client:
-            return
-            
-        bucket = client.bucket(GCS_BUCKET)
-        
-        for fname in (f"{INDEX_NAME}.faiss", f"{INDEX_NAME}.pkl"):
-            local_path = os.path.join(local_dir, fname)
-            if os.path.exists(local_path):
-                blob_path = f"{GCS_VEC_DIR}/{fname}"
-                blob = bucket.blob(blob_path)
-                blob.upload_from_filename(local_path)
-                logger.info(f"✅ Uploaded to GCS: gs://{GCS_BUCKET}/{blob_path}")
+        sync.upload()
     except Exception as e:
         logger.error(f"GCS upload error: {e}")
 
+def schedule_vectorstore_upload(local_dir: str = LOCAL_VECTOR_DIR):
+    """取り込み後のアップロードを予約（デバウンスしてバックグラウンドで実行）"""
+    sync = get_gcs_sync(local_dir)
+    if sync is not None:
+        sync.schedule_upload()
+
 def download_vectorstore_from_gcs(local_dir: str):
-    """GCSからベクトルストアをダウンロード"""
-    if not GCS_BUCKET:
+    """GCSからベクトルストアをダウンロード（manifest が変わっていれば差分だけ取得）"""
+    sync = get_gcs_sync(local_dir)
+    if sync is None:
         logger.info("GCS_BUCKET_NAME not set, skipping download")
         return False
     
     try:
-        client = _get_gcs_client()
-        if not client:
-            return False
-            
-        bucket = client.bucket(GCS_BUCKET)
-        os.makedirs(local_dir, exist_ok=True)
-        
-        downloaded = False
-        for fname in (f"{INDEX_NAME}.faiss", f"{INDEX_NAME}.pkl"):
-            blob_path = f"{GCS_VEC_DIR}/{fname}"
-            blob = bucket.blob(blob_path)
-            local_path = os.path.join(local_dir, fname)
-            
-            if blob.exists():
-                blob.download_to_filename(local_path)
-                logger.info(f"✅ Downloaded from GCS: {blob_path}")
-                downloaded = True
-                
-        return downloaded
+        return sync.download()
     except Exception as e:
         logger.error(f"GCS download error: {e}")
         return False
 
-class MyEmbedding(Embeddings):
-    """カスタム埋め込みクラス"""
-    def __init__(self, model_name: str):
-        self.model = SentenceTransformer(model_name)
-    
-    def embed_documents(self, texts):
-        return self.model.encode(texts, show_progress_bar=False).tolist()
-    
-    def embed_query(self, text):
-        return self.model.encode(text).tolist()
+def get_vectorstore(tenant: str | None = None) -> SegmentedVectorStore:
+    """プロセス共通のベクトルストア（取り込みと検索で同じインスタンスを使う）
+
+    tenant: 指定するとそのテナントのシャード（rag/tenant_shards.py。初回に GCS から取得して開く）
+    """
+    if tenant:
+        return get_tenant_shards().get(tenant)
+    global _vectorstore
+    if _vectorstore is None:
+        with _vectorstore_lock:
+            if _vectorstore is None:
+                _vectorstore = SegmentedVectorStore.load(LOCAL_VECTOR_DIR, get_embedding())
+                sync = get_gcs_sync(LOCAL_VECTOR_DIR)
+                if sync is not None:
+                    sync.attach_store(_vectorstore)
+    return _vectorstore
 
 def create_initial_vectorstore():
     """初期ベクトルストアを作成"""
     logger.info("Creating initial vectorstore...")
     
-    embeddings = MyEmbedding("intfloat/multilingual-e5-small")
-    
     # 初期ドキュメント
     initial_docs = [
         Document(
@@ -119,11 +110,9 @@ def create_initial_vectorstore():
         )
     ]
     
-    vectorstore = FAISS.from_documents(initial_docs, embeddings)
-    
-    # ローカルに保存
-    os.makedirs(LOCAL_VECTOR_DIR, exist_ok=True)
-    vectorstore.save_local(LOCAL_VECTOR_DIR, index_name=INDEX_NAME)
+    vectorstore = get_vectorstore()
+    vectorstore.add_documents(initial_docs)
+    bump_version()
     
     # GCSにアップロード
     upload_vectorstore_to_gcs(LOCAL_VECTOR_DIR)
@@ -131,29 +120,25 @@ def create_initial_vectorstore():
     logger.info("✅ Initial vectorstore created")
     return vectorstore
 
-def load_vectorstore():
-    """ベクトルストアを読み込み"""
+def load_vectorstore(download: bool = True):
+    """ベクトルストアを読み込み
+
+    download: 先に GCS から取得する（起動処理では取得を別のステップで並行に済ませるので False）
+    """
     try:
         # GCSからダウンロードを試みる
-        downloaded = download_vectorstore_from_gcs(LOCAL_VECTOR_DIR)
+        if download:
+            download_vectorstore_from_gcs(LOCAL_VECTOR_DIR)
         
-        # ローカルファイルの存在確認
-        index_path = os.path.join(LOCAL_VECTOR_DIR, f"{INDEX_NAME}.faiss")
+        # 既存のベクトルストアを読み込み（旧形式なら初回にセグメントへ移行）
+        vectorstore = get_vectorstore()
+        vectorstore.reload()
         
-        if not os.path.exists(index_path):
+        if len(vectorstore) == 0:
             logger.info("Vectorstore not found, creating initial one...")
             return create_initial_vectorstore()
         
-        # 既存のベクトルストアを読み込み
-        embeddings = MyEmbedding("intfloat/multilingual-e5-small")
-        vectorstore = FAISS.load_local(
-            LOCAL_VECTOR_DIR,
-            embeddings,
-            index_name=INDEX_NAME,
-            allow_dangerous_deserialization=True
-        )
-        
-        logger.info("✅ Vectorstore loaded successfully")
+        logger.info(f"✅ Vectorstore loaded successfully: {vectorstore.stats()}")
         return vectorstore
         
     except Exception as e:
@@ -161,78 +146,210 @@ def load_vectorstore():
         # エラー時は初期ベクトルストアを作成
         return create_initial_vectorstore()
 
-def ingest_pdf_to_vectorstore(pdf_path: str):
-    """PDFをベクトルストアに追加"""
+@contextmanager
+def _ingest_lock(sha256: str, tenant: str | None = None):
+    """同じ文書の同時取り込みを 1 つずつにする（誰も使わなくなったロックは表から外す）"""
+    key = (tenant, sha256)
+    with _ingest_locks_guard:
+        entry = _ingest_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
     try:
-        # PDF読み込み
-        loader = PyPDFLoader(pdf_path)
-        docs = loader.load()
-        
-        # テキスト分割
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=500,
-            chunk_overlap=100,
-            separators=["\n\n", "\n", "。", "！", "？", "、", " ", ""]
-        )
-        documents = splitter.split_documents(docs)
-        
-        # 埋め込みモデル
-        embeddings = MyEmbedding("intfloat/multilingual-e5-small")
-        
-        # 既存のベクトルストアを読み込み
-        os.makedirs(LOCAL_VECTOR_DIR, exist_ok=True)
-        index_path = os.path.join(LOCAL_VECTOR_DIR, f"{INDEX_NAME}.faiss")
-        
-        if os.path.exists(index_path):
-            vectorstore = FAISS.load_local(
-                LOCAL_VECTOR_DIR,
-                embeddings,
-                index_name=INDEX_NAME,
-                allow_dangerous_deserialization=True
-            )
-            vectorstore.add_documents(documents)
-        else:
-            vectorstore = FAISS.from_documents(documents, embeddings)
-        
-        # 保存
-        vectorstore.save_local(LOCAL_VECTOR_DIR, index_name=INDEX_NAME)
-        logger.info(f"✅ Added {len(documents)} documents from {os.path.basename(pdf_path)}")
+        with entry[0]:
+            yield
+    finally:
+        with _ingest_locks_guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _ingest_locks[key]
+
+def _after_change(sources: list[str], tenant: str | None = None):
+    """インデックス変更後の通知と GCS アップロードの予約"""
+    if tenant:
+        # テナントの回答はキャッシュしないので、共有ストアのキャッシュは無効にしない
+        sync = get_tenant_shards().sync(tenant)
+        if sync is not None:
+            sync.schedule_upload()
+        return
+    # 回答キャッシュなどへインデックス変更を通知
+    bump_version(sources=sources)
+    # GCSへのアップロードはバックグラウンドで（連続取り込みは 1 回にまとまる）
+    schedule_vectorstore_upload(LOCAL_VECTOR_DIR)
+
+def find_ingested(sha256: str, tenant: str | None = None) -> dict | None:
+    """同じ内容の PDF が取り込み済みなら台帳のエントリを返す"""
+    vectorstore = get_vectorstore(tenant)
+    # 他ワーカーでの取り込みも反映する（manifest が変わっていなければ stat だけ）
+    vectorstore.refresh()
+    return vectorstore.ingested_file(sha256)
+
+def ingest_pdf(pdf_path: str, source_name: str | None = None, progress=None, replace: bool = False,
+               metadata: dict | None = None, tenant: str | None = None) -> dict:
+    """PDFをベクトルストアに追加（新しいセグメントを 1 つ書き出すだけ）
+
+    同じ内容（SHA-256）の PDF が取り込み済みなら何もしない。
+    source_name: 出典として記録するファイル名（省略時は pdf_path のファイル名）
+    progress: progress(stage, **counts) で途中経過を受け取るコールバック（取り込みジョブ用）
+    replace: 同じ出典名の既存チャンクを、新しいチャンクの追加と同時に削除する（差し替え）
+    metadata: 全チャンクに付けるメタデータ（customer / tags など。検索の絞り込みに使える）
+    tenant: 取り込み先のテナント（省略時は共有ストア）
+    戻り値: {"added_docs", "skipped", "sha256", "duplicate_of", "document_id"}
+        document_id は取り込み台帳のキー（内容の SHA-256）。/chat の document_ids でこの文書だけを検索できる
+    """
+    source_name = source_name or os.path.basename(pdf_path)
+    report = progress or (lambda stage, **counts: None)
+    sha256 = file_sha256(pdf_path)
+    result = {"added_docs": 0, "skipped": False, "sha256": sha256, "duplicate_of": None, "document_id": None}
+    try:
+        with _ingest_lock(sha256, tenant):
+            duplicate = find_ingested(sha256, tenant)
+            if duplicate is not None:
+                logger.info(f"Skip ingest: {source_name} is identical to already ingested {duplicate['source']}")
+                report("skipped")
+                return {**result, "skipped": True, "duplicate_of": duplicate["source"], "document_id": sha256}
+            
+            # PDF読み込み
+            report("parsing")
+            docs = load_pdf_pages(pdf_path, source_name)
+            for doc in docs:
+                doc.metadata.update({k: v for k, v in (metadata or {}).items() if v is not None})
+            report("chunking", pages_parsed=len(docs))
+            
+            # テキスト分割（一括取り込みと同じ設定）
+            documents = split_documents(docs)
+            if not documents:
+                logger.warning(f"No text extracted from {source_name}")
+                return result
+            report("embedding", chunks_total=len(documents))
+            
+            # 進捗を出せるようにバッチごとに埋め込む
+            vectorstore = get_vectorstore(tenant)
+            texts = [doc.page_content for doc in documents]
+            vectors = []
+            for start in range(0, len(texts), INGEST_EMBED_BATCH_SIZE):
+                vectors.extend(vectorstore.embeddings.embed_documents(texts[start:start + INGEST_EMBED_BATCH_SIZE]))
+                report("embedding", chunks_embedded=len(vectors))
+            
+            # 検索中のストアと同じインスタンスに追記する
+            report("saving")
+            added = vectorstore.add_embeddings(np.asarray(vectors, dtype="float32"), documents, files=[{
+                "sha256": sha256,
+                "source": source_name,
+                "count": len(documents),
+                "pages": len(docs),
+                "size": os.path.getsize(pdf_path),
+            }], replace_source=source_name if replace else None)
+            if not added:
+                # 他のワーカーが同じ PDF を先に取り込んだ（書き込みロックの中で台帳を見直した結果）
+                duplicate = find_ingested(sha256, tenant)
+                report("skipped")
+                return {**result, "skipped": True, "document_id": sha256,
+                        "duplicate_of": duplicate["source"] if duplicate else None}
+            logger.info(f"✅ Added {len(documents)} documents from {source_name}"
+                        + (f" (tenant={tenant})" if tenant else ""))
         
-        # GCSにアップロード
-        upload_vectorstore_to_gcs(LOCAL_VECTOR_DIR)
+        _after_change([source_name], tenant)
         
-        return len(documents)
+        return {**result, "added_docs": len(documents), "document_id": sha256}
         
     except Exception as e:
         logger.error(f"Error ingesting PDF: {e}")
         raise
 
-def get_rag_chain(vectorstore, return_source: bool = True):
-    """RAGチェーンを作成（エラーハンドリング強化版）"""
-    logger.info("Creating RAG chain...")
-    
+def ingest_pdf_to_vectorstore(pdf_path: str, source_name: str | None = None, progress=None,
+                              replace: bool = False, metadata: dict | None = None, tenant: str | None = None) -> int:
+    """PDFをベクトルストアに追加し、追加したチャンク数を返す（取り込み済みなら 0）"""
+    return ingest_pdf(pdf_path, source_name=source_name, progress=progress, replace=replace,
+                      metadata=metadata, tenant=tenant)["added_docs"]
+
+def unknown_documents(document_ids: list[str], tenant: str | None = None) -> list[str]:
+    """取り込み台帳にない文書 ID（削除・差し替え済みのものも含む）"""
+    vectorstore = get_vectorstore(tenant)
+    vectorstore.refresh()
+    return [doc_id for doc_id in document_ids if vectorstore.ingested_file(doc_id) is None]
+
+def delete_document(source_name: str, tenant: str | None = None) -> int:
+    """出典（ファイル名）のチャンクをすべて削除し、削除した件数を返す（該当セグメントだけを書き換える）"""
+    vectorstore = get_vectorstore(tenant)
+    removed = vectorstore.delete_source(source_name)
+    if removed:
+        logger.info(f"✅ Deleted {removed} chunks of {source_name}")
+        _after_change([source_name], tenant)
+    return removed
+
+def list_documents(tenant: str | None = None) -> list[dict]:
+    """ベクトルストアに入っている出典の一覧（チャンク数つき）"""
+    vectorstore = get_vectorstore(tenant)
+    vectorstore.refresh()
+    return vectorstore.sources()
+
+def load_prompt() -> PromptTemplate:
+    """RAG 用プロンプトテンプレート（get_rag_chain と /chat/stream で共通）"""
     try:
-        # LLMをロード
-        from llm.llm_runner import load_llm
-        llm, _, _ = load_llm()
-        
-        # プロンプトテンプレート
-        try:
-            with open("rag/prompt_template.txt", encoding="utf-8") as f:
-                prompt_str = f.read()
-        except:
-            prompt_str = """以下のコンテキストを使用して質問に答えてください。
+        with open(PROMPT_TEMPLATE_PATH, encoding="utf-8") as f:
+            prompt_str = f.read()
+    except:
+        prompt_str = """以下のコンテキストを使用して質問に答えてください。
 
 コンテキスト: {context}
 
 質問: {question}
 
 回答（日本語で分かりやすく）:"""
+
+    return PromptTemplate(
+        input_variables=["context", "question"],
+        template=prompt_str
+    )
+
+def format_context(docs) -> str:
+    """stuff チェーンと同じ形式でコンテキストを連結"""
+    return "\n\n".join(doc.page_content for doc in docs)
+
+class SimpleSearchChain:
+    """LLM なしで検索結果だけを返すチェーン（RetrievalQA と同じ入出力形式）"""
+    def __init__(self, vectorstore, search_filter: dict | None = None):
+        self.vectorstore = vectorstore
+        self.retriever = build_retriever(vectorstore, search_filter=search_filter)
+        self.callbacks = []  # callbacksエラー回避
+
+    @staticmethod
+    def format_result(docs):
+        if docs:
+            result = "関連情報が見つかりました:\n\n"
+            for i, doc in enumerate(docs[:3], 1):
+                result += f"{i}. {doc.page_content[:200]}...\n"
+                result += f"   出典: {doc.metadata.get('source', '不明')} (p{doc.metadata.get('page', '?')})\n\n"
+        else:
+            result = "関連する情報が見つかりませんでした。"
+
+        return {
+            "result": result,
+            "source_documents": docs[:3]
+        }
+
+    def invoke(self, inputs):
+        query = inputs.get("query", "")
+        return self.format_result(self.retriever.get_relevant_documents(query))
+
+    async def ainvoke(self, inputs):
+        query = inputs.get("query", "")
+        return self.format_result(await self.retriever.ainvoke(query))
+
+def get_rag_chain(vectorstore, return_source: bool = True, llm=None):
+    """RAGチェーンを作成（エラーハンドリング強化版）
+
+    llm: 起動処理で作ったクライアント（省略時はプロセスで共有のものを使う）
+    """
+    logger.info("Creating RAG chain...")
+    
+    try:
+        # LLMをロード（作成済みならそれを使う）
+        if llm is None:
+            from llm.llm_runner import get_llm
+            llm, _, _ = get_llm()
         
-        prompt = PromptTemplate(
-            input_variables=["context", "question"],
-            template=prompt_str
-        )
+        # プロンプトテンプレート
+        prompt = load_prompt()
         
         # RAGチェーンを作成（シンプルな方法）
         from langchain.chains import RetrievalQA
@@ -240,9 +357,8 @@ def get_rag_chain(vectorstore, return_source: bool = True):
         rag_chain = RetrievalQA.from_chain_type(
             llm=llm,
             chain_type="stuff",
-            retriever=vectorstore.as_retriever(
-                search_kwargs={"k": 3}
-            ),
+            # ベクトル検索 + キーワード検索（BM25）を RRF で融合し、広めの候補を rerank して上位だけ渡す
+            retriever=build_retriever(vectorstore, k=RAG_TOP_K),
             return_source_documents=return_source,
             chain_type_kwargs={
                 "prompt": prompt,
@@ -262,32 +378,21 @@ def get_rag_chain(vectorstore, return_source: bool = True):
         logger.error(traceback.format_exc())
         
         # フォールバック: シンプルな検索のみのチェーンを返す
-        class SimpleSearchChain:
-            def __init__(self, vectorstore):
-                self.vectorstore = vectorstore
-                self.retriever = vectorstore.as_retriever()
-                self.callbacks = []  # callbacksエラー回避
-            
-            def invoke(self, inputs):
-                query = inputs.get("query", "")
-                docs = self.retriever.get_relevant_documents(query)
-                
-                if docs:
-                    result = "関連情報が見つかりました:\n\n"
-                    for i, doc in enumerate(docs[:3], 1):
-                        result += f"{i}. {doc.page_content[:200]}...\n"
-                        result += f"   出典: {doc.metadata.get('source', '不明')} (p{doc.metadata.get('page', '?')})\n\n"
-                else:
-                    result = "関連する情報が見つかりませんでした。"
-                
-                return {
-                    "result": result,
-                    "source_documents": docs[:3]
-                }
-        
         logger.warning("Returning simple search chain as fallback")
         return SimpleSearchChain(vectorstore)
 
+def filtered_chain(chain, vectorstore, search_filter: dict | None = None):
+    """チェーンの retriever だけを vectorstore（テナントのシャードなど）・メタデータの絞り込みに
+    差し替えたコピー（LLM・プロンプトは共有）"""
+    if isinstance(chain, SimpleSearchChain):
+        return SimpleSearchChain(vectorstore, search_filter=search_filter)
+    # pydantic の copy() では callbacks が落ちるので作り直す
+    return type(chain)(
+        combine_documents_chain=chain.combine_documents_chain,
+        retriever=build_retriever(vectorstore, k=RAG_TOP_K, search_filter=search_filter),
+        return_source_documents=chain.return_source_documents,
+    )
+
 # OpenAI APIキー取得（後方互換性のため残す）
 def get_openai_api_key():
     key = os.getenv("OPENAI_API_KEY")
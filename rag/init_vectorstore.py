@@ -3,14 +3,14 @@ import sys
 from pathlib import Path
 from langchain_community.document_loaders import PyPDFLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
 from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain.chains import RetrievalQA
 from langchain_community.llms import HuggingFacePipeline
 from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
 from langchain.schema import Document
-from sentence_transformers import SentenceTransformer
-from langchain_core.embeddings import Embeddings
+from rag.embeddings import MyEmbedding as _SharedEmbedding
+from rag.index_version import bump_version
+from rag.segment_store import SegmentedVectorStore
 
 # GCS設定
 try:
@@ -26,63 +26,32 @@ VECTOR_DIR = "rag/vectorstore"
 INDEX_NAME = "index"
 
 
-class MyEmbedding(Embeddings):
-    """ingested_text.pyと同じEmbeddingクラスを使用"""
-    def __init__(self, model_name: str):
-        self.model = SentenceTransformer(model_name)
-
+class MyEmbedding(_SharedEmbedding):
+    """ingested_text.pyと同じEmbeddingクラスを使用（モデルはプロセス内で共有）"""
     def embed_documents(self, texts):
         return self.model.encode(texts, show_progress_bar=True).tolist()
 
-    def embed_query(self, text):
-        return self.model.encode(text).tolist()
-
 
 def upload_to_gcs(local_dir: str):
-    """ベクトルストアをGCSにアップロード"""
+    """ベクトルストアをGCSにアップロード（manifest とセグメント単位。ingested_text.pyと共通）"""
     if not HAS_GCS:
         print("GCS設定がないためスキップします")
         return
-    
-    try:
-        client = storage.Client()
-        bucket = client.bucket(GCS_BUCKET)
-        
-        for fname in (f"{INDEX_NAME}.faiss", f"{INDEX_NAME}.pkl"):
-            local_path = os.path.join(local_dir, fname)
-            if os.path.exists(local_path):
-                blob_path = f"{GCS_VEC_DIR}/{fname}"
-                blob = bucket.blob(blob_path)
-                blob.upload_from_filename(local_path)
-                print(f"✅ GCSアップロード完了: gs://{GCS_BUCKET}/{blob_path}")
-    except Exception as e:
-        print(f"⚠️ GCSアップロードエラー: {e}")
+    from rag.ingested_text import upload_vectorstore_to_gcs
+    upload_vectorstore_to_gcs(local_dir)
 
 
 def download_from_gcs(local_dir: str):
-    """GCSからベクトルストアをダウンロード"""
+    """GCSからベクトルストアをダウンロード（ingested_text.pyと共通）"""
     if not HAS_GCS:
         return False
-    
-    try:
-        client = storage.Client()
-        bucket = client.bucket(GCS_BUCKET)
-        os.makedirs(local_dir, exist_ok=True)
-        
-        downloaded = False
-        for fname in (f"{INDEX_NAME}.faiss", f"{INDEX_NAME}.pkl"):
-            blob_path = f"{GCS_VEC_DIR}/{fname}"
-            blob = bucket.blob(blob_path)
-            local_path = os.path.join(local_dir, fname)
-            
-            if blob.exists():
-                blob.download_to_filename(local_path)
-                print(f"✅ GCSダウンロード完了: {blob_path}")
-                downloaded = True
-        return downloaded
-    except Exception as e:
-        print(f"⚠️ GCSダウンロードエラー: {e}")
-        return False
+    from rag.ingested_text import download_vectorstore_from_gcs
+    return download_vectorstore_from_gcs(local_dir)
+
+
+def _open_store() -> SegmentedVectorStore:
+    # 埋め込み済みの既存セグメントはそのまま、新しい文書だけを追記する
+    return SegmentedVectorStore.load(VECTOR_DIR, MyEmbedding("intfloat/multilingual-e5-small"))
 
 
 def create_initial_vectorstore():
@@ -92,9 +61,6 @@ def create_initial_vectorstore():
     # ディレクトリ作成
     os.makedirs(VECTOR_DIR, exist_ok=True)
     
-    # 埋め込みモデル（ingested_text.pyと同じものを使用）
-    embeddings = MyEmbedding("intfloat/multilingual-e5-small")
-    
     # ダミードキュメント
     dummy_docs = [
         Document(
@@ -108,8 +74,9 @@ def create_initial_vectorstore():
     ]
     
     # ベクトルストア作成
-    vectorstore = FAISS.from_documents(dummy_docs, embeddings)
-    vectorstore.save_local(VECTOR_DIR, index_name=INDEX_NAME)
+    vectorstore = _open_store()
+    vectorstore.add_documents(dummy_docs)
+    bump_version()
     
     print("✅ 初期ベクトルストアを作成しました")
     
@@ -127,26 +94,10 @@ def ingest_pdf_to_vectorstore(pdf_path: str):
     splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100)
     documents = splitter.split_documents(docs)
 
-    # MyEmbeddingを使用（ingested_text.pyと統一）
-    embeddings = MyEmbedding("intfloat/multilingual-e5-small")
-
-    # ベクトルストアのパス
-    index_path = os.path.join(VECTOR_DIR, f"{INDEX_NAME}.faiss")
-    
-    if os.path.exists(index_path):
-        # 既存のベクトルストアに追加
-        vectorstore = FAISS.load_local(
-            VECTOR_DIR, embeddings, 
-            index_name=INDEX_NAME, 
-            allow_dangerous_deserialization=True
-        )
-        vectorstore.add_documents(documents)
-    else:
-        # 新規作成
-        vectorstore = FAISS.from_documents(documents, embeddings)
-
-    # 保存
-    vectorstore.save_local(VECTOR_DIR, index_name=INDEX_NAME)
+    # 新しいセグメントとして追記（既存インデックスの読み書きはしない）
+    vectorstore = _open_store()
+    vectorstore.add_documents(documents)
+    bump_version(sources=[os.path.basename(pdf_path)])
     print(f"✅ {os.path.basename(pdf_path)} をベクトルストアに保存しました")
     
     # GCSにアップロード
@@ -162,19 +113,11 @@ def load_vectorstore():
     if HAS_GCS:
         download_from_gcs(VECTOR_DIR)
     
-    index_path = os.path.join(VECTOR_DIR, f"{INDEX_NAME}.faiss")
-    
-    if not os.path.exists(index_path):
+    vectorstore = _open_store()
+    if len(vectorstore) == 0:
         print("⚠️ ベクトルストアが見つかりません。初期化します...")
         return create_initial_vectorstore()
-    
-    # MyEmbeddingを使用
-    embeddings = MyEmbedding("intfloat/multilingual-e5-small")
-    return FAISS.load_local(
-        VECTOR_DIR, embeddings, 
-        index_name=INDEX_NAME, 
-        allow_dangerous_deserialization=True
-    )
+    return vectorstore
 
 
 # 🔹 RAGチェーン生成
@@ -274,7 +217,7 @@ if __name__ == "__main__":
             print(f"❌ エラー: {e}")
     else:
         # デフォルト: 初期化チェック
-        if not os.path.exists(os.path.join(VECTOR_DIR, f"{INDEX_NAME}.faiss")):
+        if len(_open_store()) == 0:
             print("ベクトルストアが存在しません。初期化します...")
             create_initial_vectorstore()
         else:
@@ -0,0 +1,67 @@
+"""
+日本語向けの文字 n-gram 転置インデックスと BM25。
+
+形態素解析器や外部サービスを使わず、NFKC 正規化した本文から
+- 文字 bigram（空白を除いた連続文字。カタカナ語・漢字熟語の部分一致に効く）
+- 英数字の連続（型番・規格番号。"ABC-1200" や "JIS" をそのまま 1 語にする）
+を語として数える。
+
+転置インデックスはセグメントの chunks.db に一緒に書き出す（rag/chunk_store.py）ので、
+取り込みのたびに新しいセグメントの分だけ作られ、ベクトルと同じように GCS へ同期される。
+BM25 の N・平均文書長・df は検索時に全セグメントの値を合計して使う。
+"""
+
+import os
+import re
+import math
+import unicodedata
+from collections import Counter
+
+BM25_K1 = float(os.environ.get("BM25_K1", "1.2"))
+BM25_B = float(os.environ.get("BM25_B", "0.75"))
+# 全チャンクのこの割合より多くに出る語（「ます」「する」など）は検索に使わない
+LEXICAL_MAX_DF_RATIO = float(os.environ.get("LEXICAL_MAX_DF_RATIO", "0.3"))
+LEXICAL_NGRAM = 2
+
+_WORD_RE = re.compile(r"[0-9a-z]+(?:[-_./][0-9a-z]+)*")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    return unicodedata.normalize("NFKC", text or "").lower()
+
+
+def tokenize(text: str) -> list[str]:
+    """本文・クエリを語の列にする（文字 bigram + 英数字の連続）"""
+    text = normalize(text)
+    tokens = [word for word in _WORD_RE.findall(text) if len(word) >= 2]
+    compact = _SPACE_RE.sub("", text)
+    if len(compact) < LEXICAL_NGRAM:
+        tokens.extend(compact)
+    else:
+        tokens.extend(compact[i:i + LEXICAL_NGRAM] for i in range(len(compact) - LEXICAL_NGRAM + 1))
+    return tokens
+
+
+def term_frequencies(text: str) -> tuple[Counter, int]:
+    """(語 → 出現回数, 文書長)"""
+    tokens = tokenize(text)
+    return Counter(tokens), len(tokens)
+
+
+def idf(n_docs: int, df: int) -> float:
+    return math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+
+
+def bm25_term(tf: int, doc_len: int, avg_len: float, term_idf: float) -> float:
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_len / (avg_len or 1.0))
+    return term_idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+
+def select_terms(query_terms, df: dict, n_docs: int, max_df_ratio: float = LEXICAL_MAX_DF_RATIO) -> list[str]:
+    """どこにでも出る語を落とす（全部落ちる短いクエリは一番まれな語だけ残す）"""
+    present = [t for t in dict.fromkeys(query_terms) if df.get(t)]
+    kept = [t for t in present if df[t] <= max_df_ratio * n_docs]
+    if not kept and present:
+        kept = [min(present, key=lambda t: df[t])]
+    return kept
@@ -0,0 +1,110 @@
+"""
+メタデータによる検索の絞り込み。
+
+チャンクの source / page / uploaded_at / customer / tags をセグメントの chunks.db の
+chunk_fields テーブル（フィールドごとの索引）に書き出し、フィルタから「対象 ID の集合」を SQL で引く。
+ベクトル検索は ID 集合からビットマップを作って FAISS の IDSelector として渡すので、
+多めに取ってから Python で捨てる必要がなく、絞り込んでも k 件そろって返る（rag/segment_store.py）。
+
+フィルタの形（条件はすべて AND。リストはいずれかに一致）:
+    {
+        "source": "仕様書.pdf" または ["a.pdf", "b.pdf"],
+        "customer": "A社" または [...],
+        "tags": "見積" または [...],
+        "page": 3 または {"gte": 1, "lte": 5},
+        "uploaded_at": {"gte": 1700000000.0, "lt": ...},   # UNIX 秒
+    }
+"""
+
+# フィールド名 → 値の種類（text は完全一致、num は範囲も可）
+FILTER_FIELDS = {
+    "source": "text",
+    "customer": "text",
+    "tags": "text",
+    "page": "num",
+    "uploaded_at": "num",
+}
+RANGE_OPS = {"gte": ">=", "gt": ">", "lte": "<=", "lt": "<"}
+
+
+def _as_list(value) -> list:
+    return list(value) if isinstance(value, (list, tuple, set)) else [value]
+
+
+def normalize_filter(search_filter: dict | None):
+    """フィルタを検証し、キャッシュのキーにできる正規形（tuple）にする。空なら None"""
+    if not search_filter:
+        return None
+    normalized = []
+    for field, cond in sorted(search_filter.items()):
+        if cond is None or cond == [] or cond == {}:
+            continue
+        kind = FILTER_FIELDS.get(field)
+        if kind is None:
+            raise ValueError(f"unknown filter field: {field}")
+        if isinstance(cond, dict):
+            if kind != "num" or not cond or set(cond) - set(RANGE_OPS):
+                raise ValueError(f"invalid range filter for {field}: {cond}")
+            normalized.append((field, "range", tuple(sorted((op, float(v)) for op, v in cond.items()))))
+        elif kind == "num":
+            normalized.append((field, "in", tuple(sorted(float(v) for v in _as_list(cond)))))
+        else:
+            normalized.append((field, "in", tuple(sorted(str(v) for v in _as_list(cond)))))
+    return tuple(normalized) or None
+
+
+def field_rows(metadata: dict) -> list[tuple]:
+    """chunk_fields に書く行 [(field, 文字列値, 数値), ...]"""
+    rows = []
+    for field, kind in FILTER_FIELDS.items():
+        value = metadata.get(field)
+        if value is None:
+            continue
+        for v in _as_list(value):
+            if kind == "num":
+                try:
+                    rows.append((field, None, float(v)))
+                except (TypeError, ValueError):
+                    continue
+            else:
+                rows.append((field, str(v), None))
+    return rows
+
+
+def condition_sql(field: str, op: str, values: tuple) -> tuple[str, list]:
+    """1 条件ぶんの「doc_id を返す SELECT」"""
+    if op == "range":
+        clauses = " AND ".join(f"num {RANGE_OPS[o]} ?" for o, _ in values)
+        return f"SELECT doc_id FROM chunk_fields WHERE field = ? AND {clauses}", [field, *(v for _, v in values)]
+    column = "num" if FILTER_FIELDS[field] == "num" else "value"
+    placeholders = ",".join("?" * len(values))
+    return f"SELECT doc_id FROM chunk_fields WHERE field = ? AND {column} IN ({placeholders})", [field, *values]
+
+
+def filter_sql(normalized: tuple) -> tuple[str, list]:
+    """全条件の AND（INTERSECT）"""
+    parts, params = [], []
+    for field, op, values in normalized:
+        sql, p = condition_sql(field, op, values)
+        parts.append(sql)
+        params.extend(p)
+    return " INTERSECT ".join(parts), params
+
+
+def matches(metadata: dict, normalized: tuple | None) -> bool:
+    """索引のない古いセグメント用に、メタデータを直接判定する"""
+    if not normalized:
+        return True
+    rows = field_rows(metadata)
+    for field, op, values in normalized:
+        present = [num if FILTER_FIELDS[field] == "num" else value for f, value, num in rows if f == field]
+        if op == "range":
+            if not any(all(_compare(v, o, bound) for o, bound in values) for v in present):
+                return False
+        elif not any(v in values for v in present):
+            return False
+    return True
+
+
+def _compare(value: float, op: str, bound: float) -> bool:
+    return {"gte": value >= bound, "gt": value > bound, "lte": value <= bound, "lt": value < bound}[op]
@@ -0,0 +1,222 @@
+"""
+検索結果の並べ直し（rerank）。
+
+retriever から広めに候補（RERANK_CANDIDATES 件）を取り、差し替え可能なスコアラーで採点して
+上位 top_n 件だけを LLM に渡す。採点が時間予算（RERANK_BUDGET_MS）を超えたら
+採点結果を捨てて元の検索順の上位 top_n 件を返す（回答は遅らせない）。
+
+スコアラー（RERANK_SCORER）:
+    none           並べ直さない（retriever の結果をそのまま使う）
+    lexical        クエリとの文字 bigram・英数字語の重なり（軽量、既定）
+    cross_encoder  ローカルのクロスエンコーダ（RERANK_MODEL。sentence-transformers が必要）
+
+クロスエンコーダは起動時（main.py の起動グラフの reranker ステップ）に warmup_scorer() で読み込んでおく
+（最初の質問の時間予算の中でモデルを読まないように）。
+所要時間・予算切れの回数は rerank_stats()（/status の "rerank"）で見られる。
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from typing import Any
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.retrievers import BaseRetriever
+
+from rag.hybrid_retriever import make_retriever
+from rag.lexical import tokenize
+
+logger = logging.getLogger(__name__)
+
+RERANK_SCORER = os.environ.get("RERANK_SCORER", "lexical").lower()
+RERANK_CANDIDATES = int(os.environ.get("RERANK_CANDIDATES", "30"))
+RERANK_BUDGET_MS = float(os.environ.get("RERANK_BUDGET_MS", "200"))
+RERANK_MODEL = os.environ.get("RERANK_MODEL", "hotchpotch/japanese-reranker-cross-encoder-xsmall-v1")
+RERANK_BATCH_SIZE = int(os.environ.get("RERANK_BATCH_SIZE", "8"))
+# 英数字の語（型番など）は bigram よりこの倍だけ重く数える
+LEXICAL_WORD_WEIGHT = 3.0
+
+
+class LexicalOverlapScorer:
+    """クエリの語（bigram・英数字語）のうち、チャンクに含まれるものの重み付き割合"""
+
+    name = "lexical"
+
+    @staticmethod
+    def _weights(query: str) -> dict:
+        words = set(tokenize(query))
+        return {t: LEXICAL_WORD_WEIGHT if t.isascii() and len(t) > 2 else 1.0 for t in words}
+
+    def score(self, query: str, docs: list, deadline: float | None = None) -> list[float] | None:
+        weights = self._weights(query)
+        total = sum(weights.values())
+        if not total:
+            return [0.0] * len(docs)
+        scores = []
+        for doc in docs:
+            if deadline is not None and time.perf_counter() > deadline:
+                return None
+            terms = set(tokenize(doc.page_content))
+            scores.append(sum(w for t, w in weights.items() if t in terms) / total)
+        return scores
+
+
+class CrossEncoderScorer:
+    """ローカルのクロスエンコーダで (質問, チャンク) を採点する（バッチごとに時間予算を確認）"""
+
+    name = "cross_encoder"
+
+    def __init__(self, model_name: str = RERANK_MODEL, batch_size: int = RERANK_BATCH_SIZE):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    from sentence_transformers import CrossEncoder
+                    t0 = time.perf_counter()
+                    self._model = CrossEncoder(self.model_name, max_length=512)
+                    logger.info(f"✅ Reranker loaded: {self.model_name} ({time.perf_counter() - t0:.1f}s)")
+        return self._model
+
+    def warmup(self):
+        """モデルを読み込み、初回 predict の遅延も先に払っておく"""
+        self.model.predict([("warmup", "warmup")])
+
+    def score(self, query: str, docs: list, deadline: float | None = None) -> list[float] | None:
+        pairs = [(query, doc.page_content) for doc in docs]
+        scores: list = []
+        for i in range(0, len(pairs), self.batch_size):
+            if deadline is not None and time.perf_counter() > deadline:
+                return None
+            scores.extend(float(s) for s in self.model.predict(pairs[i:i + self.batch_size]))
+        return scores
+
+
+_SCORERS = {"lexical": LexicalOverlapScorer, "cross_encoder": CrossEncoderScorer}
+_scorer_cache: dict = {}
+
+
+def get_scorer(name: str | None = None):
+    """名前からスコアラーを返す（none なら None）。クロスエンコーダはプロセスで 1 つだけ読む"""
+    name = (name or RERANK_SCORER).lower()
+    if name in ("", "none", "off"):
+        return None
+    if name not in _SCORERS:
+        raise ValueError(f"unknown RERANK_SCORER: {name}")
+    if name not in _scorer_cache:
+        _scorer_cache[name] = _SCORERS[name]()
+    return _scorer_cache[name]
+
+
+def warmup_scorer(name: str | None = None):
+    """起動時にスコアラーを用意する（読み込みが重いもの = クロスエンコーダはここでロードする）"""
+    scorer = get_scorer(name)
+    warmup = getattr(scorer, "warmup", None)
+    if warmup is not None:
+        t0 = time.perf_counter()
+        warmup()
+        logger.info(f"✅ Reranker warmed up: {scorer.name} ({time.perf_counter() - t0:.1f}s)")
+    return scorer
+
+
+class RerankMetrics:
+    """rerank の所要時間と予算切れの集計"""
+
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self._recent: deque = deque(maxlen=window)
+        self.calls = 0
+        self.fallbacks = 0
+        self.errors = 0
+
+    def record(self, elapsed_ms: float, fallback: bool = False, error: bool = False):
+        with self._lock:
+            self.calls += 1
+            self.fallbacks += int(fallback)
+            self.errors += int(error)
+            self._recent.append(elapsed_ms)
+
+    def stats(self) -> dict:
+        with self._lock:
+            recent = sorted(self._recent)
+            calls, fallbacks, errors = self.calls, self.fallbacks, self.errors
+
+        def percentile(p: float) -> float:
+            if not recent:
+                return 0.0
+            return round(recent[min(len(recent) - 1, int(p * len(recent)))], 3)
+
+        return {
+            "scorer": RERANK_SCORER,
+            "candidates": RERANK_CANDIDATES,
+            "budget_ms": RERANK_BUDGET_MS,
+            "calls": calls,
+            "fallbacks": fallbacks,
+            "errors": errors,
+            "avg_ms": round(sum(recent) / len(recent), 3) if recent else 0.0,
+            "p50_ms": percentile(0.5),
+            "p95_ms": percentile(0.95),
+            "max_ms": round(recent[-1], 3) if recent else 0.0,
+        }
+
+
+metrics = RerankMetrics()
+
+
+def rerank_stats() -> dict:
+    return metrics.stats()
+
+
+class RerankingRetriever(BaseRetriever):
+    """base_retriever の候補を scorer で並べ直し、上位 top_n 件を返す"""
+
+    base_retriever: Any
+    scorer: Any
+    top_n: int = 3
+    budget_ms: float = RERANK_BUDGET_MS
+
+    def rerank(self, query: str, docs: list) -> tuple[list, dict]:
+        """(上位 top_n 件, {"rerank_ms", "fallback"}) を返す。予算切れ・失敗時は元の順"""
+        started = time.perf_counter()
+        deadline = started + self.budget_ms / 1000 if self.budget_ms > 0 else None
+        scores, error = None, False
+        try:
+            scores = self.scorer.score(query, docs, deadline=deadline)
+        except Exception as e:
+            error = True
+            logger.warning(f"⚠️ Rerank failed, using retrieval order: {e}")
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if scores is not None and deadline is not None and time.perf_counter() > deadline:
+            scores = None
+        fallback = scores is None
+        metrics.record(elapsed_ms, fallback=fallback, error=error)
+
+        if fallback:
+            return docs[:self.top_n], {"rerank_ms": round(elapsed_ms, 3), "fallback": True}
+        # 同点は元の検索順のまま（sorted は安定）
+        order = sorted(range(len(docs)), key=lambda i: -scores[i])
+        return [docs[i] for i in order[:self.top_n]], {"rerank_ms": round(elapsed_ms, 3), "fallback": False}
+
+    def retrieve_with_stats(self, query: str) -> tuple[list, dict]:
+        candidates = self.base_retriever.invoke(query)
+        return self.rerank(query, candidates)
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list:
+        docs, _ = self.retrieve_with_stats(query)
+        return docs
+
+
+def build_retriever(vectorstore, k: int = 4, scorer: str | None = None, search_filter: dict | None = None):
+    """RAG 用の retriever（ハイブリッド検索 → rerank）。スコアラーが none なら rerank しない"""
+    reranker = get_scorer(scorer)
+    if reranker is None:
+        return make_retriever(vectorstore, k=k, search_filter=search_filter)
+    candidates = make_retriever(vectorstore, k=max(RERANK_CANDIDATES, k), search_filter=search_filter)
+    return RerankingRetriever(base_retriever=candidates, scorer=reranker, top_n=k)
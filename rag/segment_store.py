@@ -0,0 +1,1045 @@
+"""
+セグメント方式の追記型ベクトルストア。
+
+取り込みごとに小さな不変セグメント（ベクトル + チャンクストア）を書き出し、manifest.json に追記する。
+既存インデックス全体の load → add → save を行わないため、取り込みコストは新しい文書の量にだけ比例する。
+検索は全セグメントに投げて top-k をマージし、小さなセグメントはバックグラウンドでまとめる。
+
+ディレクトリ構成:
+    rag/vectorstore/
+        manifest.json
+        segments/<segment名>/index.faiss   (IndexIDMap2 で包んだ Flat / IVF / HNSW, ID は全セグメント通しの int64)
+        segments/<segment名>/chunks.db     (ID → チャンク本文・メタデータ。SQLite、検索時はヒットした行だけ読む)
+
+manifest.json の ingested_files は取り込み台帳（ファイル内容の SHA-256 → 出典・チャンク数・ベクトル ID）。
+セグメントと同じ manifest の書き換えで記録されるので、両者が食い違うことはなく、GCS にも一緒に同期される。
+各セグメントのインデックス種別とパラメータは manifest のセグメントエントリ（"index"）に記録する（rag/ann_index.py）。
+
+公開の手順（書き込み中のプロセスが落ちても、読み手が書きかけのファイルを見ることはない）:
+    1. セグメントを segments/<segment名>.<乱数>.tmp に書き出して fsync し、segments/<segment名> に rename する
+    2. manifest.json を一時ファイルに書いて rename する（これが「公開」。manifest にないセグメントは誰も読まない）
+    3. メモリ上は (manifest, セグメント一覧) の IndexSnapshot を 1 回の代入で差し替える
+検索はロックを取らず、開始時のスナップショットだけを使う（書き込み側は次の版を別に作る copy-on-write）。
+不要になったセグメントはすぐには消さず、SEGMENT_RETIRE_SECONDS たってから次の書き込みのときに消す
+（古いスナップショットで検索中のリクエストや、まだ読み込み直していない他プロセスのため）。
+"""
+
+import os
+import json
+import time
+import uuid
+import heapq
+import base64
+import hashlib
+import shutil
+import logging
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+from contextlib import contextmanager
+
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+from rag.ann_index import (
+    FLAT_SPEC, apply_search_params, build_index, choose_index_spec, read_index, selector_params, supports_selector,
+)
+from rag.chunk_store import CHUNKS_DB_NAME, ChunkStore, open_chunk_store
+from rag.lexical import bm25_term, idf, select_terms, tokenize
+from rag.metadata_filter import normalize_filter
+
+try:
+    import fcntl
+except ImportError:  # Windows ではプロセス間ロックなし
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+SEGMENTS_DIR = "segments"
+LEGACY_INDEX_NAME = "index"
+
+# 小さいセグメントがこの数を超えたらバックグラウンドでまとめる
+SEGMENT_MERGE_THRESHOLD = int(os.environ.get("SEGMENT_MERGE_THRESHOLD", "8"))
+# この件数未満のセグメントを「小さい」とみなす
+SEGMENT_SMALL_MAX = int(os.environ.get("SEGMENT_SMALL_MAX", "20000"))
+# セグメントのインデックスを読み取り専用 mmap で開く（対応している種別のみ。rag/ann_index.py）
+VECTORSTORE_MMAP = os.environ.get("VECTORSTORE_MMAP", "true").lower() == "true"
+# セグメントごとに覚えておくフィルタ結果（位置とビットマップ）の数
+FILTER_CACHE_SIZE = int(os.environ.get("FILTER_CACHE_SIZE", "64"))
+# 不要になったセグメントを消すまでの猶予（古いスナップショットで検索中のリクエスト用）
+SEGMENT_RETIRE_SECONDS = float(os.environ.get("SEGMENT_RETIRE_SECONDS", "300"))
+# search_filter のうち文書 ID（取り込み台帳の SHA-256）で検索範囲を絞るキー
+DOCUMENT_FILTER_KEY = "document_id"
+
+
+def _fsync_path(path: str):
+    """ファイル・ディレクトリの内容をディスクに書き出す（ディレクトリは rename を確定させるため）"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:  # ディレクトリの fsync ができない環境
+        pass
+    finally:
+        os.close(fd)
+
+
+def _atomic_write_json(path: str, data: dict):
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_path(os.path.dirname(path) or ".")
+
+
+def file_md5(path: str) -> str:
+    """GCS の md5_hash と同じ形式（base64）のファイルハッシュ"""
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return base64.b64encode(digest.digest()).decode("ascii")
+
+
+class IndexSnapshot(NamedTuple):
+    """ある版の manifest と、それに対応する読み込み済みセグメント（一緒に差し替える）"""
+    manifest: dict
+    segments: tuple
+
+
+class Segment:
+    """不変セグメント（FAISS インデックス + チャンクストア）"""
+
+    def __init__(self, name: str, path: str, index, chunks, spec: dict | None = None, mmapped: bool = False):
+        self.name = name
+        self.path = path
+        self.index = index
+        self.chunks = chunks
+        self.spec = spec or dict(FLAT_SPEC)
+        self.mmapped = mmapped
+        self._id_lookup = None
+        self._selections: OrderedDict = OrderedDict()
+        self._selection_lock = threading.Lock()
+
+    @property
+    def count(self) -> int:
+        return self.index.ntotal
+
+    @property
+    def index_bytes(self) -> int:
+        return os.path.getsize(os.path.join(self.path, "index.faiss"))
+
+    @classmethod
+    def build(cls, path: str, name: str, vectors: np.ndarray, ids: np.ndarray, docs: list,
+              spec: dict | None = None) -> "Segment":
+        """spec を省略するとベクトル数からインデックス種別を自動で選ぶ
+
+        一時ディレクトリに書き出してから path に rename するので、path には完成したセグメントしか現れない。
+        """
+        vectors = np.ascontiguousarray(vectors, dtype="float32")
+        ids = np.ascontiguousarray(ids, dtype="int64")
+        spec = spec or choose_index_spec(len(ids), vectors.shape[1])
+        index = build_index(vectors, ids, spec)
+
+        tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        os.makedirs(tmp_path)
+        try:
+            faiss.write_index(index, os.path.join(tmp_path, "index.faiss"))
+            ChunkStore.write(os.path.join(tmp_path, CHUNKS_DB_NAME), ids, docs)
+            for fname in os.listdir(tmp_path):
+                _fsync_path(os.path.join(tmp_path, fname))
+            os.replace(tmp_path, path)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        _fsync_path(os.path.dirname(path))
+        return cls(name, path, index, ChunkStore(os.path.join(path, CHUNKS_DB_NAME)), spec)
+
+    @classmethod
+    def load(cls, path: str, name: str, spec: dict | None = None, mmap: bool = VECTORSTORE_MMAP) -> "Segment":
+        """spec は manifest に記録された種別（記録のない古いセグメントは Flat）"""
+        index, mapped = read_index(os.path.join(path, "index.faiss"), spec, mmap=mmap)
+        return cls(name, path, index, open_chunk_store(path), spec, mmapped=mapped)
+
+    def tune(self, nprobe: int | None = None, ef_search: int | None = None):
+        apply_search_params(self.index, self.spec, nprobe=nprobe, ef_search=ef_search)
+
+    def search(self, query: np.ndarray, k: int, search_filter: tuple | None = None,
+               id_ranges: np.ndarray | None = None) -> list:
+        """[(距離, ID), ...]
+
+        search_filter: normalize_filter の正規形。合うものだけから k 件
+        id_ranges: ベクトル ID の区間 [[start, end], ...]（両端を含む）。区間内だけを総当たりする（文書単位の検索）
+        """
+        if id_ranges is not None:
+            positions = self.range_positions(id_ranges)
+            if search_filter is not None:
+                positions = np.intersect1d(positions, self.selection(search_filter)[1], assume_unique=True)
+            return self._search_positions(query, k, positions, exact=True)
+        if search_filter is not None:
+            _, positions, bitmap = self.selection(search_filter)
+            return self._search_positions(query, k, positions, bitmap)
+        k = min(k, self.count)
+        if k <= 0:
+            return []
+        distances, ids = self.index.search(query, k)
+        return [(float(d), int(i)) for d, i in zip(distances[0], ids[0]) if i != -1]
+
+    def selection(self, search_filter: tuple) -> tuple:
+        """フィルタに合うベクトルの (ID, インデックス内の位置, 位置のビットマップ)。セグメントは不変なので覚えておく"""
+        with self._selection_lock:
+            if search_filter in self._selections:
+                self._selections.move_to_end(search_filter)
+                return self._selections[search_filter]
+
+        id_map, sorted_ids, order = self._lookup()
+        allowed = self.chunks.filter_ids(search_filter)
+        at = np.searchsorted(sorted_ids, allowed)
+        hit = at < len(sorted_ids)
+        hit[hit] = sorted_ids[at[hit]] == allowed[hit]
+        positions = np.sort(order[at[hit]])
+        mask = np.zeros(self.count, dtype=bool)
+        mask[positions] = True
+        selection = (id_map[positions], positions, np.packbits(mask, bitorder="little"))
+
+        with self._selection_lock:
+            self._selections[search_filter] = selection
+            if len(self._selections) > FILTER_CACHE_SIZE:
+                self._selections.popitem(last=False)
+        return selection
+
+    def _lookup(self) -> tuple:
+        """(位置 → ID, ID の昇順, その並びの位置)"""
+        if self._id_lookup is None:
+            id_map = self.ids()
+            order = np.argsort(id_map, kind="stable")
+            self._id_lookup = (id_map, id_map[order], order)
+        return self._id_lookup
+
+    def range_positions(self, id_ranges: np.ndarray) -> np.ndarray:
+        """ID 区間に入るベクトルのインデックス内の位置（昇順）。二分探索なので区間内の件数にだけ比例する"""
+        _, sorted_ids, order = self._lookup()
+        lo = np.searchsorted(sorted_ids, id_ranges[:, 0])
+        hi = np.searchsorted(sorted_ids, id_ranges[:, 1], side="right")
+        parts = [order[a:b] for a, b in zip(lo, hi) if a < b]
+        return np.sort(np.concatenate(parts)) if parts else np.empty(0, dtype="int64")
+
+    def _search_positions(self, query: np.ndarray, k: int, positions: np.ndarray, bitmap: np.ndarray | None = None,
+                          exact: bool = False) -> list:
+        """インデックス内の位置 positions のベクトルだけから k 件（exact なら対象を総当たり）"""
+        k = min(k, len(positions))
+        if k <= 0:
+            return []
+        id_map = self._lookup()[0]
+        # IVF は ID から復元できない（direct map がない）ので、対象が少なくても選択付きで全リストを見る
+        is_ivf = self.spec["type"] == "ivf"
+        if supports_selector(self.spec) and (is_ivf or (len(positions) > k and not exact)):
+            if bitmap is not None:
+                selector = faiss.IDSelectorBitmap(self.count, faiss.swig_ptr(bitmap))
+            else:
+                positions = np.ascontiguousarray(positions, dtype="int64")
+                selector = faiss.IDSelectorBatch(len(positions), faiss.swig_ptr(positions))
+            inner = self.index.index
+            distances, found = inner.search(query, k, params=selector_params(
+                self.index, self.spec, selector, exhaustive=is_ivf and (exact or len(positions) <= k)
+            ))
+            if (found[0] != -1).sum() < k and is_ivf:
+                # nprobe のリストに候補が足りなければ全リストを見直す
+                distances, found = inner.search(
+                    query, k, params=selector_params(self.index, self.spec, selector, exhaustive=True)
+                )
+            if (found[0] != -1).sum() >= k:
+                return [(float(d), int(id_map[p])) for d, p in zip(distances[0], found[0]) if p != -1]
+        # 文書単位・対象が k 件以下・絞り込み検索に対応しない種別・グラフ探索で届かなかった場合は対象だけを総当たり
+        vectors = self.index.index.reconstruct_batch(positions)
+        distances = ((vectors - query[0]) ** 2).sum(axis=1)
+        best = np.argsort(distances, kind="stable")[:k]
+        return [(float(distances[i]), int(id_map[positions[i]])) for i in best]
+
+    def get(self, doc_id: int):
+        return self.chunks.get(doc_id)
+
+    def get_many(self, ids) -> dict:
+        return self.chunks.get_many(ids)
+
+    def ids(self) -> np.ndarray:
+        return faiss.vector_to_array(self.index.id_map).astype("int64")
+
+    def vectors(self) -> np.ndarray:
+        return self.index.index.reconstruct_n(0, self.count)
+
+    def documents(self, ids) -> list:
+        found = self.chunks.get_many(ids)
+        return [found[int(i)] for i in ids]
+
+    def file_hashes(self) -> dict:
+        """セグメント内の各ファイルの md5（GCS との差分同期に使う）"""
+        return {fname: file_md5(os.path.join(self.path, fname)) for fname in sorted(os.listdir(self.path))}
+
+
+class SegmentedVectorStore(VectorStore):
+    """セグメントを束ねて LangChain の VectorStore として振る舞うストア"""
+
+    def __init__(self, root_dir: str, embedding, mmap: bool | None = None):
+        self.root_dir = root_dir
+        self.embedding = embedding
+        self.mmap = VECTORSTORE_MMAP if mmap is None else mmap
+        self._snapshot = IndexSnapshot({"format": 1, "version": 0, "next_id": 0, "segments": []}, ())
+        self._write_lock = threading.RLock()
+        self._merge_thread = None
+        self._manifest_mtime = None
+        self._flock_depth = 0
+        os.makedirs(os.path.join(root_dir, SEGMENTS_DIR), exist_ok=True)
+        self.reload()
+
+    # ------------------------------------------------------------------
+    # manifest / ロック
+    # ------------------------------------------------------------------
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.root_dir, MANIFEST_NAME)
+
+    def _segment_path(self, name: str) -> str:
+        return os.path.join(self.root_dir, SEGMENTS_DIR, name)
+
+    @contextmanager
+    def _locked(self):
+        """プロセス内（RLock）とプロセス間（flock）の書き込みロック（同じスレッドからは入れ子で取れる）"""
+        with self._write_lock:
+            if fcntl is None or self._flock_depth > 0:
+                self._flock_depth += 1
+                try:
+                    yield
+                finally:
+                    self._flock_depth -= 1
+                return
+            with open(os.path.join(self.root_dir, ".lock"), "a+") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self._flock_depth = 1
+                try:
+                    yield
+                finally:
+                    self._flock_depth = 0
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_manifest(self) -> dict | None:
+        if not os.path.exists(self.manifest_path):
+            return None
+        with open(self.manifest_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def reload(self):
+        """ディスク上の manifest に合わせてセグメントを読み込み直す（読み込み済みは再利用）"""
+        manifest = self._read_manifest()
+        if manifest is None:
+            return
+        loaded = {seg.name: seg for seg in self._snapshot.segments}
+        segments = []
+        for entry in manifest["segments"]:
+            seg = loaded.get(entry["name"]) or Segment.load(
+                self._segment_path(entry["name"]), entry["name"], entry.get("index"), mmap=self.mmap
+            )
+            segments.append(seg)
+        self._snapshot = IndexSnapshot(manifest, tuple(segments))
+        self._manifest_mtime = os.stat(self.manifest_path).st_mtime_ns
+
+    def refresh(self) -> bool:
+        """manifest が他プロセスで更新されていれば読み込み直す（stat 1 回だけの軽い確認）
+
+        新しいセグメントを読み込んでからセグメント一覧を差し替えるので、検索は止まらない
+        （検索中のリクエストは差し替え前の一覧で最後まで走る）。
+        """
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        except OSError:
+            return False
+        if mtime == self._manifest_mtime:
+            return False
+        # 同じプロセスの書き込み（_publish）と入れ違いに古い manifest で上書きしないように
+        with self._write_lock:
+            if os.stat(self.manifest_path).st_mtime_ns == self._manifest_mtime:
+                return False
+            self.reload()
+        return True
+
+    @contextmanager
+    def exclusive(self):
+        """書き込み（取り込み・削除・マージ）と同時に走らせたくない外部の処理用（GCS からの取得など）"""
+        with self._locked():
+            yield
+
+    def _publish(self, manifest: dict, segments: list):
+        manifest["version"] = manifest.get("version", 0) + 1
+        manifest["updated_at"] = time.time()
+        _atomic_write_json(self.manifest_path, manifest)
+        self._snapshot = IndexSnapshot(manifest, tuple(segments))
+        self._manifest_mtime = os.stat(self.manifest_path).st_mtime_ns
+
+    def _new_segment_name(self) -> str:
+        return f"seg-{int(time.time() * 1000):013d}-{uuid.uuid4().hex[:6]}"
+
+    # ------------------------------------------------------------------
+    # 情報
+    # ------------------------------------------------------------------
+    @property
+    def embeddings(self):
+        return self.embedding
+
+    def snapshot(self) -> IndexSnapshot:
+        """現在の版（検索は最初に 1 回だけ取り、最後まで同じものを使う）"""
+        return self._snapshot
+
+    @property
+    def segments(self) -> tuple:
+        return self._snapshot.segments
+
+    @property
+    def manifest(self) -> dict:
+        """現在の manifest（読み取り専用として扱う）"""
+        return self._snapshot.manifest
+
+    # 書き込み側（_locked の中）で使う短縮名
+    @property
+    def _segments(self) -> tuple:
+        return self._snapshot.segments
+
+    @property
+    def _manifest(self) -> dict:
+        return self._snapshot.manifest
+
+    def __len__(self):
+        return sum(seg.count for seg in self._segments)
+
+    def stats(self) -> dict:
+        manifest, segments = self._snapshot
+        return {
+            "segments": len(segments),
+            "vectors": sum(seg.count for seg in segments),
+            "segment_sizes": [seg.count for seg in segments],
+            "index_types": [seg.spec["type"] for seg in segments],
+            "index_codecs": [seg.spec.get("codec", "flat") for seg in segments],
+            "index_bytes": sum(seg.index_bytes for seg in segments),
+            "mmapped_segments": sum(1 for seg in segments if seg.mmapped),
+            "manifest_version": manifest.get("version", 0),
+            "ingested_files": len(manifest.get("ingested_files") or {}),
+            "next_id": manifest.get("next_id", 0),
+        }
+
+    # ------------------------------------------------------------------
+    # 書き込み
+    # ------------------------------------------------------------------
+    def add_texts(self, texts, metadatas=None, **kwargs) -> list[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+        metadatas = list(metadatas) if metadatas else [{} for _ in texts]
+        vectors = np.asarray(self.embedding.embed_documents(texts), dtype="float32")
+        docs = [Document(page_content=t, metadata=m) for t, m in zip(texts, metadatas)]
+        return self.add_embeddings(vectors, docs)
+
+    def _build_segment(self, vectors: np.ndarray, ids: np.ndarray, docs: list,
+                       index_type: str | None = None, codec: str | None = None, **extra):
+        """セグメントを書き出し、(segment, manifest エントリ) を返す"""
+        name = self._new_segment_name()
+        spec = choose_index_spec(len(ids), vectors.shape[1], index_type=index_type, codec=codec)
+        segment = Segment.build(self._segment_path(name), name, vectors, ids, docs, spec)
+        entry = {
+            "name": name,
+            "count": segment.count,
+            "index": spec,
+            "min_id": int(ids.min()),
+            "max_id": int(ids.max()),
+            "created_at": time.time(),
+            "files": segment.file_hashes(),
+            **extra,
+        }
+        return segment, entry
+
+    def _write_segment(self, manifest: dict, vectors: np.ndarray, docs: list, index_type: str | None = None,
+                       codec: str | None = None, **extra):
+        """次の ID から連番でセグメントを書き出し、(segment, ids, manifest エントリ) を返す"""
+        start_id = manifest["next_id"]
+        ids = np.arange(start_id, start_id + len(docs), dtype="int64")
+        segment, entry = self._build_segment(vectors, ids, docs, index_type=index_type, codec=codec,
+                                             **extra)
+        manifest["next_id"] = start_id + len(docs)
+        manifest["dim"] = int(vectors.shape[1])
+        return segment, ids, entry
+
+    @staticmethod
+    def _skip_ingested(manifest: dict, vectors: np.ndarray, docs: list, files: list) -> tuple:
+        """台帳に既にあるファイルの分を (vectors, docs, files) から除く（files の count 件ずつが docs の並びに対応）"""
+        registry = manifest.get("ingested_files") or {}
+        if not any(f["sha256"] in registry for f in files):
+            return vectors, docs, files
+        keep_rows, keep_files = [], []
+        offset = 0
+        for f in files:
+            if f["sha256"] in registry:
+                logger.info(f"Skip ingest: {f['source']} was already ingested by another process")
+            else:
+                keep_rows.extend(range(offset, offset + f["count"]))
+                keep_files.append(f)
+            offset += f["count"]
+        return vectors[keep_rows], [docs[i] for i in keep_rows], keep_files
+
+    @staticmethod
+    def _register_files(manifest: dict, ids: np.ndarray, files: list | None):
+        """取り込み台帳（SHA-256 → 出典・チャンク数・ベクトル ID）に追記する
+
+        files: [{"sha256", "source", "count", "pages", "size"}, ...]。docs の並び順で count 件ずつ対応する
+        """
+        if not files:
+            return
+        if sum(f["count"] for f in files) != len(ids):
+            raise ValueError("files の count の合計が docs の件数と一致しません")
+        registry = dict(manifest.get("ingested_files") or {})
+        offset = 0
+        for f in files:
+            file_ids = ids[offset:offset + f["count"]]
+            offset += f["count"]
+            registry[f["sha256"]] = {
+                "source": f["source"],
+                "chunks": int(f["count"]),
+                "pages": f.get("pages"),
+                "size": f.get("size"),
+                "vector_ids": [[int(file_ids[0]), int(file_ids[-1])]] if len(file_ids) else [],
+                "ingested_at": time.time(),
+            }
+        manifest["ingested_files"] = registry
+
+    def _drop_segments(self, names):
+        """不要になったセグメントに退役の印（mtime）を付け、猶予を過ぎたものを消す"""
+        now = time.time()
+        for name in names:
+            try:
+                os.utime(self._segment_path(name), (now, now))
+            except OSError:
+                pass
+        self._reap_segments(now)
+
+    def _reap_segments(self, now: float | None = None) -> list[str]:
+        """manifest にないセグメント（退役済み・書きかけの .tmp）のうち、猶予を過ぎたものを消す（_locked の中で呼ぶ）"""
+        now = time.time() if now is None else now
+        live = {e["name"] for e in self._manifest["segments"]}
+        segments_dir = os.path.join(self.root_dir, SEGMENTS_DIR)
+        reaped = []
+        for name in os.listdir(segments_dir):
+            path = os.path.join(segments_dir, name)
+            if name in live or not os.path.isdir(path):
+                continue
+            try:
+                retired_at = os.stat(path).st_mtime
+            except OSError:
+                continue
+            if now - retired_at >= SEGMENT_RETIRE_SECONDS:
+                shutil.rmtree(path, ignore_errors=True)
+                reaped.append(name)
+        if reaped:
+            logger.info(f"Removed {len(reaped)} retired segments")
+        return reaped
+
+    def add_embeddings(self, vectors: np.ndarray, docs: list, files: list | None = None,
+                       replace_source: str | None = None, index_type: str | None = None,
+                       codec: str | None = None) -> list[str]:
+        """埋め込み済みベクトルを 1 セグメントとして追記する
+
+        files: 取り込み台帳に同時に記録するファイル情報。書き込みロックの中で台帳を見直し、
+            他プロセス（別の uvicorn ワーカー）が先に取り込んだファイルの分は追記しない（全部そうなら何もせず [] を返す）
+        replace_source: 指定した出典の既存ベクトルを同じ manifest 更新で削除する（差し替え）
+        index_type / codec: セグメントのインデックス種別と保存形式（省略時は ANN_INDEX_TYPE / ANN_CODEC）
+        """
+        removed = 0
+        obsolete: list = []
+        with self._locked():
+            self.reload()
+            manifest = dict(self._manifest)
+            if files:
+                vectors, docs, files = self._skip_ingested(manifest, vectors, docs, files)
+                if not docs:
+                    return []
+            segments = list(self._segments)
+            if replace_source is not None:
+                segments, obsolete, removed = self._apply_removal(
+                    manifest, segments, self._ids_for_source(replace_source)
+                )
+            segment, ids, entry = self._write_segment(manifest, vectors, docs, index_type=index_type,
+                                                      codec=codec, ledgered=bool(files))
+            manifest["segments"] = manifest["segments"] + [entry]
+            self._register_files(manifest, ids, files)
+            self._publish(manifest, segments + [segment])
+            self._drop_segments(obsolete)
+
+        if replace_source is not None:
+            logger.info(f"✅ Segment written: {segment.name} ({len(docs)} vectors, "
+                        f"replaced {removed} vectors of {replace_source})")
+        else:
+            logger.info(f"✅ Segment written: {segment.name} ({len(docs)} vectors)")
+        self.maybe_merge_async()
+        return [str(i) for i in ids]
+
+    def rebuild(self, vectors: np.ndarray, docs: list, files: list | None = None,
+                index_type: str | None = None, codec: str | None = None) -> list[str]:
+        """全セグメントを 1 つの新しいセグメントで置き換える（一括再構築用。取り込み台帳も作り直す）
+
+        index_type: "flat" / "ivf" / "hnsw" / "auto"（省略時は ANN_INDEX_TYPE）
+        codec: "flat" / "fp16" / "sq8" / "pq"（省略時は ANN_CODEC）
+        """
+        with self._locked():
+            self.reload()
+            manifest = dict(self._manifest)
+            segment, ids, entry = self._write_segment(manifest, vectors, docs, index_type=index_type,
+                                                      codec=codec, ledgered=bool(files))
+
+            old_names = [seg.name for seg in self._segments]
+            manifest["segments"] = [entry]
+            manifest["ingested_files"] = {}
+            self._register_files(manifest, ids, files)
+            self._publish(manifest, [segment])
+            self._drop_segments(old_names)
+
+        logger.info(f"✅ Rebuilt vectorstore as {segment.name} ({len(docs)} vectors, "
+                    f"{segment.spec['type']} index, replaced {len(old_names)} segments)")
+        return [str(i) for i in ids]
+
+    # ------------------------------------------------------------------
+    # 削除
+    # ------------------------------------------------------------------
+    def _ids_for_source(self, source: str) -> np.ndarray:
+        """出典に属するベクトル ID（台帳の ID 区間 + 台帳のないセグメントはチャンクストアを出典で引く）"""
+        ids = [
+            doc_id
+            for entry in self.ingested_files(source=source)
+            for start, end in entry["vector_ids"]
+            for doc_id in range(start, end + 1)
+        ]
+        entries = {e["name"]: e for e in self._manifest["segments"]}
+        for seg in self._segments:
+            if entries.get(seg.name, {}).get("ledgered"):
+                continue
+            ids.extend(seg.chunks.ids_for_source(source))
+        return np.unique(np.asarray(ids, dtype="int64"))
+
+    def _apply_removal(self, manifest: dict, segments: list, remove_ids: np.ndarray):
+        """
+        remove_ids を含むセグメントだけを書き換える（全部消えるものは manifest から外すだけ）。
+        manifest を更新し、(新しいセグメント一覧, 不要になったセグメント名, 削除件数) を返す。
+        """
+        remove_ids = np.unique(np.asarray(remove_ids, dtype="int64"))
+        if len(remove_ids) == 0:
+            return segments, [], 0
+
+        entries = {e["name"]: e for e in manifest["segments"]}
+        new_entries, new_segments, obsolete = [], [], []
+        removed = 0
+        for seg in segments:
+            entry = entries[seg.name]
+            lo = np.searchsorted(remove_ids, entry["min_id"])
+            hi = np.searchsorted(remove_ids, entry["max_id"], side="right")
+            seg_ids = seg.ids() if lo < hi else None
+            mask = np.isin(seg_ids, remove_ids[lo:hi]) if seg_ids is not None else None
+            if mask is None or not mask.any():
+                new_entries.append(entry)
+                new_segments.append(seg)
+                continue
+
+            removed += int(mask.sum())
+            obsolete.append(seg.name)
+            if mask.all():
+                continue
+            keep_ids = seg_ids[~mask]
+            # 書き換えても元のセグメントと同じ種別・保存形式にする
+            rewritten, rewritten_entry = self._build_segment(
+                seg.vectors()[~mask], keep_ids, seg.documents(keep_ids),
+                index_type=seg.spec["type"], codec=seg.spec.get("codec"),
+                ledgered=entry.get("ledgered", False), rewritten_from=seg.name,
+            )
+            new_entries.append(rewritten_entry)
+            new_segments.append(rewritten)
+
+        manifest["segments"] = new_entries
+        # 一部でもベクトルが消えたファイルは台帳から外す（再アップロードで取り込み直せるように）
+        registry = manifest.get("ingested_files") or {}
+        manifest["ingested_files"] = {
+            sha: entry for sha, entry in registry.items()
+            if not any(
+                np.searchsorted(remove_ids, start) < np.searchsorted(remove_ids, end, side="right")
+                for start, end in entry["vector_ids"]
+            )
+        }
+        return new_segments, obsolete, removed
+
+    def delete_ids(self, ids) -> int:
+        """ID を指定して削除し、削除した件数を返す"""
+        with self._locked():
+            self.reload()
+            manifest = dict(self._manifest)
+            segments, obsolete, removed = self._apply_removal(manifest, list(self._segments), ids)
+            if removed:
+                self._publish(manifest, segments)
+                self._drop_segments(obsolete)
+        if removed:
+            logger.info(f"✅ Deleted {removed} vectors ({len(obsolete)} segments touched)")
+        return removed
+
+    def delete_source(self, source: str) -> int:
+        """出典（ファイル名）単位で削除し、削除した件数を返す"""
+        with self._locked():
+            self.reload()
+            return self.delete_ids(self._ids_for_source(source))
+
+    def delete(self, ids=None, **kwargs) -> bool:
+        """LangChain の VectorStore.delete 互換"""
+        if not ids:
+            return False
+        return self.delete_ids([int(i) for i in ids]) > 0
+
+    def sources(self) -> list[dict]:
+        """出典ごとのチャンク数"""
+        counts: dict = {}
+        for seg in self._segments:
+            for source, n in seg.chunks.source_counts().items():
+                name = source or "不明"
+                counts[name] = counts.get(name, 0) + n
+        return [{"source": name, "chunks": n} for name, n in sorted(counts.items())]
+
+    # ------------------------------------------------------------------
+    # 取り込み台帳
+    # ------------------------------------------------------------------
+    def ingested_file(self, sha256: str) -> dict | None:
+        """同じ内容のファイルが取り込み済みなら台帳のエントリを返す"""
+        entry = (self._manifest.get("ingested_files") or {}).get(sha256)
+        return {"sha256": sha256, **entry} if entry else None
+
+    def ingested_files(self, source: str | None = None) -> list[dict]:
+        registry = self._manifest.get("ingested_files") or {}
+        return [
+            {"sha256": sha, **entry} for sha, entry in registry.items()
+            if source is None or entry["source"] == source
+        ]
+
+    # ------------------------------------------------------------------
+    # 他インスタンスの版への付け替え（GCS の manifest 競合時）
+    # ------------------------------------------------------------------
+    @staticmethod
+    def _range_ids(ranges) -> np.ndarray:
+        ids = [np.arange(start, end + 1, dtype="int64") for start, end in ranges]
+        return np.concatenate(ids) if ids else np.empty(0, dtype="int64")
+
+    def rebase(self, remote: dict, base: dict | None = None) -> dict:
+        """
+        remote（他インスタンスが公開した manifest。セグメントはローカルに取得済み）の上に、
+        base（前回同期した manifest）以降にこのストアで行った変更をかけ直して公開する。
+
+        - base にあってローカルにない台帳エントリ（削除・差し替えた文書）は remote からも消す
+        - ID が base の next_id 以降のベクトル（ローカルで足したもの）は remote の next_id から ID を振り直し、
+          1 つのセグメントにまとめて足す（remote に同じ内容のファイルがあればそのファイルの分は足さない）
+        base が分からないとき（古い同期状態）は、ローカルで足したセグメントの最小 ID を base の next_id とし、
+        それより前の ID だけを持つ台帳エントリと、remote と共通の台帳エントリを base とみなす。
+        公開した manifest を返す。
+        """
+        with self._locked():
+            self.reload()
+            local = self._manifest
+            remote_names = {e["name"] for e in remote["segments"]}
+            local_ledger = local.get("ingested_files") or {}
+            remote_ledger = remote.get("ingested_files") or {}
+            if base is None:
+                added_here = [e["min_id"] for e in local["segments"] if e["name"] not in remote_names
+                              and not e.get("merged_from") and not e.get("rewritten_from")]
+                base_next = min(added_here, default=local.get("next_id", 0))
+                base = {
+                    "next_id": base_next,
+                    "ingested_files": {
+                        **{sha: e for sha, e in remote_ledger.items()
+                           if all(end < base_next for _, end in e["vector_ids"])},
+                        **{sha: e for sha, e in local_ledger.items() if sha in remote_ledger},
+                    },
+                }
+            base_next = base.get("next_id", 0)
+            base_ledger = base.get("ingested_files") or {}
+
+            manifest = dict(remote)
+            loaded = {seg.name: seg for seg in self._segments}
+            segments = [
+                loaded.get(e["name"]) or Segment.load(self._segment_path(e["name"]), e["name"], e.get("index"),
+                                                      mmap=self.mmap)
+                for e in remote["segments"]
+            ]
+
+            # 1) ローカルで消した文書を remote からも消す
+            removed_files = [sha for sha in base_ledger if sha not in local_ledger]
+            remove_ids = self._range_ids(r for sha in removed_files for r in base_ledger[sha]["vector_ids"])
+            segments, obsolete, removed = self._apply_removal(manifest, segments, remove_ids)
+
+            # 2) ローカルで足したベクトルを、remote の ID の後ろに振り直して足す
+            new_files = {sha: e for sha, e in local_ledger.items() if sha not in base_ledger}
+            duplicate_ids = self._range_ids(
+                r for sha, e in new_files.items() if sha in remote_ledger for r in e["vector_ids"]
+            )
+            old_ids, vectors, docs = [], [], []
+            for seg in self._segments:
+                if seg.name in remote_names:
+                    continue
+                seg_ids = seg.ids()
+                keep = (seg_ids >= base_next) & ~np.isin(seg_ids, duplicate_ids)
+                if keep.any():
+                    old_ids.append(seg_ids[keep])
+                    vectors.append(seg.vectors()[keep])
+                    docs.extend(seg.documents(seg_ids[keep]))
+
+            added = 0
+            if old_ids:
+                old_ids = np.concatenate(old_ids)
+                order = np.argsort(old_ids, kind="stable")
+                old_ids = old_ids[order]
+                docs = [docs[i] for i in order]
+                carried = {sha: e for sha, e in new_files.items() if sha not in remote_ledger}
+                segment, new_ids, entry = self._write_segment(
+                    manifest, np.concatenate(vectors)[order], docs,
+                    ledgered=all(e.get("ledgered") for e in local["segments"] if e["name"] not in remote_names),
+                )
+                registry = dict(manifest.get("ingested_files") or {})
+                for sha, e in carried.items():
+                    ranges = []
+                    for start, end in e["vector_ids"]:
+                        lo, hi = np.searchsorted(old_ids, [start, end])
+                        if lo < len(old_ids) and hi < len(old_ids) and old_ids[hi] == end:
+                            ranges.append([int(new_ids[lo]), int(new_ids[hi])])
+                    registry[sha] = {**e, "vector_ids": ranges}
+                manifest["ingested_files"] = registry
+                manifest["segments"] = manifest["segments"] + [entry]
+                segments = segments + [segment]
+                added = len(docs)
+
+            stale = [e["name"] for e in local["segments"] if e["name"] not in remote_names]
+            self._publish(manifest, segments)
+            self._drop_segments(stale + obsolete)
+
+        logger.info(f"✅ Rebased local changes onto manifest v{remote.get('version')} "
+                    f"(+{added} vectors, -{removed} vectors)")
+        return manifest
+
+    # ------------------------------------------------------------------
+    # マージ
+    # ------------------------------------------------------------------
+    def _small_segments(self) -> list:
+        return [seg for seg in self._segments if seg.count < SEGMENT_SMALL_MAX]
+
+    def maybe_merge_async(self):
+        """小さいセグメントが増えすぎていればバックグラウンドでまとめる"""
+        if len(self._small_segments()) <= SEGMENT_MERGE_THRESHOLD:
+            return
+        if self._merge_thread is not None and self._merge_thread.is_alive():
+            return
+        self._merge_thread = threading.Thread(target=self.merge_small_segments, name="segment-merge", daemon=True)
+        self._merge_thread.start()
+
+    def merge_small_segments(self) -> str | None:
+        """小さいセグメントを 1 つにまとめる（検索は古いセグメントで継続）"""
+        with self._locked():
+            self.reload()
+            small = self._small_segments()
+            if len(small) < 2:
+                return None
+
+            ids = np.concatenate([seg.ids() for seg in small])
+            vectors = np.concatenate([seg.vectors() for seg in small])
+            docs = [doc for seg in small for doc in seg.documents(seg.ids())]
+
+            merged_names = {seg.name for seg in small}
+            manifest = dict(self._manifest)
+            ledgered = all(e.get("ledgered") for e in manifest["segments"] if e["name"] in merged_names)
+            merged, entry = self._build_segment(
+                vectors, ids, docs, ledgered=ledgered, merged_from=sorted(merged_names)
+            )
+
+            kept = [e for e in manifest["segments"] if e["name"] not in merged_names]
+            manifest["segments"] = kept + [entry]
+            segments = [seg for seg in self._segments if seg.name not in merged_names] + [merged]
+            self._publish(manifest, segments)
+            self._drop_segments(merged_names)
+
+        logger.info(f"✅ Merged {len(small)} segments into {merged.name} ({merged.count} vectors, "
+                    f"{merged.spec['type']} index)")
+        return merged.name
+
+    # ------------------------------------------------------------------
+    # 検索
+    # ------------------------------------------------------------------
+    def tune(self, nprobe: int | None = None, ef_search: int | None = None):
+        """読み込み済みの全セグメントの nprobe（IVF）/ efSearch（HNSW）を変える（Flat には影響しない）"""
+        for seg in self._segments:
+            seg.tune(nprobe=nprobe, ef_search=ef_search)
+
+    def document_ranges(self, document_ids, snapshot: IndexSnapshot | None = None) -> np.ndarray:
+        """文書 ID（取り込み台帳の SHA-256）のベクトル ID 区間 [[start, end], ...]（台帳にない ID は無視）"""
+        registry = (snapshot or self._snapshot).manifest.get("ingested_files") or {}
+        ranges = [r for doc_id in document_ids for r in (registry.get(doc_id) or {}).get("vector_ids", [])]
+        return np.asarray(ranges, dtype="int64").reshape(-1, 2)
+
+    def _scope(self, search_filter: dict | None, snapshot: IndexSnapshot | None = None) -> tuple:
+        """search_filter を (文書 ID の区間 or None, メタデータ条件の正規形) に分ける"""
+        search_filter = dict(search_filter or {})
+        document_ids = search_filter.pop(DOCUMENT_FILTER_KEY, None)
+        if isinstance(document_ids, str):
+            document_ids = [document_ids]
+        id_ranges = self.document_ranges(document_ids, snapshot) if document_ids else None
+        return id_ranges, normalize_filter(search_filter)
+
+    def _segments_for(self, id_ranges: np.ndarray | None, snapshot: IndexSnapshot | None = None) -> tuple:
+        """ID 区間に重なるセグメントだけ（manifest の min_id / max_id で判定。区間なしなら全部）"""
+        manifest, segments = snapshot or self._snapshot
+        if id_ranges is None:
+            return segments
+        entries = {e["name"]: e for e in manifest["segments"]}
+        kept = []
+        for seg in segments:
+            entry = entries.get(seg.name, {})
+            lo, hi = entry.get("min_id"), entry.get("max_id")
+            if lo is None or hi is None or ((id_ranges[:, 0] <= hi) & (id_ranges[:, 1] >= lo)).any():
+                kept.append(seg)
+        return tuple(kept)
+
+    def vector_hits(self, embedding, k: int = 4, search_filter: dict | None = None) -> list[tuple]:
+        """ベクトル検索の上位 k 件 [(距離, ID, segment), ...]（距離の昇順。本文は読まない）
+
+        search_filter: メタデータの条件（rag/metadata_filter.py）。合うチャンクだけから k 件を探す。
+            "document_id"（1 つまたはリスト）を含めると、その文書のベクトル ID 区間だけを探す
+            （文書のセグメントだけを開き、区間内を総当たりするので、コストは文書の大きさに比例する）
+        """
+        query = np.asarray([embedding], dtype="float32")
+        snapshot = self._snapshot
+        id_ranges, normalized = self._scope(search_filter, snapshot)
+        if id_ranges is not None and len(id_ranges) == 0:
+            return []
+        hits = []
+        for seg in self._segments_for(id_ranges, snapshot):
+            hits.extend((dist, doc_id, seg) for dist, doc_id in seg.search(query, k, normalized, id_ranges))
+        return heapq.nsmallest(k, hits, key=lambda h: h[0])
+
+    def lexical_hits(self, query: str, k: int = 4, search_filter: dict | None = None) -> list[tuple]:
+        """文字 n-gram の BM25 で上位 k 件 [(スコア, ID, segment), ...]（スコアの降順）
+
+        N・平均文書長・df は絞り込み前の全体の値を使う（順位付けの基準をフィルタで変えない）
+        """
+        snapshot = self._snapshot
+        id_ranges, normalized = self._scope(search_filter, snapshot)
+        segments = [seg for seg in snapshot.segments if seg.chunks.has_lexical]
+        terms = tokenize(query)
+        if not segments or not terms or (id_ranges is not None and len(id_ranges) == 0):
+            return []
+        n_docs = total_len = 0
+        df: dict = {}
+        for seg in segments:
+            n, length = seg.chunks.lexical_stats()
+            n_docs += n
+            total_len += length
+            for term, count in seg.chunks.term_df(set(terms)).items():
+                df[term] = df.get(term, 0) + count
+        kept = select_terms(terms, df, n_docs)
+        if not kept:
+            return []
+        idfs = {term: idf(n_docs, df[term]) for term in kept}
+        avg_len = total_len / n_docs
+
+        scores: dict = {}
+        scoped = {seg.name for seg in self._segments_for(id_ranges, snapshot)}
+        for seg in segments:
+            if seg.name not in scoped:
+                continue
+            allowed = seg.selection(normalized)[0] if normalized else None
+            if allowed is not None and len(allowed) == 0:
+                continue
+            rows = seg.chunks.postings(kept, id_ranges)
+            if allowed is not None and rows:
+                keep = np.isin(np.fromiter((row[1] for row in rows), dtype="int64", count=len(rows)), allowed)
+                rows = [row for row, ok in zip(rows, keep) if ok]
+            for term, doc_id, tf, length in rows:
+                key = (doc_id, seg.name)
+                score, _ = scores.get(key, (0.0, seg))
+                scores[key] = (score + bm25_term(tf, length, avg_len, idfs[term]), seg)
+        top = heapq.nlargest(k, scores.items(), key=lambda item: item[1][0])
+        return [(score, doc_id, seg) for (doc_id, _), (score, seg) in top]
+
+    @staticmethod
+    def documents_for(hits: list) -> list:
+        """[(スコア, ID, segment), ...] の本文を、セグメントごとにまとめて読んで同じ順に返す（見つからないものは None）"""
+        wanted: dict = {}
+        for _, doc_id, seg in hits:
+            wanted.setdefault(seg.name, (seg, []))[1].append(doc_id)
+        found = {name: seg.get_many(ids) for name, (seg, ids) in wanted.items()}
+        return [found[seg.name].get(doc_id) for _, doc_id, seg in hits]
+
+    def similarity_search_with_score_by_vector(self, embedding, k: int = 4, filter: dict | None = None,
+                                               **kwargs) -> list:
+        # 本文は top-k の分だけ読む。filter は LangChain の search_kwargs={"filter": ...} と同じ名前
+        top = self.vector_hits(embedding, k, search_filter=filter)
+        return [
+            (doc, dist) for (dist, _, _), doc in zip(top, self.documents_for(top)) if doc is not None
+        ]
+
+    def lexical_search(self, query: str, k: int = 4, filter: dict | None = None) -> list:
+        """キーワード（BM25）だけで検索する [(Document, スコア), ...]"""
+        top = self.lexical_hits(query, k, search_filter=filter)
+        return [(doc, score) for (score, _, _), doc in zip(top, self.documents_for(top)) if doc is not None]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs) -> list:
+        embedding = self.embedding.embed_query(query)
+        return self.similarity_search_with_score_by_vector(embedding, k, **kwargs)
+
+    def similarity_search_by_vector(self, embedding, k: int = 4, **kwargs) -> list:
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, **kwargs)]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs) -> list:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def _select_relevance_score_fn(self):
+        return self._euclidean_relevance_score_fn
+
+    # ------------------------------------------------------------------
+    # 生成・移行
+    # ------------------------------------------------------------------
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, root_dir: str = "rag/vectorstore", **kwargs):
+        store = cls(root_dir, embedding)
+        store.add_texts(texts, metadatas)
+        return store
+
+    @classmethod
+    def load(cls, root_dir: str, embedding, mmap: bool | None = None) -> "SegmentedVectorStore":
+        """ストアを開く。manifest がなく旧形式（index.faiss/index.pkl）があれば移行する
+
+        mmap: 対応しているインデックスを読み取り専用 mmap で開く（省略時は VECTORSTORE_MMAP）
+        """
+        store = cls(root_dir, embedding, mmap=mmap)
+        if store._read_manifest() is None and os.path.exists(
+            os.path.join(root_dir, f"{LEGACY_INDEX_NAME}.faiss")
+        ):
+            store.migrate_legacy()
+        return store
+
+    def migrate_legacy(self):
+        """LangChain FAISS 形式の index.faiss/index.pkl を 1 セグメントに変換する"""
+        from langchain_community.vectorstores import FAISS
+
+        legacy = FAISS.load_local(
+            self.root_dir,
+            self.embedding,
+            index_name=LEGACY_INDEX_NAME,
+            allow_dangerous_deserialization=True,
+        )
+        n = legacy.index.ntotal
+        if n == 0:
+            return
+        vectors = legacy.index.reconstruct_n(0, n)
+        docs = [legacy.docstore.search(legacy.index_to_docstore_id[i]) for i in range(n)]
+        self.add_embeddings(vectors, docs)
+        logger.info(f"✅ Migrated legacy FAISS index ({n} vectors) to segment store")
@@ -0,0 +1,162 @@
+"""
+質問の埋め込みで引くセマンティック回答キャッシュ。
+
+言い換え（「標準仕様は？」と「標準仕様を教えて」など）を同じ質問とみなし、
+コサイン類似度がしきい値以上かつインデックスバージョンが一致すれば
+LLM を呼ばずに保存済みの回答と出典を返す。
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SEMANTIC_CACHE_ENABLED = os.environ.get("SEMANTIC_CACHE_ENABLED", "true").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_SIZE = int(os.environ.get("SEMANTIC_CACHE_SIZE", "512"))
+SEMANTIC_CACHE_TTL = float(os.environ.get("SEMANTIC_CACHE_TTL", "86400"))
+
+
+class SemanticCache:
+    """小さな専用ベクトル索引（正規化済み行列の内積検索）を持つ回答キャッシュ"""
+
+    def __init__(self, embed_fn, threshold: float = 0.95, max_entries: int = 512,
+                 ttl: float | None = 86400, clock=time.monotonic):
+        self.embed_fn = embed_fn
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl if ttl and ttl > 0 else None
+        self._clock = clock
+        self._entries: OrderedDict = OrderedDict()
+        self._matrix = None
+        self._keys: list = []
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _embed(self, question: str):
+        vector = np.asarray(self.embed_fn(question), dtype="float32")
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _rebuild(self):
+        self._keys = list(self._entries.keys())
+        if self._keys:
+            self._matrix = np.stack([self._entries[k]["vector"] for k in self._keys])
+        else:
+            self._matrix = None
+
+    def _expire(self):
+        if self.ttl is None:
+            return
+        now = self._clock()
+        expired = [k for k, e in self._entries.items() if e["expires_at"] <= now]
+        for k in expired:
+            del self._entries[k]
+        if expired:
+            self._matrix = None
+
+    def lookup(self, question: str, version: str) -> dict | None:
+        """類似質問の回答を返す（なければ None）"""
+        vector = self._embed(question)
+        with self._lock:
+            self._expire()
+            if self._matrix is None:
+                self._rebuild()
+            if self._matrix is None:
+                self.misses += 1
+                return None
+
+            scores = self._matrix @ vector
+            best = int(np.argmax(scores))
+            similarity = float(scores[best])
+            key = self._keys[best]
+            entry = self._entries[key]
+            if similarity < self.threshold or entry["version"] != version:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return {
+                "answer": entry["answer"],
+                "sources": entry["sources"],
+                "question": entry["question"],
+                "similarity": round(similarity, 4),
+            }
+
+    def store(self, question: str, answer: str, sources: list, version: str):
+        if self.max_entries <= 0:
+            return
+        vector = self._embed(question)
+        expires_at = self._clock() + self.ttl if self.ttl else float("inf")
+        with self._lock:
+            self._entries[self._next_id] = {
+                "question": question,
+                "vector": vector,
+                "answer": answer,
+                "sources": sources,
+                "version": version,
+                "expires_at": expires_at,
+            }
+            self._next_id += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._matrix = None
+
+    def invalidate(self, *_):
+        """全エントリを破棄（インデックス変更時に呼ばれる）"""
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "enabled": True,
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "threshold": self.threshold,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+_cache: SemanticCache | None = None
+_cache_lock = threading.Lock()
+
+
+def get_semantic_cache() -> SemanticCache | None:
+    """プロセス共通のセマンティックキャッシュ（無効なら None）"""
+    global _cache
+    if not SEMANTIC_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                from rag.embeddings import get_embedding
+                from rag.index_version import on_change
+
+                cache = SemanticCache(
+                    get_embedding().embed_query,
+                    threshold=SEMANTIC_CACHE_THRESHOLD,
+                    max_entries=SEMANTIC_CACHE_SIZE,
+                    ttl=SEMANTIC_CACHE_TTL,
+                )
+                on_change(cache.invalidate)
+                _cache = cache
+    return _cache
@@ -0,0 +1,122 @@
+"""
+ベクトルストアの起動時間の比較（全部読み込む場合と読み取り専用 mmap の場合）。
+
+モードごとに新しいプロセスを立ち上げ、ストアを開くまでの時間・RSS の増分・最初の検索の時間を測る。
+ページキャッシュは前の計測で温まっているので、本当のコールドスタート（Cloud Run の新規インスタンス）より
+読み込み側が有利になる点に注意（--drop_caches は root 権限が必要）。
+
+python -m rag.startup_benchmark [--vectorstore rag/vectorstore] [--repeat 3]
+"""
+
+import os
+import time
+import argparse
+import multiprocessing
+
+import numpy as np
+
+MODES = ("eager", "mmap")
+
+
+def _rss_bytes() -> int:
+    try:
+        with open("/proc/self/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def _measure(root_dir: str, mmap: bool) -> dict:
+    """子プロセスで 1 回分を測る"""
+    import faiss  # noqa: F401  import 時間を計測に含めない
+    from rag.segment_store import SegmentedVectorStore
+
+    rss_before = _rss_bytes()
+    t0 = time.perf_counter()
+    store = SegmentedVectorStore(root_dir, embedding=None, mmap=mmap)
+    open_seconds = time.perf_counter() - t0
+    rss_open = _rss_bytes()
+
+    dim = store.segments[0].index.d if store.segments else 0
+    first_query_ms = None
+    if dim:
+        query = np.random.default_rng(0).random(dim, dtype="float32").tolist()
+        t0 = time.perf_counter()
+        store.similarity_search_with_score_by_vector(query, k=5)
+        first_query_ms = (time.perf_counter() - t0) * 1000
+
+    stats = store.stats()
+    return {
+        "mode": "mmap" if mmap else "eager",
+        "open_seconds": round(open_seconds, 4),
+        "rss_delta_bytes": max(rss_open - rss_before, 0),
+        "rss_after_query_bytes": max(_rss_bytes() - rss_before, 0),
+        "first_query_ms": round(first_query_ms, 3) if first_query_ms is not None else None,
+        "segments": stats["segments"],
+        "mmapped_segments": stats["mmapped_segments"],
+        "vectors": stats["vectors"],
+    }
+
+
+def _drop_page_cache():
+    os.sync()
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3\n")
+
+
+def run_benchmark(root_dir: str, repeat: int = 3, drop_caches: bool = False) -> list[dict]:
+    ctx = multiprocessing.get_context("spawn")
+    rows = []
+    with ctx.Pool(1, maxtasksperchild=1) as pool:
+        for _ in range(repeat):
+            for mode in MODES:
+                if drop_caches:
+                    _drop_page_cache()
+                rows.append(pool.apply(_measure, (root_dir, mode == "mmap")))
+    return rows
+
+
+def summarize(rows: list[dict]) -> list[dict]:
+    """モードごとの中央値"""
+    summary = []
+    for mode in MODES:
+        picked = [r for r in rows if r["mode"] == mode]
+        if not picked:
+            continue
+        row = {"mode": mode}
+        for key in ("open_seconds", "rss_delta_bytes", "rss_after_query_bytes", "first_query_ms"):
+            values = [r[key] for r in picked if r[key] is not None]
+            row[key] = float(np.median(values)) if values else None
+        row["mmapped_segments"] = picked[0]["mmapped_segments"]
+        row["segments"] = picked[0]["segments"]
+        summary.append(row)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ベクトルストアの起動時間の比較（eager / mmap）")
+    parser.add_argument("--vectorstore", default=None, help="ベクトルストアの場所（既定: rag/vectorstore）")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--drop_caches", action="store_true", help="計測ごとにページキャッシュを捨てる（要 root）")
+    args = parser.parse_args(argv)
+
+    root_dir = args.vectorstore
+    if root_dir is None:
+        from rag.ingested_text import LOCAL_VECTOR_DIR
+        root_dir = LOCAL_VECTOR_DIR
+
+    summary = summarize(run_benchmark(root_dir, args.repeat, args.drop_caches))
+    for row in summary:
+        print(
+            f"{row['mode']:>5}: open {row['open_seconds'] * 1000:.1f} ms, "
+            f"RSS +{row['rss_delta_bytes'] / 2**20:.1f} MiB (after first query +{row['rss_after_query_bytes'] / 2**20:.1f} MiB), "
+            f"first query {row['first_query_ms'] or 0:.2f} ms, mmapped {row['mmapped_segments']}/{row['segments']} segments"
+        )
+    return summary
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""
+テナント（顧客）ごとのベクトルストア（シャード）。
+
+顧客の文書が混ざらないよう、テナントキーごとに独立した SegmentedVectorStore を
+rag/vectorstore_tenants/<テナント>/ に持ち、GCS にも vectorstore_tenants/<テナント>/ として別々に同期する。
+シャードは最初に使われたときに GCS から取得して開き、次のときに閉じる（参照を捨てる）:
+- 最後の利用から TENANT_IDLE_SECONDS 秒たった
+- 開いているシャードが TENANT_MAX_LOADED を超えた、または常駐サイズの合計が TENANT_MEMORY_BUDGET_MB を超えた
+  （最も長く使われていないものから）
+インスタンスのメモリは全テナントの合計ではなく、いま使われているテナントの分だけになる。
+追い出しはロードのたびのほか、最初のロード以降 TENANT_EVICT_INTERVAL_SECONDS ごとにバックグラウンドでも行う
+（新しいテナントが来なくても、使われなくなったシャードは閉じる）。
+
+テナントキーを指定しない要求は従来どおり rag/vectorstore（共有ストア）を使う。
+"""
+
+import os
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from rag.segment_store import SegmentedVectorStore
+
+logger = logging.getLogger(__name__)
+
+TENANT_VECTOR_DIR = os.path.join("rag", "vectorstore_tenants")
+TENANT_GCS_PREFIX = "vectorstore_tenants"
+TENANT_MAX_LOADED = int(os.environ.get("TENANT_MAX_LOADED", "16"))
+TENANT_IDLE_SECONDS = float(os.environ.get("TENANT_IDLE_SECONDS", "1800"))
+TENANT_MEMORY_BUDGET_MB = float(os.environ.get("TENANT_MEMORY_BUDGET_MB", "1024"))
+# 0 以下ならバックグラウンドでは追い出さない（ロード時だけ）
+TENANT_EVICT_INTERVAL_SECONDS = float(os.environ.get("TENANT_EVICT_INTERVAL_SECONDS", "60"))
+
+# ディレクトリ名・GCS のパスにそのまま使うので、区切り文字や "." は許さない
+_TENANT_KEY_RE = re.compile(r"^[\w\-]{1,64}$")
+
+
+def validate_tenant(tenant: str) -> str:
+    if not isinstance(tenant, str) or not _TENANT_KEY_RE.match(tenant):
+        raise ValueError(f"invalid tenant key: {tenant!r}")
+    return tenant
+
+
+def resident_bytes(store: SegmentedVectorStore) -> int:
+    """メモリに載っているインデックスの大きさ（mmap で開いたセグメントはページキャッシュなので数えない）"""
+    return sum(seg.index_bytes for seg in store.segments if not seg.mmapped)
+
+
+class TenantShards:
+    """テナントキー → シャード（遅延ロード + LRU で追い出し）"""
+
+    def __init__(self, root_dir: str = TENANT_VECTOR_DIR, embedding_factory=None, sync_factory=None,
+                 max_loaded: int = TENANT_MAX_LOADED, idle_seconds: float = TENANT_IDLE_SECONDS,
+                 memory_budget_mb: float = TENANT_MEMORY_BUDGET_MB, mmap: bool | None = None,
+                 evict_interval: float = TENANT_EVICT_INTERVAL_SECONDS):
+        self.root_dir = root_dir
+        self.max_loaded = max(1, max_loaded)
+        self.idle_seconds = idle_seconds
+        self.memory_budget_bytes = int(memory_budget_mb * 1024 * 1024)
+        self.mmap = mmap
+        self.evict_interval = evict_interval
+        self._embedding_factory = embedding_factory
+        self._sync_factory = sync_factory
+        self._loaded: OrderedDict = OrderedDict()  # テナント → (store, 最終利用時刻)
+        self._lock = threading.Lock()
+        self._load_locks: dict = {}  # ロード中のテナントだけ
+        self._stop = threading.Event()
+        self._evict_thread = None
+        self.loads = 0
+        self.evictions = 0
+
+    def shard_dir(self, tenant: str) -> str:
+        return os.path.join(self.root_dir, validate_tenant(tenant))
+
+    def sync(self, tenant: str):
+        """シャードの GCS 同期オブジェクト（GCS_BUCKET_NAME 未設定なら None）"""
+        if self._sync_factory is None:
+            from rag.gcs_sync import get_gcs_sync
+            return get_gcs_sync(self.shard_dir(tenant), prefix=f"{TENANT_GCS_PREFIX}/{tenant}")
+        return self._sync_factory(self.shard_dir(tenant), f"{TENANT_GCS_PREFIX}/{tenant}")
+
+    def _embedding(self):
+        if self._embedding_factory is None:
+            from rag.embeddings import get_embedding
+            self._embedding_factory = get_embedding
+        return self._embedding_factory()
+
+    def get(self, tenant: str) -> SegmentedVectorStore:
+        """テナントのシャード（開いていなければ GCS から取得して開く）"""
+        validate_tenant(tenant)
+        with self._lock:
+            if tenant in self._loaded:
+                store, _ = self._loaded[tenant]
+                self._loaded[tenant] = (store, time.time())
+                self._loaded.move_to_end(tenant)
+                return store
+            load_lock = self._load_locks.setdefault(tenant, threading.Lock())
+
+        # 同じテナントの同時ロードは 1 回にまとめる（他テナントの検索は止めない）
+        try:
+            with load_lock:
+                with self._lock:
+                    if tenant in self._loaded:
+                        return self._loaded[tenant][0]
+                store = self._open(tenant)
+                with self._lock:
+                    self._loaded[tenant] = (store, time.time())
+                    self._loaded.move_to_end(tenant)
+                    self.loads += 1
+        finally:
+            # 待っていた呼び出しはロックの参照を持っているので、ロードが終われば表から外してよい
+            with self._lock:
+                if self._load_locks.get(tenant) is load_lock:
+                    del self._load_locks[tenant]
+        self.evict(keep=tenant)
+        self.start_evictor()
+        return store
+
+    def _open(self, tenant: str) -> SegmentedVectorStore:
+        started = time.perf_counter()
+        path = self.shard_dir(tenant)
+        os.makedirs(path, exist_ok=True)
+        sync = self.sync(tenant)
+        if sync is not None:
+            try:
+                sync.download()
+            except Exception as e:
+                logger.error(f"❌ Tenant shard download failed ({tenant}): {e}")
+        store = SegmentedVectorStore.load(path, self._embedding(), mmap=self.mmap)
+        if sync is not None:
+            sync.attach_store(store)
+        logger.info(f"✅ Tenant shard loaded: {tenant} ({len(store)} vectors, "
+                    f"{(time.perf_counter() - started) * 1000:.1f} ms)")
+        return store
+
+    def evict(self, keep: str | None = None, now: float | None = None) -> list[str]:
+        """使われていない・上限を超えた分のシャードを閉じ、閉じたテナントを返す
+
+        検索中のリクエストは自分でストアの参照を持っているので、閉じても途中で壊れない。
+        """
+        now = time.time() if now is None else now
+        evicted = []
+        with self._lock:
+            for tenant, (_, last_used) in list(self._loaded.items()):
+                if tenant != keep and now - last_used > self.idle_seconds:
+                    del self._loaded[tenant]
+                    evicted.append(tenant)
+            sizes = {tenant: resident_bytes(store) for tenant, (store, _) in self._loaded.items()}
+            for tenant in list(self._loaded):
+                over_count = len(self._loaded) > self.max_loaded
+                over_budget = sum(sizes[t] for t in self._loaded) > self.memory_budget_bytes
+                if not (over_count or over_budget):
+                    break
+                if tenant == keep:
+                    continue
+                del self._loaded[tenant]
+                evicted.append(tenant)
+            self.evictions += len(evicted)
+        for tenant in evicted:
+            logger.info(f"Tenant shard evicted: {tenant}")
+        return evicted
+
+    def _evict_loop(self):
+        while not self._stop.wait(self.evict_interval):
+            try:
+                self.evict()
+            except Exception as e:
+                logger.error(f"❌ Tenant shard eviction failed: {e}")
+
+    def start_evictor(self):
+        """TENANT_EVICT_INTERVAL_SECONDS ごとに evict() するスレッドを（まだなければ）起動する"""
+        if self.evict_interval <= 0 or self._stop.is_set():
+            return
+        with self._lock:
+            if self._evict_thread is not None and self._evict_thread.is_alive():
+                return
+            self._evict_thread = threading.Thread(target=self._evict_loop, name="tenant-evictor", daemon=True)
+            self._evict_thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def loaded(self) -> list[str]:
+        with self._lock:
+            return list(self._loaded)
+
+    def loaded_stores(self) -> list[tuple]:
+        """開いているシャードの [(テナント, ストア), ...]（最終利用時刻は更新しない。ホットリロードなどの裏方用）"""
+        with self._lock:
+            return [(tenant, store) for tenant, (store, _) in self._loaded.items()]
+
+    def tenants(self) -> list[str]:
+        """ローカルにあるシャード（開いていないものも含む）"""
+        if not os.path.isdir(self.root_dir):
+            return []
+        return sorted(name for name in os.listdir(self.root_dir) if _TENANT_KEY_RE.match(name))
+
+    def stats(self) -> dict:
+        with self._lock:
+            loaded = {tenant: store for tenant, (store, _) in self._loaded.items()}
+        return {
+            "loaded": list(loaded),
+            "loaded_vectors": {tenant: len(store) for tenant, store in loaded.items()},
+            "resident_bytes": sum(resident_bytes(store) for store in loaded.values()),
+            "max_loaded": self.max_loaded,
+            "idle_seconds": self.idle_seconds,
+            "memory_budget_bytes": self.memory_budget_bytes,
+            "loading": len(self._load_locks),
+            "evict_interval_seconds": self.evict_interval,
+            "loads": self.loads,
+            "evictions": self.evictions,
+        }
+
+
+_shards: TenantShards | None = None
+_shards_lock = threading.Lock()
+
+
+def get_tenant_shards() -> TenantShards:
+    global _shards
+    if _shards is None:
+        with _shards_lock:
+            if _shards is None:
+                _shards = TenantShards()
+    return _shards
@@ -0,0 +1,15 @@
+# scripts/ann_report.py
+"""
+保存形式（fp16 / SQ8 / PQ）ごとのメモリと recall@k を比べるレポート（実体は rag/ann_report.py）。
+python scripts/ann_report.py [--pdf_dir rag/data] [--queries 200] [--k 5]
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rag.ann_report import main
+
+if __name__ == "__main__":
+    main()
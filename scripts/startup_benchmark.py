@@ -0,0 +1,15 @@
+# scripts/startup_benchmark.py
+"""
+ベクトルストアを全部読み込む場合と mmap で開く場合の起動時間の比較（実体は rag/startup_benchmark.py）。
+python scripts/startup_benchmark.py [--vectorstore rag/vectorstore] [--repeat 3]
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rag.startup_benchmark import main
+
+if __name__ == "__main__":
+    main()
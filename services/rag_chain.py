@@ -2,23 +2,16 @@ import os
 from langchain_openai import ChatOpenAI
 from langchain.prompts import PromptTemplate
 from langchain.chains import RetrievalQA
-from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import HuggingFaceEmbeddings
 from dotenv import load_dotenv
 from langsmith import traceable  # トレース用
+from rag.ingested_text import get_vectorstore
 
 load_dotenv()
 
-VECTOR_DIR = "rag/vectorstore"
-INDEX_NAME = "index"
-
 @traceable(name="rag_response_trace")
 def get_rag_response(query: str):
     # ベクトルストア読み込み
-    embeddings = HuggingFaceEmbeddings(model_name="intfloat/multilingual-e5-small")
-    vectorstore = FAISS.load_local(
-        VECTOR_DIR, embeddings, index_name=INDEX_NAME, allow_dangerous_deserialization=True
-    )
+    vectorstore = get_vectorstore()
 
     with open("rag/prompt_template.txt", encoding="utf-8") as f:
         prompt_str = f.read()
@@ -0,0 +1,66 @@
+# tests/test_answer_cache.py
+from rag.answer_cache import AnswerCache, source_names
+
+
+def src(name, page="1"):
+    return {"metadata": {"source": name, "page": page}}
+
+
+def make_cache(tmp_path, state):
+    return AnswerCache(
+        str(tmp_path / "answers.db"),
+        l1_size=8,
+        version_fn=lambda: state["version"],
+    )
+
+
+def test_hit_across_instances(tmp_path):
+    state = {"version": "v1"}
+    worker_a = make_cache(tmp_path, state)
+    worker_b = make_cache(tmp_path, state)
+
+    worker_a.put("標準仕様は？", "A です", [src("a.pdf")], "p1", "gpt")
+    assert worker_a.get("標準仕様は？ ", "p1", "gpt")["answer"] == "A です"   # L1
+    assert worker_b.get("標準仕様は？", "p1", "gpt")["answer"] == "A です"    # L2 (SQLite)
+    assert worker_b.stats()["l2"]["hits"] == 1
+    assert worker_b.get("標準仕様は？", "p2", "gpt") is None                   # プロンプトが違う
+    assert worker_b.get("標準仕様は？", "p1", "gpt-4") is None                 # モデルが違う
+
+
+def test_source_aware_invalidation(tmp_path):
+    state = {"version": "v1"}
+    cache = make_cache(tmp_path, state)
+    cache.put("q1", "A", [src("a.pdf"), src("b.pdf")], "p", "m")
+    cache.put("q2", "B", [src("b.pdf")], "p", "m")
+    cache.put("q3", "C", [src("c.pdf")], "p", "m")
+
+    assert cache.invalidate_sources(["b.pdf"]) == 2
+    assert cache.get("q1", "p", "m") is None
+    assert cache.get("q2", "p", "m") is None
+    assert cache.get("q3", "p", "m")["answer"] == "C"
+
+
+def test_version_change_misses(tmp_path):
+    state = {"version": "v1"}
+    cache = make_cache(tmp_path, state)
+    cache.put("q", "A", [src("a.pdf")], "p", "m")
+    state.update(version="v2")
+    assert cache.get("q", "p", "m") is None
+    assert cache.prune() == 1
+
+
+def test_new_document_evicts_existing_answers(tmp_path):
+    state = {"version": "v1"}
+    cache = make_cache(tmp_path, state)
+    cache.put("ABC-1200 の仕様は？", "資料には記載がありません", [src("old.pdf")], "p", "m")
+    cache.put("保証期間は？", "1 年です", [src("old.pdf")], "p", "m")
+
+    # spec.pdf を取り込んだ（bump_version(sources=["spec.pdf"]) → on_index_change）
+    state.update(version="v2")
+    cache.on_index_change("v2", ["spec.pdf"])
+    assert cache.get("ABC-1200 の仕様は？", "p", "m") is None
+    assert cache.stats()["l2"]["size"] == 0 and cache.stats()["invalidated"] == 2
+
+
+def test_source_names_dedup():
+    assert source_names([src("a.pdf", "1"), src("a.pdf", "2"), src("b.pdf")]) == ["a.pdf", "b.pdf"]
@@ -0,0 +1,89 @@
+# tests/test_bulk_ingest.py
+import os
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("faiss")
+pytest.importorskip("langchain_core")
+
+from langchain_core.documents import Document
+
+from rag import index_version
+from rag.bulk_ingest import run_bulk_ingest
+from rag.segment_store import SegmentedVectorStore
+
+from tests.test_segment_store import FakeEmbedding
+
+
+@pytest.fixture(autouse=True)
+def isolated_version(tmp_path, monkeypatch):
+    monkeypatch.setattr(index_version, "VERSION_PATH", str(tmp_path / "index.version"))
+    monkeypatch.setattr(index_version, "_listeners", [])
+    monkeypatch.setattr(index_version, "_cached", {"version": None, "generation": None, "mtime": None})
+
+
+def fake_parse(path):
+    if "broken" in path:
+        raise ValueError("not a pdf")
+    name = os.path.basename(path)
+    chunks = [Document(page_content=f"{name} chunk {i}", metadata={"source": name, "page": i}) for i in range(3)]
+    return path, 2, chunks
+
+
+def make_pdfs(tmp_path, names):
+    paths = []
+    for name in names:
+        path = tmp_path / name
+        path.write_bytes(f"%PDF {name}".encode())
+        paths.append(str(path))
+    return paths
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_bulk_ingest_writes_one_segment(tmp_path, workers):
+    paths = make_pdfs(tmp_path, [f"doc{i}.pdf" for i in range(4)] + ["broken.pdf"])
+    report = run_bulk_ingest(paths, root_dir=str(tmp_path / "vs"), embedding=FakeEmbedding(),
+                             workers=workers, batch_size=5, parse_fn=fake_parse)
+
+    assert (report["files"], report["pages"], report["chunks"]) == (4, 8, 12)
+    assert report["failed_files"] == [str(tmp_path / "broken.pdf")]
+    assert report["chunks_per_sec"] > 0
+
+    store = SegmentedVectorStore(str(tmp_path / "vs"), FakeEmbedding())
+    assert len(store.segments) == 1
+    assert len(store) == 12
+    assert len(store.ingested_files()) == 4
+
+
+def test_rerun_skips_already_ingested_content(tmp_path):
+    root = str(tmp_path / "vs")
+    paths = make_pdfs(tmp_path, ["a.pdf", "b.pdf"])
+    run_bulk_ingest(paths, root_dir=root, embedding=FakeEmbedding(), workers=1, parse_fn=fake_parse)
+
+    # 同じ内容を別名でコピーしたものも含めて再実行
+    copy = tmp_path / "a_copy.pdf"
+    copy.write_bytes((tmp_path / "a.pdf").read_bytes())
+    report = run_bulk_ingest(paths + [str(copy)], root_dir=root, embedding=FakeEmbedding(),
+                             workers=1, parse_fn=fake_parse)
+    assert report["skipped_files"] == 3
+    assert report["chunks"] == 0
+
+    store = SegmentedVectorStore(root, FakeEmbedding())
+    assert len(store) == 6
+    entry = [f for f in store.ingested_files(source="b.pdf")][0]
+    assert entry["chunks"] == 3
+    assert entry["vector_ids"] == [[3, 5]]
+
+
+def test_rebuild_replaces_existing_segments(tmp_path):
+    root = str(tmp_path / "vs")
+    store = SegmentedVectorStore(root, FakeEmbedding())
+    store.add_texts(["old one"])
+    store.add_texts(["old two"])
+
+    run_bulk_ingest(make_pdfs(tmp_path, ["new.pdf"]), root_dir=root, embedding=FakeEmbedding(),
+                    workers=1, parse_fn=fake_parse, rebuild=True)
+    store.reload()
+    assert len(store.segments) == 1
+    assert {d.metadata["source"] for d in store.similarity_search("new.pdf chunk", k=5)} == {"new.pdf"}
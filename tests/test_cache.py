@@ -0,0 +1,51 @@
+# tests/test_cache.py
+from rag.cache import LRUTTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_eviction():
+    cache = LRUTTLCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1   # a を最近使ったことにする
+    cache.set("c", 3)            # → b が追い出される
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_ttl_expiration():
+    clock = FakeClock()
+    cache = LRUTTLCache(max_size=10, ttl=5, clock=clock)
+    cache.set("q", [0.1, 0.2])
+    clock.now = 4.9
+    assert cache.get("q") == [0.1, 0.2]
+    clock.now = 5.0
+    assert cache.get("q") is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_hit_miss_counters():
+    cache = LRUTTLCache(max_size=10)
+    cache.get("x")
+    cache.set("x", 1)
+    cache.get("x")
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["hit_rate"] == 0.5
+
+
+def test_disabled_cache():
+    cache = LRUTTLCache(max_size=0)
+    cache.set("x", 1)
+    assert cache.get("x") is None
+    assert len(cache) == 0
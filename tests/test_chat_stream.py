@@ -0,0 +1,165 @@
+# tests/test_chat_stream.py
+import json
+import asyncio
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("dotenv")
+pytest.importorskip("sentence_transformers")
+
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessageChunk
+
+import main
+from api.routers import chat
+from rag import ingested_text
+
+
+class FakeRetriever:
+    def __init__(self, docs, error=None):
+        self.docs = docs
+        self.error = error
+        self.queries = []
+
+    async def ainvoke(self, query):
+        self.queries.append(query)
+        if self.error is not None:
+            raise self.error
+        return self.docs
+
+
+class FakeChain:
+    def __init__(self, retriever):
+        self.retriever = retriever
+
+
+class FakeLLM:
+    model_name = "fake"
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    async def astream(self, prompt):
+        for token in self.tokens:
+            yield AIMessageChunk(content=token)
+
+
+DOCS = [Document(page_content="型番 ABC-1200 の仕様", metadata={"source": "spec.pdf", "page": 3})]
+
+
+def run_stream(req):
+    async def collect():
+        return [chunk async for chunk in chat._stream_chat(req)]
+
+    events = []
+    for chunk in asyncio.run(collect()):
+        lines = chunk.strip().split("\n")
+        events.append((lines[0].removeprefix("event: "), json.loads(lines[1].removeprefix("data: "))))
+    return events
+
+
+@pytest.fixture
+def app_state(monkeypatch):
+    """main のグローバル（ストア・チェーン・LLM）とキャッシュを差し替える"""
+    retriever = FakeRetriever(DOCS)
+    state = {"retriever": retriever, "stored": [], "stored_versions": [], "filtered": []}
+    monkeypatch.setattr(main, "vectorstore", object())
+    monkeypatch.setattr(main, "rag_chain_template", FakeChain(retriever))
+    monkeypatch.setattr(main, "llm_instance", FakeLLM(["ABC-1200 は", "仕様書の 3 ページです。"]))
+    monkeypatch.setattr(chat, "history_logs", [])
+
+    async def lookup(query):
+        return state.get("cached")
+
+    async def store(query, answer, sources, index_version):
+        state["stored"].append((query, answer))
+        state["stored_versions"].append(index_version)
+
+    def filtered(chain, vectorstore, search_filter=None):
+        state["filtered"].append(search_filter)
+        return FakeChain(retriever)
+
+    monkeypatch.setattr(chat, "_cache_lookup", lookup)
+    monkeypatch.setattr(chat, "_cache_store", store)
+    monkeypatch.setattr(ingested_text, "filtered_chain", filtered)
+    return state
+
+
+def test_filtered_stream_keeps_generated_answer_without_caching(app_state):
+    req = chat.ChatRequest(question="ABC-1200 の仕様は？", filters={"customer": ["A社"]})
+    events = run_stream(req)
+
+    done = events[-1][1]
+    assert done["answer"] == "ABC-1200 は仕様書の 3 ページです。"
+    assert chat.history_logs[-1]["answer"] == done["answer"]
+    assert app_state["filtered"] == [{"customer": ["A社"]}]
+    # 絞り込みありの回答はキャッシュしない
+    assert app_state["stored"] == []
+
+
+def test_stream_event_order(app_state):
+    events = run_stream(chat.ChatRequest(question="ABC-1200 の仕様は？"))
+
+    assert [name for name, _ in events] == ["sources", "token", "token", "done"]
+    assert events[0][1]["sources"][0]["metadata"]["source"] == "spec.pdf"
+    done = events[-1][1]
+    assert done["status"] == "ok" and done["cached"] is None
+    assert done["answer"] == "".join(data["token"] for name, data in events if name == "token")
+    assert {"retrieval_ms", "first_token_ms", "total_ms"} <= set(done["timings"])
+    assert app_state["stored"] == [("ABC-1200 の仕様は？", done["answer"])]
+
+
+def test_stream_error_is_reported_in_done(app_state):
+    app_state["retriever"].error = RuntimeError("faiss exploded")
+    events = run_stream(chat.ChatRequest(question="ABC-1200 の仕様は？"))
+
+    assert [name for name, _ in events] == ["error", "done"]
+    error, done = events[0][1], events[1][1]
+    assert done["status"] == "error"
+    assert done["error_id"] == error["error_id"]
+    assert error["error_id"] in done["answer"]
+
+
+def test_stream_cache_hit_skips_retrieval_and_generation(app_state):
+    cached_sources = [{"metadata": {"source": "spec.pdf", "page": "3"}}]
+    app_state["cached"] = {"answer": "キャッシュの回答", "sources": cached_sources, "cache": "exact"}
+    events = run_stream(chat.ChatRequest(question="ABC-1200 の仕様は？"))
+
+    assert [name for name, _ in events] == ["sources", "done"]
+    assert events[0][1] == {"sources": cached_sources, "cached": "exact"}
+    assert events[1][1]["answer"] == "キャッシュの回答" and events[1][1]["cached"] == "exact"
+    assert app_state["retriever"].queries == [] and app_state["stored"] == []
+
+
+def test_answer_is_cached_under_the_version_it_was_built_from(app_state, monkeypatch):
+    version = {"current": "v1"}
+    monkeypatch.setattr(chat, "current_version", lambda: version["current"])
+    retriever = app_state["retriever"]
+    original = retriever.ainvoke
+
+    async def ingest_during_retrieval(query):
+        version["current"] = "v2"  # 検索中に取り込みが終わった
+        return await original(query)
+
+    retriever.ainvoke = ingest_during_retrieval
+    run_stream(chat.ChatRequest(question="ABC-1200 の仕様は？"))
+    assert app_state["stored_versions"] == ["v1"]
+
+
+def test_cache_store_skips_exact_cache_after_index_change(monkeypatch):
+    calls = []
+
+    class Cache:
+        def put(self, *args):
+            calls.append(("exact", args))
+
+        def store(self, question, answer, sources, version):
+            calls.append(("semantic", version))
+
+    monkeypatch.setattr(chat, "get_answer_cache", lambda: Cache())
+    monkeypatch.setattr(chat, "get_semantic_cache", lambda: Cache())
+    monkeypatch.setattr(chat, "_prompt_fingerprint", lambda: "p")
+    monkeypatch.setattr(chat, "current_version", lambda: "v2")
+    chat._cache_store_sync("質問", "回答", [], "v1")
+    assert calls == [("semantic", "v1")]
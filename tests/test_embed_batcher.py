@@ -0,0 +1,64 @@
+# tests/test_embed_batcher.py
+import threading
+
+from rag.embed_batcher import EmbeddingBatcher
+
+
+def fake_encode(calls):
+    def encode(texts):
+        calls.append(list(texts))
+        return [[float(len(t)), 1.0] for t in texts]
+    return encode
+
+
+def test_concurrent_queries_are_coalesced():
+    calls = []
+    batcher = EmbeddingBatcher(fake_encode(calls), window_ms=200, max_batch_size=8)
+    results = {}
+    barrier = threading.Barrier(4)
+
+    def worker(text):
+        barrier.wait()
+        results[text] = batcher.embed(text, timeout=5)
+
+    threads = [threading.Thread(target=worker, args=(t,)) for t in ["a", "bb", "ccc", "dddd"]]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert results == {"a": [1.0, 1.0], "bb": [2.0, 1.0], "ccc": [3.0, 1.0], "dddd": [4.0, 1.0]}
+    assert len(calls) < 4
+    stats = batcher.stats()
+    assert stats["items"] == 4
+    assert stats["max_batch_seen"] >= 2
+    batcher.close()
+
+
+def test_duplicate_queries_in_one_batch_are_encoded_once():
+    calls = []
+    batcher = EmbeddingBatcher(fake_encode(calls), window_ms=200, max_batch_size=2)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(batcher.embed("xy", timeout=5))) for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert results == [[2.0, 1.0], [2.0, 1.0]]
+    assert calls == [["xy"]]
+    batcher.close()
+
+
+def test_errors_propagate_to_callers():
+    def broken(texts):
+        raise ValueError("boom")
+
+    batcher = EmbeddingBatcher(broken, window_ms=1)
+    try:
+        batcher.embed("q", timeout=5)
+        assert False, "exception expected"
+    except ValueError:
+        pass
+    assert batcher.stats()["errors"] == 1
+    batcher.close()
@@ -0,0 +1,188 @@
+# tests/test_gcs_sync.py
+import time
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("faiss")
+pytest.importorskip("langchain_core")
+
+from rag import gcs_sync, segment_store
+from rag.gcs_sync import GCSSync
+from rag.segment_store import SegmentedVectorStore, file_md5
+
+from tests.test_segment_store import FakeEmbedding
+
+
+class PreconditionFailed(Exception):
+    code = 412
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    @property
+    def md5_hash(self):
+        return self.bucket.objects[self.name][1]
+
+    @property
+    def generation(self):
+        entry = self.bucket.objects.get(self.name)
+        return entry[2] if entry else None
+
+    def exists(self):
+        return self.name in self.bucket.objects
+
+    def reload(self):
+        pass
+
+    def upload_from_filename(self, path, if_generation_match=None):
+        # GCS と同じく 0 は「まだ無いこと」
+        if if_generation_match is not None and (self.generation or 0) != if_generation_match:
+            raise PreconditionFailed("precondition failed")
+        with open(path, "rb") as f:
+            data = f.read()
+        self.bucket.generation += 1
+        self.bucket.objects[self.name] = (data, file_md5(path), self.bucket.generation)
+        self.bucket.uploads.append(self.name)
+
+    def download_to_filename(self, path):
+        with open(path, "wb") as f:
+            f.write(self.bucket.objects[self.name][0])
+        self.bucket.downloads.append(self.name)
+
+    def download_as_bytes(self, if_generation_match=None):
+        return self.bucket.objects[self.name][0]
+
+    def delete(self):
+        del self.bucket.objects[self.name]
+
+
+class FakeBucket:
+    def __init__(self):
+        self.objects = {}
+        self.generation = 0
+        self.uploads = []
+        self.downloads = []
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+
+class FakeClient:
+    def __init__(self):
+        self._bucket = FakeBucket()
+
+    def bucket(self, name):
+        return self._bucket
+
+    def list_blobs(self, bucket_name, prefix=""):
+        return [FakeBlob(self._bucket, n) for n in list(self._bucket.objects) if n.startswith(prefix)]
+
+
+def _sync(client, path, **kwargs):
+    return GCSSync("bucket", str(path), client_factory=lambda: client, **kwargs)
+
+
+def test_upload_sends_only_new_files(tmp_path):
+    client = FakeClient()
+    store = SegmentedVectorStore(str(tmp_path), FakeEmbedding())
+    sync = _sync(client, tmp_path)
+
+    store.add_texts(["aaaa"])
+    assert sync.upload() == 3  # index.faiss + chunks.db + manifest
+    assert sync.upload() == 0  # 変更なし
+
+    store.add_texts(["bbbb"])
+    client.bucket("bucket").uploads.clear()
+    assert sync.upload() == 3
+    assert all("seg-" in n or n.endswith("manifest.json") for n in client.bucket("bucket").uploads)
+    assert sync.skipped_files == 2
+
+
+def test_download_skips_unchanged_manifest(tmp_path):
+    client = FakeClient()
+    store = SegmentedVectorStore(str(tmp_path / "a"), FakeEmbedding())
+    store.add_texts(["aaaa"])
+    _sync(client, tmp_path / "a").upload()
+
+    remote = _sync(client, tmp_path / "b")
+    assert remote.download() is True
+    assert remote.downloaded_files == 2
+    assert len(SegmentedVectorStore(str(tmp_path / "b"), FakeEmbedding())) == 1
+
+    client.bucket("bucket").downloads.clear()
+    assert remote.download() is True
+    assert client.bucket("bucket").downloads == []
+
+    # 新しいセグメントだけを取りに行く
+    store.add_texts(["bbbb"])
+    _sync(client, tmp_path / "a").upload()
+    remote.download()
+    assert len(client.bucket("bucket").downloads) == 2
+    assert len(SegmentedVectorStore(str(tmp_path / "b"), FakeEmbedding())) == 2
+
+
+def test_schedule_upload_is_debounced(tmp_path):
+    client = FakeClient()
+    store = SegmentedVectorStore(str(tmp_path), FakeEmbedding())
+    sync = _sync(client, tmp_path, debounce_seconds=0.05)
+
+    for text in ["aaaa", "bbbb", "cccc"]:
+        store.add_texts([text])
+        sync.schedule_upload()
+    assert sync.pending
+
+    deadline = time.time() + 5
+    while sync.uploads == 0 and time.time() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    assert sync.uploads == 1
+    assert client.bucket("bucket").uploads.count("vectorstore/manifest.json") == 1
+
+
+def _add(store, text, source, sha):
+    vector = np.array(FakeEmbedding().embed_documents([text]), dtype="float32")
+    doc = segment_store.Document(page_content=text, metadata={"source": source})
+    store.add_embeddings(vector, [doc], files=[{"sha256": sha, "source": source, "count": 1}])
+
+
+def test_upload_conflict_rebases_local_changes_onto_remote(tmp_path, monkeypatch):
+    client = FakeClient()
+    a = SegmentedVectorStore(str(tmp_path / "a"), FakeEmbedding())
+    _add(a, "aaaa", "a.pdf", "sha-a")
+    _add(a, "old0", "old.pdf", "sha-old")
+    sync_a = _sync(client, tmp_path / "a")
+    sync_a.upload()
+
+    sync_b = _sync(client, tmp_path / "b")
+    sync_b.download()
+    b = SegmentedVectorStore(str(tmp_path / "b"), FakeEmbedding())
+    sync_b.attach_store(b)
+
+    # 両方のインスタンスが同じ版から別々に取り込み・削除する（ID 2 が両方で使われる）
+    _add(a, "bbbb", "b.pdf", "sha-b")
+    sync_a.upload()
+    _add(b, "cccc", "c.pdf", "sha-c")
+    b.delete_source("old.pdf")
+
+    # かけ直しは検索中のストア b に対して行う（同じディレクトリをもう一度開かない）
+    monkeypatch.setattr(gcs_sync, "SegmentedVectorStore", None)
+    sync_b.upload()  # 競合 → a の版の上にかけ直して送り直す
+    assert (sync_b.conflicts, sync_b.rebases) == (1, 1)
+    assert not sync_b.has_local_changes()
+    assert b.refresh() is False  # 読み込み直さなくても検索に反映済み
+    assert sorted(f["source"] for f in b.ingested_files()) == ["a.pdf", "b.pdf", "c.pdf"]
+    ids = np.concatenate([seg.ids() for seg in b.segments])
+    assert len(ids) == len(set(ids.tolist())) == 3
+    c_range = b.ingested_file("sha-c")["vector_ids"]
+    assert [d.page_content for d in b.similarity_search_by_vector(
+        FakeEmbedding().embed_query("cccc"), k=1, filter={"document_id": "sha-c"})] == ["cccc"]
+    assert c_range[0][0] >= 3  # a が使った ID の後ろに振り直された
+
+    # a からは b の変更が見える
+    sync_a.download()
+    a.refresh()
+    assert sorted(f["source"] for f in a.ingested_files()) == ["a.pdf", "b.pdf", "c.pdf"]
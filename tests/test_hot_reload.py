@@ -0,0 +1,101 @@
+# tests/test_hot_reload.py
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("faiss")
+pytest.importorskip("langchain_core")
+
+from rag import hot_reload, segment_store
+from rag.hot_reload import IndexWatcher, changed_sources
+from rag.segment_store import SegmentedVectorStore
+
+from tests.test_segment_store import FakeEmbedding
+
+
+def test_watcher_picks_up_index_published_by_another_instance(tmp_path, monkeypatch):
+    bumped = []
+    monkeypatch.setattr(hot_reload, "bump_version", lambda sources=None: bumped.append(sources))
+    writer = SegmentedVectorStore(str(tmp_path), FakeEmbedding())
+    writer.add_texts(["aaaa"], [{"source": "a.pdf"}])
+    reader = SegmentedVectorStore.load(str(tmp_path), FakeEmbedding())
+    watcher = IndexWatcher(lambda: [("shared", reader, None, True)], interval=0)
+
+    assert watcher.check() == []
+    before = reader.segments
+    doc = segment_store.Document(page_content="bbbb", metadata={"source": "b.pdf"})
+    writer.add_embeddings(np.array(FakeEmbedding().embed_documents(["bbbb"]), dtype="float32"), [doc],
+                          files=[{"sha256": "sha-b", "source": "b.pdf", "count": 1}])
+    assert watcher.check() == ["shared"]
+    assert len(reader) == 2 and len(before) == 1  # 差し替え前の一覧はそのまま（検索中のリクエスト用）
+    assert reader.similarity_search("bbbb", k=1)[0].metadata["source"] == "b.pdf"
+    assert bumped == [["b.pdf"]]
+    assert watcher.check() == [] and watcher.stats()["reloads"] == 1
+
+
+def test_changed_sources_diffs_the_ledger():
+    old = {"segments": [{"name": "s1", "ledgered": True}],
+           "ingested_files": {"x": {"source": "a.pdf"}, "y": {"source": "b.pdf"}}}
+    new = {"segments": [{"name": "s1", "ledgered": True}, {"name": "s2", "ledgered": True}],
+           "ingested_files": {"x": {"source": "a.pdf"}, "z": {"source": "c.pdf"}}}
+    assert changed_sources(old, new) == ["b.pdf", "c.pdf"]
+    # マージだけなら出典は変わらない
+    merged = {"segments": [{"name": "s3", "ledgered": True, "merged_from": ["s1", "s2"]}],
+              "ingested_files": new["ingested_files"]}
+    assert changed_sources(new, merged) == []
+    # 台帳のない追加（add_texts）は分からないので全体を無効化
+    assert changed_sources(new, {**new, "segments": new["segments"] + [{"name": "s4"}]}) is None
+
+
+def test_watcher_retries_upload_of_local_changes_after_conflict(tmp_path, monkeypatch):
+    from tests.test_gcs_sync import FakeClient, _add, _sync
+
+    monkeypatch.setattr(hot_reload, "bump_version", lambda sources=None: None)
+    client = FakeClient()
+    a = SegmentedVectorStore(str(tmp_path / "a"), FakeEmbedding())
+    _add(a, "aaaa", "a.pdf", "sha-a")
+    sync_a = _sync(client, tmp_path / "a")
+    sync_a.upload()
+    sync_b = _sync(client, tmp_path / "b")
+    sync_b.download()
+    b = SegmentedVectorStore.load(str(tmp_path / "b"), FakeEmbedding())
+
+    _add(a, "bbbb", "b.pdf", "sha-b")
+    sync_a.upload()
+    _add(b, "cccc", "c.pdf", "sha-c")
+    monkeypatch.setattr(sync_b, "upload", lambda: 0)  # 競合で送れなかったまま残る
+    watcher = IndexWatcher(lambda: [("shared", b, sync_b, True)], interval=0)
+    watcher.check()
+    assert sync_b.has_local_changes() and watcher.stats()["skipped_downloads"] == 1
+
+    monkeypatch.undo()
+    monkeypatch.setattr(hot_reload, "bump_version", lambda sources=None: None)
+    assert watcher.check() == ["shared"]  # 送り直し（GCS の版の上にかけ直す）→ 取得
+    assert not sync_b.has_local_changes()
+    assert sorted(f["source"] for f in b.ingested_files()) == ["a.pdf", "b.pdf", "c.pdf"]
+
+
+def test_watcher_drops_local_changes_that_never_upload(tmp_path, monkeypatch):
+    from tests.test_gcs_sync import FakeClient, _add, _sync
+
+    monkeypatch.setattr(hot_reload, "bump_version", lambda sources=None: None)
+    client = FakeClient()
+    a = SegmentedVectorStore(str(tmp_path / "a"), FakeEmbedding())
+    _add(a, "aaaa", "a.pdf", "sha-a")
+    sync_a = _sync(client, tmp_path / "a")
+    sync_a.upload()
+    sync_b = _sync(client, tmp_path / "b")
+    sync_b.download()
+    b = SegmentedVectorStore.load(str(tmp_path / "b"), FakeEmbedding())
+
+    _add(a, "bbbb", "b.pdf", "sha-b")
+    sync_a.upload()
+    _add(b, "cccc", "c.pdf", "sha-c")
+    monkeypatch.setattr(sync_b, "upload", lambda: 0)
+    watcher = IndexWatcher(lambda: [("shared", b, sync_b, True)], interval=0, max_upload_failures=2)
+
+    assert watcher.check() == []
+    assert watcher.check() == ["shared"]  # 2 回続けて送れなかった → ローカルの変更を捨てて GCS の版に合わせる
+    assert not sync_b.has_local_changes()
+    assert sorted(f["source"] for f in b.ingested_files()) == ["a.pdf", "b.pdf"]
+    stats = watcher.stats()
+    assert stats["dropped_local_changes"] == 1 and "dropped local changes" in stats["last_error"]
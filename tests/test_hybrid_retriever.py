@@ -0,0 +1,49 @@
+# tests/test_hybrid_retriever.py
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("faiss")
+pytest.importorskip("langchain_core")
+
+from rag.hybrid_retriever import HybridRetriever, reciprocal_rank_fusion
+from rag.lexical import tokenize
+from rag.segment_store import SegmentedVectorStore
+
+from tests.test_segment_store import FakeEmbedding
+
+
+def test_tokenize_keeps_product_codes_and_bigrams():
+    tokens = tokenize("型番ＸＲ－２００の仕様")
+    assert "xr-200" in tokens
+    assert {"型番", "仕様"} <= set(tokens)
+
+
+def test_rrf_prefers_items_ranked_high_in_both_lists():
+    fused = reciprocal_rank_fusion([[("a", 1), ("b", 2)], [("b", 2), ("c", 3)]], [1.0, 1.0], rrf_k=60)
+    assert [key for _, key, _ in fused] == ["b", "a", "c"]
+
+
+def test_lexical_search_finds_exact_code_across_segments(tmp_path):
+    store = SegmentedVectorStore(str(tmp_path), FakeEmbedding())
+    store.add_texts(["標準仕様は耐熱ガラスです", "保証期間は一年です"], [{"source": "a.pdf"}, {"source": "a.pdf"}])
+    store.add_texts(["型番 XR-200 の定格電圧は 100V", "型番 XR-300 の定格電圧は 200V"],
+                    [{"source": "b.pdf"}, {"source": "b.pdf"}])
+
+    hits = store.lexical_search("XR-300 の電圧", k=2)
+    assert hits[0][0].page_content.startswith("型番 XR-300")
+
+    # 再起動後も同じ転置インデックスで引ける
+    reopened = SegmentedVectorStore(str(tmp_path), FakeEmbedding())
+    retriever = HybridRetriever(vectorstore=reopened, k=2, fetch_k=4)
+    docs = retriever.invoke("ＸＲ－３００")
+    assert docs[0].page_content.startswith("型番 XR-300")
+    assert len(docs) == 2
+
+
+def test_deleted_chunks_leave_the_lexical_index(tmp_path):
+    store = SegmentedVectorStore(str(tmp_path), FakeEmbedding())
+    store.add_texts(["カタログ ABC-1"], [{"source": "old.pdf"}])
+    store.add_texts(["カタログ ABC-2"], [{"source": "new.pdf"}])
+    store.delete_source("old.pdf")
+    assert [d.metadata["source"] for d, _ in store.lexical_search("abc-1", k=5)] != ["old.pdf"]
+    assert all(d.metadata["source"] == "new.pdf" for d, _ in store.lexical_search("カタログ", k=5))
@@ -0,0 +1,20 @@
+# tests/test_index_version.py
+from rag import index_version
+
+
+def test_bump_notifies_listeners(tmp_path, monkeypatch):
+    monkeypatch.setattr(index_version, "VERSION_PATH", str(tmp_path / "index.version"))
+    monkeypatch.setattr(index_version, "_listeners", [])
+    monkeypatch.setattr(index_version, "_cached", {"version": None, "generation": None, "mtime": None})
+
+    events = []
+    index_version.on_change(lambda version, sources: events.append((version, sources)))
+
+    assert index_version.current_version() == "0"
+    v1 = index_version.bump_version(sources=["a.pdf"])
+    assert index_version.current_version() == v1
+    assert index_version.current_generation() == "0"
+    v2 = index_version.bump_version()
+    assert v2 != v1
+    assert index_version.current_generation() == v2
+    assert events == [(v1, ["a.pdf"]), (v2, None)]
@@ -0,0 +1,120 @@
+# tests/test_ingest_jobs.py
+import time
+import threading
+
+from rag.ingest_jobs import IngestJobQueue, IngestJobStore
+
+
+def fake_ingest(path, source_name=None, progress=None, **kwargs):
+    progress("chunking", pages_parsed=2)
+    progress("embedding", chunks_total=4)
+    progress("embedding", chunks_embedded=4)
+    progress("saving")
+    return 4
+
+
+def make_queue(tmp_path, ingest_fn=fake_ingest):
+    store = IngestJobStore(str(tmp_path / "jobs.db"))
+    return IngestJobQueue(store, ingest_fn=ingest_fn, max_workers=1, upload_dir=str(tmp_path / "uploads"))
+
+
+def test_job_runs_in_background_and_records_progress(tmp_path):
+    queue = make_queue(tmp_path)
+    job = queue.submit_bytes("仕様書.pdf", b"%PDF-1.4")
+    assert job["status"] == "queued"
+
+    future = queue.future(job["id"])
+    if future is not None:
+        future.result(timeout=5)
+    done = queue.store.get(job["id"])
+    assert done["status"] == "succeeded"
+    assert (done["pages_parsed"], done["chunks_total"], done["chunks_embedded"]) == (2, 4, 4)
+    assert done["added_docs"] == 4
+    assert not (tmp_path / "uploads" / f"{job['id']}.pdf").exists()
+
+
+def test_failed_job_keeps_error(tmp_path):
+    def broken(path, source_name=None, progress=None, **kwargs):
+        raise ValueError("壊れた PDF")
+
+    queue = make_queue(tmp_path, broken)
+    job = queue.submit_bytes("bad.pdf", b"xx")
+    future = queue.future(job["id"])
+    if future is not None:
+        future.result(timeout=5)
+    failed = queue.store.get(job["id"])
+    assert failed["status"] == "failed"
+    assert "壊れた PDF" in failed["error"]
+
+
+def wait_for_status(store, job_id, status, timeout=5):
+    deadline = time.time() + timeout
+    while store.get(job_id)["status"] != status:
+        assert time.time() < deadline, f"job {job_id} did not reach {status}"
+        time.sleep(0.01)
+
+
+def test_unfinished_jobs_resume_once_after_restart(tmp_path):
+    release = threading.Event()
+    first_seen = []
+
+    def blocked(path, source_name=None, progress=None, **kwargs):
+        first_seen.append(source_name)
+        release.wait(5)
+        return 1
+
+    first = make_queue(tmp_path, blocked)
+    job = first.submit_bytes("a.pdf", b"%PDF")
+    waiting = first.submit_bytes("b.pdf", b"%PDF")  # ワーカー 1 本なので queued のまま
+    wait_for_status(first.store, job["id"], "running")
+
+    # 別のプロセス相当（同じ DB / アップロード先）。a.pdf は first がリース中なので取らない
+    seen = []
+    second = make_queue(tmp_path, lambda path, source_name=None, progress=None, **kwargs: seen.append(source_name) or 1)
+    assert second.resume() == 1
+    future = second.future(waiting["id"])
+    if future is not None:
+        future.result(timeout=5)
+    assert second.store.get(waiting["id"])["status"] == "succeeded"
+
+    release.set()
+    first.shutdown(wait=True)
+    # 各ジョブは 1 回だけ取り込まれる（b.pdf は first では claim できずに飛ばされる）
+    assert first_seen == ["a.pdf"] and seen == ["b.pdf"]
+    assert first.store.get(job["id"])["status"] == "succeeded"
+
+
+def test_running_job_with_expired_lease_is_taken_over(tmp_path):
+    seen = []
+    queue = make_queue(tmp_path, lambda path, source_name=None, progress=None, **kwargs: seen.append(source_name) or 1)
+    path = queue.job_path("orphan")
+    with open(path, "wb") as f:
+        f.write(b"%PDF")
+    queue.store.create("orphan.pdf", path, job_id="orphan")
+    # 落ちたプロセスが実行中のまま残したジョブ
+    assert queue.store.claim("orphan", "dead-worker")
+    queue.store.update("orphan", heartbeat=time.time() - 3600)
+    assert not queue.store.claim("orphan", "other-worker", lease_seconds=7200)
+
+    assert queue.resume() == 1
+    future = queue.future("orphan")
+    if future is not None:
+        future.result(timeout=5)
+    done = queue.store.get("orphan")
+    assert (done["status"], done["owner"]) == ("succeeded", queue.owner)
+    assert seen == ["orphan.pdf"]
+
+
+def test_duplicate_content_is_recorded_as_skipped(tmp_path):
+    def already_ingested(path, source_name=None, progress=None, **kwargs):
+        progress("skipped")
+        return {"added_docs": 0, "skipped": True, "sha256": "abc", "duplicate_of": "原本.pdf"}
+
+    queue = make_queue(tmp_path, already_ingested)
+    job = queue.submit_bytes("コピー.pdf", b"%PDF")
+    future = queue.future(job["id"])
+    if future is not None:
+        future.result(timeout=5)
+    done = queue.store.get(job["id"])
+    assert (done["status"], done["stage"], done["skipped"]) == ("succeeded", "skipped", 1)
+    assert done["duplicate_of"] == "原本.pdf"
@@ -0,0 +1,35 @@
+# tests/test_ingested_text.py
+import time
+import threading
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("faiss")
+pytest.importorskip("sentence_transformers")
+
+from rag import ingested_text
+
+
+def test_ingest_lock_serializes_same_document_and_is_pruned():
+    events = []
+
+    def ingest(n):
+        with ingested_text._ingest_lock("sha-a", "A社"):
+            events.append(("start", n))
+            time.sleep(0.02)
+            events.append(("end", n))
+
+    threads = [threading.Thread(target=ingest, args=(n,)) for n in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # 同じ文書の取り込みは重ならない
+    assert all(events[i][0] == "start" and events[i + 1] == ("end", events[i][1]) for i in range(0, 6, 2))
+    # 終わった文書のロックは残らない（例外で抜けたときも）
+    with pytest.raises(ValueError):
+        with ingested_text._ingest_lock("sha-b"):
+            raise ValueError("broken pdf")
+    assert ingested_text._ingest_locks == {}
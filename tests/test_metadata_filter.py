@@ -0,0 +1,104 @@
+# tests/test_metadata_filter.py
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("faiss")
+pytest.importorskip("langchain_core")
+
+from rag import segment_store
+from rag.hybrid_retriever import HybridRetriever
+from rag.metadata_filter import matches, normalize_filter
+from rag.segment_store import SegmentedVectorStore
+
+from tests.test_segment_store import FakeEmbedding
+
+CUSTOMERS = ["A社", "B社", "C社"]
+
+
+def make_store(tmp_path, index_type="flat", codec=None, n=600):
+    rng = np.random.default_rng(5)
+    vectors = rng.random((n, 16), dtype="float32")
+    docs = [segment_store.Document(page_content=f"doc{i}", metadata={
+        "source": f"file{i % 7}.pdf",
+        "page": i % 50,
+        "customer": CUSTOMERS[i % 3],
+        "tags": ["見積"] if i % 10 == 0 else ["仕様", "図面"],
+        "n": i,
+    }) for i in range(n)]
+    store = SegmentedVectorStore(str(tmp_path), FakeEmbedding())
+    store.add_embeddings(vectors, docs, index_type=index_type, codec=codec)
+    return store, vectors, docs
+
+
+def test_normalize_filter_validates_fields():
+    assert normalize_filter({}) is None
+    assert normalize_filter({"source": "a.pdf", "tags": []}) == (("source", "in", ("a.pdf",)),)
+    assert normalize_filter({"page": {"lte": 5, "gte": 1}}) == (("page", "range", (("gte", 1.0), ("lte", 5.0))),)
+    with pytest.raises(ValueError):
+        normalize_filter({"owner": "x"})
+    with pytest.raises(ValueError):
+        normalize_filter({"source": {"gte": 1}})
+    assert matches({"tags": ["仕様", "図面"], "page": 3}, normalize_filter({"tags": "図面", "page": {"lt": 4}}))
+
+
+@pytest.mark.parametrize("index_type,codec", [("flat", None), ("hnsw", None), ("ivf", None), ("flat", "sq8")])
+def test_filtered_search_returns_full_k_of_matching_chunks(tmp_path, monkeypatch, index_type, codec):
+    from rag import ann_index
+
+    monkeypatch.setattr(ann_index, "ANN_REFINE_K_FACTOR", 4)
+    store, vectors, docs = make_store(tmp_path, index_type, codec)
+    search_filter = {"customer": "B社", "page": {"gte": 10, "lte": 30}}
+    allowed = [i for i, d in enumerate(docs) if matches(d.metadata, normalize_filter(search_filter))]
+
+    query = vectors[0].tolist()
+    hits = store.similarity_search_by_vector(query, k=8, filter=search_filter)
+    assert len(hits) == 8
+    assert all(d.metadata["customer"] == "B社" and 10 <= d.metadata["page"] <= 30 for d in hits)
+    if index_type == "flat" and codec is None:
+        exact = sorted(allowed, key=lambda i: ((vectors[i] - vectors[0]) ** 2).sum())[:8]
+        assert [d.metadata["n"] for d in hits] == exact
+
+    # 対象が k 件より少なければ、あるだけ返す
+    few = store.similarity_search_by_vector(query, k=8, filter={"tags": "見積", "customer": "A社", "page": 0})
+    assert sorted(d.metadata["n"] for d in few) == [0, 150, 300, 450]
+
+
+def test_filter_applies_to_lexical_and_hybrid_search(tmp_path):
+    store = SegmentedVectorStore(str(tmp_path), FakeEmbedding())
+    store.add_texts(["型番 ABC-1200 の仕様", "型番 ABC-1200 の見積"],
+                    [{"source": "spec.pdf", "customer": "A社"}, {"source": "quote.pdf", "customer": "B社"}])
+    store.add_texts(["ABC-1200 の図面"], [{"source": "drawing.pdf", "customer": "B社"}])
+
+    hits = store.lexical_search("ABC-1200", k=5, filter={"customer": "B社"})
+    assert sorted(d.metadata["source"] for d, _ in hits) == ["drawing.pdf", "quote.pdf"]
+
+    retriever = HybridRetriever(vectorstore=store, k=5, search_filter={"source": ["spec.pdf", "drawing.pdf"]})
+    docs = retriever.invoke("ABC-1200")
+    assert sorted(d.metadata["source"] for d in docs) == ["drawing.pdf", "spec.pdf"]
+
+
+def test_document_scope_searches_only_that_documents_ids(tmp_path):
+    rng = np.random.default_rng(6)
+    store = SegmentedVectorStore(str(tmp_path), FakeEmbedding())
+    batches = {}
+    for name in ["a", "b", "c"]:
+        vectors = rng.random((300, 16), dtype="float32")
+        docs = [segment_store.Document(page_content=f"{name}{i}", metadata={"source": f"{name}.pdf", "n": i})
+                for i in range(300)]
+        store.add_embeddings(vectors, docs, files=[{"sha256": f"sha-{name}", "source": f"{name}.pdf", "count": 300}],
+                             index_type="hnsw" if name == "b" else "flat")
+        batches[name] = vectors
+
+    query = batches["b"][17].tolist()
+    scoped = store.similarity_search_by_vector(query, k=5, filter={"document_id": "sha-b"})
+    assert len(scoped) == 5 and {d.metadata["source"] for d in scoped} == {"b.pdf"}
+    assert scoped[0].metadata["n"] == 17
+    # 対象の文書のセグメントだけを開く
+    ranges = store.document_ranges(["sha-b"])
+    assert [seg.name for seg in store._segments_for(ranges)] == [store.segments[1].name]
+
+    both = store.similarity_search_by_vector(query, k=20, filter={"document_id": ["sha-a", "sha-c"]})
+    assert {d.metadata["source"] for d in both} <= {"a.pdf", "c.pdf"} and len(both) == 20
+    assert store.similarity_search_by_vector(query, k=5, filter={"document_id": "unknown"}) == []
+    lexical = store.lexical_search("b17", k=3, filter={"document_id": "sha-a"})
+    assert lexical and {d.metadata["source"] for d, _ in lexical} == {"a.pdf"}
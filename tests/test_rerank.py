@@ -0,0 +1,73 @@
+# tests/test_rerank.py
+import time
+
+import pytest
+
+pytest.importorskip("langchain_core")
+
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from rag.rerank import LexicalOverlapScorer, RerankingRetriever, metrics
+
+
+class ListRetriever(BaseRetriever):
+    docs: list
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        return list(self.docs)
+
+
+class SlowScorer:
+    def score(self, query, docs, deadline=None):
+        time.sleep(0.05)
+        return list(range(len(docs)))
+
+
+CANDIDATES = [
+    Document(page_content="会社概要と沿革"),
+    Document(page_content="保証期間は一年"),
+    Document(page_content="型番 XR-200 の定格電圧は 100V"),
+]
+
+
+def test_lexical_scorer_moves_matching_chunk_to_top():
+    retriever = RerankingRetriever(base_retriever=ListRetriever(docs=CANDIDATES),
+                                   scorer=LexicalOverlapScorer(), top_n=2)
+    docs, info = retriever.retrieve_with_stats("XR-200 の電圧")
+    assert docs[0].page_content.startswith("型番 XR-200")
+    assert len(docs) == 2 and info["fallback"] is False
+
+
+def test_over_budget_falls_back_to_retrieval_order():
+    before = metrics.stats()["fallbacks"]
+    retriever = RerankingRetriever(base_retriever=ListRetriever(docs=CANDIDATES),
+                                   scorer=SlowScorer(), top_n=2, budget_ms=1)
+    docs, info = retriever.retrieve_with_stats("質問")
+    assert docs == CANDIDATES[:2]
+    assert info["fallback"] is True and info["rerank_ms"] >= 1
+    assert metrics.stats()["fallbacks"] == before + 1
+
+
+def test_warmup_loads_cross_encoder_before_first_query(monkeypatch):
+    import sys
+    import types
+    from rag import rerank
+
+    loaded = []
+
+    class FakeCrossEncoder:
+        def __init__(self, model_name, max_length=None):
+            loaded.append(model_name)
+
+        def predict(self, pairs):
+            return [float(len(doc)) for _, doc in pairs]
+
+    monkeypatch.setitem(sys.modules, "sentence_transformers", types.SimpleNamespace(CrossEncoder=FakeCrossEncoder))
+    monkeypatch.setattr(rerank, "_scorer_cache", {})
+    scorer = rerank.warmup_scorer("cross_encoder")
+    assert loaded == [rerank.RERANK_MODEL]
+    # 質問のときはもう読み込まない
+    assert scorer.score("質問", CANDIDATES[:2], deadline=time.perf_counter() + 1) == [7.0, 7.0]
+    assert loaded == [rerank.RERANK_MODEL] and rerank.get_scorer("cross_encoder") is scorer
+    assert rerank.warmup_scorer("none") is None
@@ -0,0 +1,274 @@
+# tests/test_segment_store.py
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("faiss")
+pytest.importorskip("langchain_core")
+
+from langchain_core.embeddings import Embeddings
+
+from rag import segment_store
+from rag.segment_store import SegmentedVectorStore
+
+
+class FakeEmbedding(Embeddings):
+    """文字コードの出現頻度をベクトルにする決定的な埋め込み"""
+    dim = 16
+
+    def _vec(self, text):
+        v = np.zeros(self.dim, dtype="float32")
+        for ch in text:
+            v[ord(ch) % self.dim] += 1.0
+        return v.tolist()
+
+    def embed_documents(self, texts):
+        return [self._vec(t) for t in texts]
+
+    def embed_query(self, text):
+        return self._vec(text)
+
+
+def test_each_add_writes_one_segment(tmp_path):
+    store = SegmentedVectorStore(str(tmp_path), FakeEmbedding())
+    ids1 = store.add_texts(["aaaa", "bbbb"], [{"source": "a.pdf"}, {"source": "a.pdf"}])
+    ids2 = store.add_texts(["cccc"], [{"source": "c.pdf"}])
+
+    assert ids1 == ["0", "1"] and ids2 == ["2"]
+    assert len(store.segments) == 2
+    assert store.similarity_search("cccc", k=1)[0].metadata["source"] == "c.pdf"
+
+    # 別インスタンス（別ワーカー）からも manifest 経由で読める
+    reopened = SegmentedVectorStore(str(tmp_path), FakeEmbedding())
+    assert len(reopened) == 3
+    docs = reopened.similarity_search("aaaa", k=2)
+    assert [d.page_content for d in docs][0] == "aaaa"
+
+
+def test_top_k_merges_across_segments(tmp_path):
+    store = SegmentedVectorStore(str(tmp_path), FakeEmbedding())
+    for text in ["abab", "abac", "zzzz"]:
+        store.add_texts([text])
+    results = store.similarity_search_with_score("abab", k=2)
+    assert [d.page_content for d, _ in results] == ["abab", "abac"]
+    assert results[0][1] <= results[1][1]
+
+
+def test_merge_small_segments(tmp_path, monkeypatch):
+    monkeypatch.setattr(segment_store, "SEGMENT_MERGE_THRESHOLD", 100)
+    monkeypatch.setattr(segment_store, "SEGMENT_RETIRE_SECONDS", 0)
+    store = SegmentedVectorStore(str(tmp_path), FakeEmbedding())
+    for i in range(5):
+        store.add_texts([f"doc{i}" * 3], [{"n": i}])
+    assert len(store.segments) == 5
+
+    merged = store.merge_small_segments()
+    assert merged is not None
+    assert len(store.segments) == 1
+    assert len(store) == 5
+    assert store.similarity_search("doc3doc3doc3", k=1)[0].metadata["n"] == 3
+    assert len(list((tmp_path / "segments").iterdir())) == 1
+
+
+def _files(sha, source, count):
+    return [{"sha256": sha, "source": source, "count": count}]
+
+
+def test_delete_source_only_touches_its_segments(tmp_path):
+    store = SegmentedVectorStore(str(tmp_path), FakeEmbedding())
+    emb = FakeEmbedding()
+    for sha, source, texts in [("h1", "a.pdf", ["aaaa", "aaab"]), ("h2", "b.pdf", ["bbbb"])]:
+        vectors = np.asarray(emb.embed_documents(texts), dtype="float32")
+        docs = [segment_store.Document(page_content=t, metadata={"source": source}) for t in texts]
+        store.add_embeddings(vectors, docs, files=_files(sha, source, len(texts)))
+    untouched = store.segments[1].name
+
+    assert store.delete_source("a.pdf") == 2
+    assert [seg.name for seg in store.segments] == [untouched]
+    assert store.ingested_file("h1") is None and store.ingested_file("h2") is not None
+    assert {d.metadata["source"] for d in store.similarity_search("aaaa", k=5)} == {"b.pdf"}
+    assert store.delete_source("a.pdf") == 0
+
+
+def test_same_file_from_two_workers_is_added_once(tmp_path):
+    emb = FakeEmbedding()
+    worker_a = SegmentedVectorStore(str(tmp_path), emb)
+    worker_b = SegmentedVectorStore(str(tmp_path), emb)  # 別プロセスの同じストア（先に開いた古い状態）
+
+    def add(store, items):
+        texts = [t for _, _, ts in items for t in ts]
+        docs = [segment_store.Document(page_content=t, metadata={"source": src})
+                for _, src, ts in items for t in ts]
+        files = [f for sha, src, ts in items for f in _files(sha, src, len(ts))]
+        return store.add_embeddings(np.asarray(emb.embed_documents(texts), dtype="float32"), docs, files=files)
+
+    assert len(add(worker_a, [("h1", "a.pdf", ["aaaa", "aaab"])])) == 2
+    first = worker_a.ingested_file("h1")["vector_ids"]
+    # 両方の重複チェックをすり抜けた同じ PDF は、書き込みロックの中の台帳の見直しで弾かれる
+    assert add(worker_b, [("h1", "a.pdf", ["aaaa", "aaab"])]) == []
+    # 一部だけ取り込み済みなら、まだのファイルの分だけ追記する
+    assert len(add(worker_b, [("h1", "a.pdf", ["aaaa", "aaab"]), ("h2", "b.pdf", ["bbbb"])])) == 1
+
+    assert len(worker_b) == 3 and worker_b.ingested_file("h1")["vector_ids"] == first
+    assert worker_b.delete_source("a.pdf") == 2 and len(worker_b) == 1
+
+
+def test_delete_rewrites_shared_segment(tmp_path, monkeypatch):
+    monkeypatch.setattr(segment_store, "SEGMENT_MERGE_THRESHOLD", 100)
+    monkeypatch.setattr(segment_store, "SEGMENT_RETIRE_SECONDS", 0)
+    store = SegmentedVectorStore(str(tmp_path), FakeEmbedding())
+    store.add_texts(["aaaa", "bbbb", "cccc"], [{"source": "a.pdf"}, {"source": "b.pdf"}, {"source": "a.pdf"}])
+
+    assert store.delete_source("a.pdf") == 2
+    assert len(store) == 1
+    assert store.segments[0].ids().tolist() == [1]
+    reopened = SegmentedVectorStore(str(tmp_path), FakeEmbedding())
+    assert [d.page_content for d in reopened.similarity_search("aaaa", k=5)] == ["bbbb"]
+    assert len(list((tmp_path / "segments").iterdir())) == 1
+
+
+def test_replace_source_swaps_in_one_publish(tmp_path):
+    store = SegmentedVectorStore(str(tmp_path), FakeEmbedding())
+    emb = FakeEmbedding()
+    old = np.asarray(emb.embed_documents(["old text"]), dtype="float32")
+    store.add_embeddings(old, [segment_store.Document(page_content="old text", metadata={"source": "a.pdf"})],
+                         files=_files("v1", "a.pdf", 1))
+    version = store.stats()["manifest_version"]
+
+    new = np.asarray(emb.embed_documents(["new text"]), dtype="float32")
+    store.add_embeddings(new, [segment_store.Document(page_content="new text", metadata={"source": "a.pdf"})],
+                         files=_files("v2", "a.pdf", 1), replace_source="a.pdf")
+    assert store.stats()["manifest_version"] == version + 1
+    assert [d.page_content for d in store.similarity_search("old text", k=5)] == ["new text"]
+    assert [f["sha256"] for f in store.ingested_files(source="a.pdf")] == ["v2"]
+
+
+def test_choose_index_spec_by_size():
+    from rag.ann_index import choose_index_spec
+
+    assert choose_index_spec(1000, 384, index_type="auto", target_ms=5)["type"] == "flat"
+    assert choose_index_spec(200_000, 384, index_type="auto", target_ms=5)["type"] == "hnsw"
+    ivf = choose_index_spec(200_000, 384, index_type="ivf", target_ms=5)
+    assert ivf["params"]["nlist"] == int(4 * 200_000 ** 0.5)
+    assert 1 <= ivf["params"]["nprobe"] <= ivf["params"]["nlist"]
+    # 学習できない小さなセグメントは IVF を指定しても Flat
+    assert choose_index_spec(10, 384, index_type="ivf")["type"] == "flat"
+
+
+@pytest.mark.parametrize("index_type", ["ivf", "hnsw"])
+def test_ann_segment_is_reopened_with_recorded_spec(tmp_path, index_type):
+    rng = np.random.default_rng(0)
+    vectors = rng.random((400, 16), dtype="float32")
+    docs = [segment_store.Document(page_content=f"doc{i}", metadata={"n": i}) for i in range(400)]
+    store = SegmentedVectorStore(str(tmp_path), FakeEmbedding())
+    store.add_embeddings(vectors, docs, index_type=index_type)
+    spec = store._manifest["segments"][0]["index"]
+    assert spec["type"] == index_type
+
+    reopened = SegmentedVectorStore(str(tmp_path), FakeEmbedding())
+    assert reopened.stats()["index_types"] == [index_type]
+    reopened.tune(nprobe=spec["params"].get("nlist"), ef_search=200)
+    hit = reopened.similarity_search_by_vector(vectors[123].tolist(), k=1)[0]
+    assert hit.metadata["n"] == 123
+    # 削除時の書き換えで使う再構成もできる
+    assert np.allclose(reopened.segments[0].vectors()[5], vectors[5])
+
+
+@pytest.mark.parametrize("codec,refine", [("fp16", 0), ("sq8", 0), ("sq8", 4)])
+def test_compressed_segment_round_trip(tmp_path, monkeypatch, codec, refine):
+    from rag import ann_index
+
+    monkeypatch.setattr(ann_index, "ANN_REFINE_K_FACTOR", refine)
+    rng = np.random.default_rng(1)
+    vectors = rng.random((600, 16), dtype="float32")
+    docs = [segment_store.Document(page_content=f"doc{i}", metadata={"n": i}) for i in range(600)]
+    store = SegmentedVectorStore(str(tmp_path), FakeEmbedding())
+    store.add_embeddings(vectors, docs, index_type="flat", codec=codec)
+
+    reopened = SegmentedVectorStore(str(tmp_path), FakeEmbedding())
+    spec = reopened.segments[0].spec
+    assert (spec["codec"], spec["refine"]) == (codec, refine)
+    hits = reopened.similarity_search_by_vector(vectors[42].tolist(), k=3)
+    assert 42 in [d.metadata["n"] for d in hits]
+
+
+def test_ann_report_compares_against_flat():
+    from rag.ann_report import evaluate
+
+    rng = np.random.default_rng(2)
+    vectors = rng.random((500, 16), dtype="float32")
+    rows = evaluate(vectors, vectors[:20], k=5, configs=[("flat", 0), ("sq8", 0)])
+    flat, sq8 = rows
+    assert flat["recall@5"] == 1.0
+    assert sq8["bytes_per_vector"] < flat["bytes_per_vector"]
+
+
+def test_pq_falls_back_to_sq8_without_enough_training_points():
+    from rag.ann_index import choose_index_spec, factory_string
+
+    small = choose_index_spec(100, 384, index_type="flat", codec="pq", refine=0)
+    assert small["codec"] == "sq8"
+    large = choose_index_spec(50_000, 384, index_type="ivf", codec="pq", refine=4)
+    assert factory_string(large) == f"IVF{large['params']['nlist']},PQ48,RFlat"
+
+
+def test_chunks_are_read_from_sqlite_not_pickle(tmp_path):
+    import pickle
+
+    store = SegmentedVectorStore(str(tmp_path), FakeEmbedding())
+    store.add_texts(["aaaa", "bbbb"], [{"source": "a.pdf", "page": 1}, {"source": "b.pdf", "page": 2}])
+    seg_dir = tmp_path / "segments" / store.segments[0].name
+    assert sorted(p.name for p in seg_dir.iterdir()) == ["chunks.db", "index.faiss"]
+
+    reopened = SegmentedVectorStore(str(tmp_path), FakeEmbedding())
+    doc = reopened.similarity_search("bbbb", k=1)[0]
+    assert (doc.page_content, doc.metadata) == ("bbbb", {"source": "b.pdf", "page": 2})
+    assert reopened.sources() == [{"source": "a.pdf", "chunks": 1}, {"source": "b.pdf", "chunks": 1}]
+
+    # 旧形式（docstore.pkl）のセグメントも読める
+    legacy = seg_dir / "docstore.pkl"
+    legacy.write_bytes(pickle.dumps(
+        {i: d for i, d in zip([0, 1], reopened.segments[0].documents([0, 1]))}
+    ))
+    (seg_dir / "chunks.db").unlink()
+    legacy_store = SegmentedVectorStore(str(tmp_path), FakeEmbedding())
+    assert legacy_store.similarity_search("aaaa", k=1)[0].page_content == "aaaa"
+    assert legacy_store.delete_source("a.pdf") == 1
+
+
+def test_ivf_segment_is_memory_mapped(tmp_path):
+    from rag.startup_benchmark import _measure
+
+    rng = np.random.default_rng(3)
+    vectors = rng.random((400, 16), dtype="float32")
+    docs = [segment_store.Document(page_content=f"doc{i}", metadata={"n": i}) for i in range(400)]
+    SegmentedVectorStore(str(tmp_path), FakeEmbedding()).add_embeddings(vectors, docs, index_type="ivf")
+
+    mapped = SegmentedVectorStore(str(tmp_path), FakeEmbedding(), mmap=True)
+    eager = SegmentedVectorStore(str(tmp_path), FakeEmbedding(), mmap=False)
+    assert mapped.segments[0].mmapped and not eager.segments[0].mmapped
+    mapped.tune(nprobe=100)
+    assert mapped.similarity_search_by_vector(vectors[7].tolist(), k=1)[0].metadata["n"] == 7
+    # 削除時の書き換えもマップしたまま読める
+    assert mapped.delete_ids([7]) == 1
+
+    row = _measure(str(tmp_path), mmap=True)
+    assert (row["mode"], row["mmapped_segments"], row["vectors"]) == ("mmap", 1, 399)
+
+
+def test_retired_segments_stay_readable_for_inflight_snapshots(tmp_path, monkeypatch):
+    monkeypatch.setattr(segment_store, "SEGMENT_MERGE_THRESHOLD", 100)
+    store = SegmentedVectorStore(str(tmp_path), FakeEmbedding())
+    store.add_texts(["aaaa", "bbbb"], [{"source": "a.pdf"}, {"source": "b.pdf"}])
+    old = store.snapshot()
+    store.delete_source("a.pdf")
+
+    # 差し替え前のスナップショットで始まった検索は、退役したセグメントを最後まで読める
+    assert old.segments[0].get_many([0, 1])[0].page_content == "aaaa"
+    assert [seg.name for seg in store.segments] != [seg.name for seg in old.segments]
+    assert len(list((tmp_path / "segments").iterdir())) == 2
+
+    monkeypatch.setattr(segment_store, "SEGMENT_RETIRE_SECONDS", 0)
+    with store.exclusive():
+        assert store._reap_segments() == [old.segments[0].name]
+    # 書きかけの一時ディレクトリは残らない
+    assert not [p for p in (tmp_path / "segments").iterdir() if p.name.endswith(".tmp")]
@@ -0,0 +1,42 @@
+# tests/test_semantic_cache.py
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from rag.semantic_cache import SemanticCache
+
+VECTORS = {
+    "標準仕様は？": [1.0, 0.0, 0.0],
+    "標準仕様を教えて": [0.99, 0.05, 0.0],
+    "価格は？": [0.0, 1.0, 0.0],
+}
+
+
+def make_cache(**kwargs):
+    return SemanticCache(lambda q: VECTORS[q], threshold=0.95, **kwargs)
+
+
+def test_paraphrase_hits():
+    cache = make_cache()
+    cache.store("標準仕様は？", "A です", [{"metadata": {"source": "a.pdf", "page": "1"}}], "v1")
+    hit = cache.lookup("標準仕様を教えて", "v1")
+    assert hit["answer"] == "A です"
+    assert hit["similarity"] >= 0.95
+    assert cache.lookup("価格は？", "v1") is None
+    assert cache.stats()["hits"] == 1
+
+
+def test_version_mismatch_misses():
+    cache = make_cache()
+    cache.store("標準仕様は？", "A です", [], "v1")
+    assert cache.lookup("標準仕様は？", "v2") is None
+
+
+def test_invalidate_and_eviction():
+    cache = make_cache(max_entries=1)
+    cache.store("標準仕様は？", "A", [], "v1")
+    cache.store("価格は？", "B", [], "v1")
+    assert cache.lookup("標準仕様は？", "v1") is None
+    assert cache.lookup("価格は？", "v1")["answer"] == "B"
+    cache.invalidate()
+    assert cache.lookup("価格は？", "v1") is None
@@ -0,0 +1,65 @@
+# tests/test_startup.py
+import time
+
+import pytest
+
+from api import startup
+from api.startup import StartupGraph
+
+
+def test_independent_steps_run_in_parallel_and_once():
+    graph = StartupGraph()
+    calls = []
+
+    def slow(name, value):
+        def fn(results):
+            calls.append(name)
+            time.sleep(0.3)
+            return value
+        return fn
+
+    graph.step("download")(slow("download", "files"))
+    graph.step("embedding")(slow("embedding", "model"))
+    graph.step("llm", required=False)(slow("llm", "client"))
+    graph.step("store", after=("download", "embedding"))(lambda results: (results["download"], results["embedding"]))
+
+    started = time.perf_counter()
+    results = graph.run()
+    # 3 つの 0.3 秒のステップは並行に走るので、合計は一番長いステップの分だけ
+    assert time.perf_counter() - started < 0.8
+    assert sorted(calls) == ["download", "embedding", "llm"]
+    assert results["store"] == ("files", "model")
+    assert startup.readiness()["ready"] is True
+
+
+def test_failed_optional_step_degrades_without_blocking_dependents():
+    graph = StartupGraph()
+
+    @graph.step("llm", required=False)
+    def llm(results):
+        raise RuntimeError("OPENAI_API_KEY not set")
+
+    @graph.step("chain", after=("llm",))
+    def chain(results):
+        return "search-only" if "llm" not in results else "rag"
+
+    assert graph.run()["chain"] == "search-only"
+    status = graph.status()
+    assert status["ready"] is True
+    assert status["components"]["llm"]["state"] == "failed"
+    assert "OPENAI_API_KEY" in status["components"]["llm"]["error"]
+
+    @graph.step("vectorstore")
+    def vectorstore(results):
+        raise RuntimeError("boom")
+
+    graph.run()
+    assert graph.status()["ready"] is False
+
+
+def test_dependency_cycles_are_rejected():
+    graph = StartupGraph()
+    graph.step("a", after=("b",))(lambda results: None)
+    graph.step("b", after=("a",))(lambda results: None)
+    with pytest.raises(ValueError):
+        graph.run()
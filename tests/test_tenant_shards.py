@@ -0,0 +1,80 @@
+# tests/test_tenant_shards.py
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("faiss")
+pytest.importorskip("langchain_core")
+
+from rag.tenant_shards import TenantShards, validate_tenant
+
+from tests.test_segment_store import FakeEmbedding
+
+
+def make_shards(tmp_path, **kwargs):
+    return TenantShards(str(tmp_path), embedding_factory=FakeEmbedding, sync_factory=lambda *_: None, **kwargs)
+
+
+def test_tenants_do_not_share_vectors(tmp_path):
+    shards = make_shards(tmp_path)
+    shards.get("A社").add_texts(["aaaa"], [{"source": "a.pdf"}])
+    shards.get("B社").add_texts(["bbbb"], [{"source": "b.pdf"}])
+
+    assert [d.metadata["source"] for d in shards.get("A社").similarity_search("bbbb", k=5)] == ["a.pdf"]
+    assert shards.tenants() == ["A社", "B社"]
+    with pytest.raises(ValueError):
+        validate_tenant("../other")
+
+
+def test_shards_are_loaded_lazily_and_evicted_lru(tmp_path):
+    shards = make_shards(tmp_path, max_loaded=2, idle_seconds=60)
+    for tenant in ["t1", "t2", "t3"]:
+        shards.get(tenant).add_texts([tenant * 2])
+    # 上限 2 を超えたので一番古い t1 が閉じられる
+    assert shards.loaded() == ["t2", "t3"]
+
+    store = shards.get("t1")  # 再ロード（ディスクから開き直す）
+    assert len(store) == 1 and shards.loaded() == ["t3", "t1"]
+    assert shards.stats()["loads"] == 4
+
+    # しばらく使われていないシャードは閉じる
+    import time
+    assert sorted(shards.evict(now=time.time() + 120)) == ["t1", "t3"]
+    assert shards.loaded() == []
+
+
+def test_hot_reload_targets_do_not_keep_shards_alive(tmp_path, monkeypatch):
+    import sys
+    import types
+    from rag import gcs_sync, hot_reload, tenant_shards
+
+    shards = make_shards(tmp_path, idle_seconds=60)
+    shards.get("t1").add_texts(["aaaa"])
+    last_used = shards._loaded["t1"][1]
+    monkeypatch.setattr(tenant_shards, "_shards", shards)
+    # 共有ストア側（埋め込みモデルを読み込む）は使わない
+    monkeypatch.setitem(sys.modules, "rag.ingested_text",
+                        types.SimpleNamespace(LOCAL_VECTOR_DIR=str(tmp_path / "shared"), get_vectorstore=lambda: None))
+    monkeypatch.setattr(gcs_sync, "get_gcs_sync", lambda *args, **kwargs: None)
+
+    store = shards.loaded_stores()[0][1]
+    targets = hot_reload.default_targets()
+    assert [(name, target) for name, target, _, _ in targets[1:]] == [("tenant:t1", store)]
+    # 監視は利用に数えない（最終利用時刻が変わらず、idle で追い出される）
+    assert shards._loaded["t1"][1] == last_used
+    assert shards.evict(now=last_used + 120) == ["t1"]
+
+
+def test_idle_shards_are_evicted_in_the_background(tmp_path):
+    import time
+
+    shards = make_shards(tmp_path, idle_seconds=0.05, evict_interval=0.02)
+    shards.get("t1").add_texts(["aaaa"])
+    assert shards.loaded() == ["t1"]
+    # ロードが終わったテナントのロック用の表は空になる
+    assert shards._load_locks == {}
+
+    deadline = time.time() + 5
+    while shards.loaded() and time.time() < deadline:
+        time.sleep(0.01)
+    shards.stop()
+    assert shards.loaded() == [] and shards.stats()["evictions"] == 1
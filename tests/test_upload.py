@@ -0,0 +1,46 @@
+# tests/test_upload.py
+import asyncio
+import threading
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("google.cloud.storage")
+pytest.importorskip("sentence_transformers")
+
+from fastapi import HTTPException
+
+from api.routers import upload
+
+
+class FakeStore:
+    def __init__(self, status):
+        self.status = status
+
+    def get(self, job_id):
+        return {"id": job_id, "status": self.status, "error": None}
+
+
+class FakeQueue:
+    def __init__(self, status):
+        self.store = FakeStore(status)
+
+    def future(self, job_id):
+        return None  # 他のワーカーの resume() が取得して実行している
+
+
+def test_wait_for_job_follows_the_store_not_the_local_future(monkeypatch):
+    queue = FakeQueue("running")
+    monkeypatch.setattr(upload, "get_ingest_queue", lambda: queue)
+    monkeypatch.setattr(upload, "UPLOAD_PDF_POLL_SECONDS", 0.01)
+    threading.Timer(0.1, lambda: setattr(queue.store, "status", "succeeded")).start()
+    assert asyncio.run(upload._wait_for_job("job-1"))["status"] == "succeeded"
+
+
+def test_wait_for_job_times_out_with_504(monkeypatch):
+    monkeypatch.setattr(upload, "get_ingest_queue", lambda: FakeQueue("queued"))
+    monkeypatch.setattr(upload, "UPLOAD_PDF_POLL_SECONDS", 0.01)
+    monkeypatch.setattr(upload, "UPLOAD_PDF_WAIT_SECONDS", 0.05)
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(upload._wait_for_job("job-1"))
+    assert e.value.status_code == 504